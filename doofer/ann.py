@@ -0,0 +1,440 @@
+""" Approximate nearest neighbour search with an IVF-flat index
+
+The unit vectors are clustered with spherical k-means. A search only
+scores the vectors in the few clusters whose centroids are closest to the
+query, which trades a little recall for far less work on large libraries.
+Each user's index is stored in the database as an AnnIndex row with the
+centroids, and AnnSegment rows with the vectors. Each sync appends a
+segment with its changes, and the index is only written whole when it is
+compacted. Only the job worker writes them; web processes apply the
+segments they haven't seen yet.
+"""
+
+# pylint: disable=no-member
+
+import io
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import Lock
+from typing import NamedTuple
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from doofer.models import AnnIndex, AnnSegment, Note
+from doofer.similarity import load_note_vectors
+
+# compact when more than this fraction of the rows are tombstones
+COMPACT_DEAD_FRACTION = 0.2
+# retrain the centroids when the index has grown this much since training
+RETRAIN_GROWTH = 2.0
+# at most this many vectors are used to train the centroids
+MAX_TRAINING_ROWS = 50000
+KMEANS_ITERATIONS = 10
+# seconds each sync looks back before the previous one
+SYNC_OVERLAP = 60
+# an index is written whole once it has this many segments
+MAX_SEGMENTS = 64
+# the most users, and the most bytes of index, each process keeps loaded
+MAX_LOADED_USERS = 8
+MAX_LOADED_BYTES = 512 * 1024 * 1024
+
+
+def default_nlist(rows: int) -> int:
+    """number of clusters for an index of this many vectors"""
+    return max(1, min(rows, int(4 * np.sqrt(rows))))
+
+
+def nearest_centroids(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """the closest centroid of each vector, in chunks to bound memory"""
+    lists = np.zeros(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), 8192):
+        chunk = vectors[start : start + 8192]
+        lists[start : start + 8192] = np.argmax(chunk @ centroids.T, axis=1)
+    return lists
+
+
+def train_centroids(vectors: np.ndarray, nlist: int, seed: int = 0) -> np.ndarray:
+    """spherical k-means centroids of unit vectors"""
+    rng = np.random.default_rng(seed)
+    if len(vectors) > MAX_TRAINING_ROWS:
+        vectors = vectors[rng.choice(len(vectors), MAX_TRAINING_ROWS, replace=False)]
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        lists = nearest_centroids(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, lists, vectors)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        # an empty cluster keeps its old centroid
+        filled = norms[:, 0] > 0
+        centroids[filled] = sums[filled] / norms[filled]
+    return centroids
+
+
+class IVFIndex:
+    """An inverted-file index of note vectors
+    Each note has up to two rows (title and content) sharing its id.
+    Updated notes get new rows and their old rows become tombstones,
+    which compact() removes.
+    """
+
+    def __init__(self, centroids, vectors, ids, lists, alive, trained_size, meta=None):
+        self.centroids = centroids
+        self.vectors = vectors
+        self.ids = ids
+        self.lists = lists
+        self.alive = alive
+        self.trained_size = trained_size
+        # sync state kept with the index, see sync_user_ann
+        self.meta: dict = meta or {}
+        self.id_rows: dict[int, list[int]] = {}
+        for row in np.flatnonzero(alive):
+            self.id_rows.setdefault(int(ids[row]), []).append(int(row))
+
+    @classmethod
+    def build(cls, ids: np.ndarray, vectors: np.ndarray, nlist=None, seed=0):
+        """train an index on (ids, unit vectors); all-zero rows are skipped"""
+        keep = np.any(vectors != 0, axis=1)
+        ids, vectors = ids[keep], np.ascontiguousarray(vectors[keep], np.float32)
+        dims = vectors.shape[1]
+        if len(vectors) == 0:
+            centroids = np.zeros((0, dims), dtype=np.float32)
+            lists = np.zeros(0, dtype=np.int32)
+        else:
+            centroids = train_centroids(
+                vectors, nlist or default_nlist(len(vectors)), seed
+            )
+            lists = nearest_centroids(vectors, centroids)
+        alive = np.ones(len(vectors), dtype=bool)
+        return cls(centroids, vectors, ids.astype(np.int64), lists, alive, len(ids))
+
+    @classmethod
+    def empty(cls, centroids: np.ndarray, trained_size: int, meta=None):
+        """an index with centroids and no rows"""
+        dims = centroids.shape[1]
+        return cls(
+            centroids,
+            np.zeros((0, dims), dtype=np.float32),
+            np.zeros(0, dtype=np.int64),
+            np.zeros(0, dtype=np.int32),
+            np.zeros(0, dtype=bool),
+            trained_size,
+            meta,
+        )
+
+    def copy(self) -> "IVFIndex":
+        """a copy that can be changed while this one is searched"""
+        copied = IVFIndex.empty(self.centroids, self.trained_size, dict(self.meta))
+        copied.vectors, copied.ids, copied.lists = self.vectors, self.ids, self.lists
+        copied.alive = self.alive.copy()
+        copied.id_rows = {note_id: list(rows) for note_id, rows in self.id_rows.items()}
+        return copied
+
+    @property
+    def nbytes(self) -> int:
+        """size of the index arrays"""
+        arrays = (self.centroids, self.vectors, self.ids, self.lists, self.alive)
+        return sum(array.nbytes for array in arrays)
+
+    @property
+    def dims(self) -> int:
+        """length of the indexed vectors"""
+        return self.vectors.shape[1]
+
+    @property
+    def live_rows(self) -> int:
+        """number of rows that are not tombstones"""
+        return int(self.alive.sum())
+
+    def remove(self, note_ids) -> None:
+        """tombstone every row of the notes"""
+        for note_id in note_ids:
+            for row in self.id_rows.pop(int(note_id), []):
+                self.alive[row] = False
+
+    def add(self, ids: np.ndarray, vectors: np.ndarray) -> None:
+        """add rows for notes, replacing any rows they had
+        Vectors of a different length retrain the index on them alone.
+        """
+        self.remove(set(ids.tolist()))
+        keep = np.any(vectors != 0, axis=1)
+        ids, vectors = ids[keep].astype(np.int64), vectors[keep].astype(np.float32)
+        if len(ids) == 0:
+            return
+        if vectors.shape[1] != self.dims:
+            # a new model, the old rows can't be scored against these
+            rebuilt = IVFIndex.build(ids, vectors)
+            self.centroids, self.vectors = rebuilt.centroids, rebuilt.vectors
+            self.ids, self.lists = rebuilt.ids, rebuilt.lists
+            self.alive, self.id_rows = rebuilt.alive, rebuilt.id_rows
+            self.trained_size = rebuilt.trained_size
+            return
+        if len(self.centroids) == 0:
+            # nothing to cluster against yet, start with one cluster
+            self.centroids = vectors[:1].copy()
+        self.append(ids, vectors, nearest_centroids(vectors, self.centroids))
+
+    def append(self, ids: np.ndarray, vectors: np.ndarray, lists: np.ndarray) -> None:
+        """add rows already assigned to their clusters"""
+        start = len(self.ids)
+        self.vectors = np.concatenate([self.vectors, vectors])
+        self.ids = np.concatenate([self.ids, ids])
+        self.lists = np.concatenate([self.lists, lists])
+        self.alive = np.concatenate([self.alive, np.ones(len(ids), dtype=bool)])
+        for offset, note_id in enumerate(ids.tolist()):
+            self.id_rows.setdefault(note_id, []).append(start + offset)
+
+    def needs_compaction(self) -> bool:
+        """true if there are too many tombstones or the clusters are stale"""
+        dead = len(self.alive) - self.live_rows
+        grown = self.live_rows > RETRAIN_GROWTH * max(self.trained_size, 1)
+        return dead > COMPACT_DEAD_FRACTION * max(len(self.alive), 1) or grown
+
+    def compact(self) -> "IVFIndex":
+        """a copy without tombstones, retrained if the index has grown"""
+        rows = np.flatnonzero(self.alive)
+        if self.live_rows > RETRAIN_GROWTH * max(self.trained_size, 1):
+            compacted = IVFIndex.build(self.ids[rows], self.vectors[rows])
+        else:
+            compacted = IVFIndex(
+                self.centroids,
+                self.vectors[rows],
+                self.ids[rows],
+                self.lists[rows],
+                np.ones(len(rows), dtype=bool),
+                self.trained_size,
+            )
+        compacted.meta = self.meta
+        return compacted
+
+    def search(self, queries: np.ndarray, count: int, nprobe: int):
+        """the notes closest to any of the unit query vectors
+        Returns (ids, scores), best first, one entry per note
+        """
+        if len(self.centroids) == 0 or count <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        nprobe = min(nprobe, len(self.centroids))
+        centroid_scores = queries @ self.centroids.T
+        probes = np.argpartition(-centroid_scores, nprobe - 1, axis=1)[:, :nprobe]
+        rows = np.flatnonzero(np.isin(self.lists, probes) & self.alive)
+        scores = (queries @ self.vectors[rows].T).max(axis=0)
+        # best row of each note, then the best notes
+        order = np.argsort(-scores, kind="stable")
+        _, first = np.unique(self.ids[rows][order], return_index=True)
+        best = order[np.sort(first)][:count]
+        return self.ids[rows][best], scores[best]
+
+    def centroid_bytes(self) -> bytes:
+        """the centroids as an .npz file, see from_centroid_bytes"""
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            centroids=self.centroids,
+            trained_size=np.array(self.trained_size),
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def from_centroid_bytes(cls, data: bytes, meta=None) -> "IVFIndex":
+        """an empty index with the centroids written by centroid_bytes()"""
+        with np.load(io.BytesIO(data)) as arrays:
+            return cls.empty(arrays["centroids"], int(arrays["trained_size"]), meta)
+
+    def segment_bytes(self, removed, start: int = 0) -> bytes:
+        """the removed note ids and the rows from 'start' on, as an .npz file"""
+        rows = np.arange(start, len(self.ids))[self.alive[start:]]
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            removed=np.array(sorted(removed), dtype=np.int64),
+            ids=self.ids[rows],
+            vectors=self.vectors[rows],
+            lists=self.lists[rows],
+        )
+        return buffer.getvalue()
+
+    def apply_segment(self, data: bytes) -> None:
+        """apply the changes written by segment_bytes()"""
+        with np.load(io.BytesIO(data)) as arrays:
+            self.remove(arrays["removed"].tolist())
+            self.remove(set(arrays["ids"].tolist()))
+            self.append(arrays["ids"], arrays["vectors"], arrays["lists"])
+
+
+def ann_enabled(note_count: int) -> bool:
+    """true if a library of this size should use the approximate index"""
+    min_notes = settings.ANN_MIN_NOTES
+    return bool(min_notes) and note_count >= min_notes
+
+
+class LoadedAnn(NamedTuple):
+    """an index loaded by this process, and how far it has been read"""
+
+    built_at: datetime
+    segment: int
+    index: IVFIndex
+
+
+_loaded: OrderedDict[str, LoadedAnn] = OrderedDict()
+_loaded_lock = Lock()
+
+
+def remember_ann(uid, loaded: LoadedAnn | None) -> None:
+    """keep a loaded index, dropping the least recently used ones
+    until within MAX_LOADED_USERS and MAX_LOADED_BYTES"""
+    key = str(uid)
+    with _loaded_lock:
+        _loaded.pop(key, None)
+        if loaded is None:
+            return
+        _loaded[key] = loaded
+        size = sum(entry.index.nbytes for entry in _loaded.values())
+        while len(_loaded) > 1 and (
+            len(_loaded) > MAX_LOADED_USERS or size > MAX_LOADED_BYTES
+        ):
+            _, dropped = _loaded.popitem(last=False)
+            size -= dropped.index.nbytes
+
+
+def load_user_ann(uid) -> IVFIndex | None:
+    """A user's index, reading only the segments added since it was loaded
+    The loaded index is never changed, new segments are applied to a copy,
+    so searches running meanwhile see a consistent index.
+    """
+    header = AnnIndex.objects.filter(user=uid).values("built_at", "meta").first()
+    if header is None:
+        remember_ann(uid, None)
+        return None
+    with _loaded_lock:
+        loaded = _loaded.get(str(uid))
+        if loaded is not None:
+            _loaded.move_to_end(str(uid))
+    fresh = loaded is None or loaded.built_at != header["built_at"]
+    if fresh:
+        data = AnnIndex.objects.filter(user=uid).values_list("data", flat=True).first()
+        if data is None:
+            return None
+        index = IVFIndex.from_centroid_bytes(bytes(data))
+        loaded = LoadedAnn(header["built_at"], 0, index)
+    # segments of a newer build are left for the next load, which starts over
+    segments = list(
+        AnnSegment.objects.filter(
+            user=uid, base=header["built_at"], id__gt=loaded.segment
+        )
+        .order_by("id")
+        .values_list("id", "data")
+    )
+    index, segment = loaded.index, loaded.segment
+    if segments and not fresh:
+        index = index.copy()
+    for segment, data in segments:
+        index.apply_segment(bytes(data))
+    if fresh or segments:
+        index.meta = header["meta"]
+    remember_ann(uid, LoadedAnn(header["built_at"], segment, index))
+    return index
+
+
+def save_user_ann(uid, index: IVFIndex) -> None:
+    """store a user's whole index, replacing what was stored"""
+    now = timezone.now()
+    with transaction.atomic():
+        AnnIndex.objects.update_or_create(
+            user=uid,
+            defaults={
+                "data": index.centroid_bytes(),
+                "built_at": now,
+                "saved_at": now,
+                "meta": index.meta,
+            },
+        )
+        AnnSegment.objects.filter(user=uid).delete()
+        segment = AnnSegment.objects.create(
+            user=uid, base=now, data=index.segment_bytes(())
+        )
+    remember_ann(uid, LoadedAnn(now, segment.id, index))
+
+
+def append_user_ann(uid, index: IVFIndex, removed, start: int) -> None:
+    """store the changes a sync made to a stored index, see sync_user_ann
+    removed -- ids of the notes whose rows were removed
+    start -- the first of the rows the sync added
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        base = AnnIndex.objects.values_list("built_at", flat=True).get(user=uid)
+        segment = AnnSegment.objects.create(
+            user=uid, base=base, data=index.segment_bytes(removed, start)
+        )
+        AnnIndex.objects.filter(user=uid).update(saved_at=now, meta=index.meta)
+    remember_ann(uid, LoadedAnn(segment.base, segment.id, index))
+
+
+def note_vectors(notes) -> tuple[np.ndarray, np.ndarray]:
+    """(ids, vectors) with a row for each title and content embedding"""
+    ids, vectors = [], []
+    for note in notes:
+        for vector in (note.title_vector(), note.content_vector()):
+            if vector.size:
+                ids.append(note.id)
+                vectors.append(vector)
+    if not vectors:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 0), dtype=np.float32)
+    return np.array(ids, dtype=np.int64), np.stack(vectors)
+
+
+def sync_user_ann(uid) -> IVFIndex | None:
+    """Bring a user's stored index up to date with their notes
+    Rows changed since the last sync are re-added and deleted notes become
+    tombstones, which are stored as a new segment. The index is compacted
+    and written whole when it needs compaction, has too many segments, or
+    its clusters changed. Libraries below ANN_MIN_NOTES have their index
+    removed.
+    """
+    notes = Note.objects.filter(user=uid)
+    if not ann_enabled(notes.count()):
+        AnnIndex.objects.filter(user=uid).delete()
+        AnnSegment.objects.filter(user=uid).delete()
+        remember_ann(uid, None)
+        return None
+
+    # re-adding a row is harmless, so overlap with the previous sync to
+    # catch rows committed late
+    started = timezone.now() - timedelta(seconds=SYNC_OVERLAP)
+    stored = load_user_ann(uid)
+    if stored is None:
+        ids, vectors = note_vectors(load_note_vectors(notes))
+        if len(ids) == 0:
+            return None
+        index = IVFIndex.build(ids, vectors)
+        index.meta["synced_at"] = started.isoformat()
+        save_user_ann(uid, index)
+        return index
+
+    index = stored.copy()
+    since = datetime.fromisoformat(index.meta["synced_at"])
+    changed = list(
+        load_note_vectors(
+            notes.filter(Q(updated_at__gt=since) | Q(embedded_at__gt=since))
+        )
+    )
+    current = set(notes.values_list("id", flat=True))
+    removed = {note.id for note in changed} | (set(index.id_rows) - current)
+    start = len(index.ids)
+    index.remove(removed)
+    ids, vectors = note_vectors(changed)
+    if len(ids):
+        index.add(ids, vectors)
+    index.meta["synced_at"] = started.isoformat()
+
+    segments = AnnSegment.objects.filter(user=uid).count()
+    retrained = index.centroids is not stored.centroids
+    if retrained or segments >= MAX_SEGMENTS or index.needs_compaction():
+        index = index.compact()
+        save_user_ann(uid, index)
+    else:
+        append_user_ann(uid, index, removed, start)
+    return index
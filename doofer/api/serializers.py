@@ -1,3 +1,4 @@
+from django.conf import settings
 from rest_framework import serializers
 
 from doofer.models import Note
@@ -11,3 +12,36 @@ class NoteSerializer(serializers.ModelSerializer):
         fields = ["id", "title", "comment", "url", "related"]
         read_only_fields = ("user", "related")
         extra_kwargs = {"user": {"read_only": True}}
+
+
+class NoteUpdateSerializer(NoteSerializer):
+    """A change to a note in a bulk request, which names the note by id
+    Fields left out keep their values.
+    """
+
+    id = serializers.IntegerField()
+
+
+class BulkNoteSerializer(serializers.Serializer):
+    """A batch of note creates, updates and deletes"""
+
+    def get_fields(self):
+        """the batch fields, declared here as create and update would shadow
+        the serializer methods of the same names
+        """
+        return {
+            "create": NoteSerializer(many=True, required=False),
+            "update": NoteUpdateSerializer(many=True, required=False),
+            "delete": serializers.ListField(
+                child=serializers.IntegerField(), required=False
+            ),
+        }
+
+    def validate(self, attrs):
+        """limit the batch size"""
+        size = sum(len(attrs.get(key, [])) for key in ("create", "update", "delete"))
+        if size > settings.NOTES_BULK_MAX_ITEMS:
+            raise serializers.ValidationError(
+                f"At most {settings.NOTES_BULK_MAX_ITEMS} changes per request"
+            )
+        return attrs
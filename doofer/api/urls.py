@@ -1,8 +1,11 @@
-from django.urls import path
+from django.urls import path, re_path
 from . import views
 
 urlpatterns = [
     path("", views.get_notes),
     path("note/<int:id_>/", views.note_detail),
+    path("note/<int:id_>/related/", views.note_related),
     path("note/new/", views.note_create),
+    path("note/bulk/", views.notes_bulk),
+    re_path(r"^notes\.(?P<extension>csv|jsonl\.gz)$", views.export_notes),
 ]
@@ -2,70 +2,163 @@
 
 # pylint: disable=no-member
 
+import json
+
+from adrf.decorators import api_view
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import StreamingHttpResponse
 from rest_framework.response import Response
-from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.utils.urls import replace_query_param
+from rest_framework.authentication import SessionAuthentication, TokenAuthentication
+from rest_framework.decorators import authentication_classes, permission_classes
+from rest_framework.permissions import IsAuthenticated
 from rest_framework.authtoken.models import Token
 
-from rest_framework.decorators import api_view
 from django.contrib.auth import authenticate, login, logout
 
-from doofer.api.serializers import NoteSerializer
+from doofer.api.serializers import BulkNoteSerializer, NoteSerializer
+from doofer.backup import export_csv, export_jsonl_gz
+from doofer.bulk import apply_changes
+from doofer.conditional import conditional, note_validators, user_notes_validators
 from doofer.models import Note
+from doofer.pagination import ORDERING, apage, page_size, user_notes
+from doofer.related import get_related_notes
+
+# note fields of the API's NoteSerializer, related notes are prefetched
+API_FIELDS = ("id", "title", "comment", "url")
+
+
+async def serialized(serializer):
+    """a serializer's data, rendered on the ORM thread as it may query"""
+    return await sync_to_async(lambda: serializer.data)()
+
+
+async def stream_json(notes):
+    """the notes as a JSON array, written as they are read from the database"""
+    yield b"["
+    separator = b""
+    async for note in notes.aiterator(chunk_size=settings.NOTES_STREAM_CHUNK_SIZE):
+        data = NoteSerializer(note).data
+        yield separator + json.dumps(data, cls=JSONEncoder).encode()
+        separator = b","
+    yield b"]"
+
+
+async def note_list_response(request, notes):
+    """Respond with a page of notes, newest first
+    ?page_size= -- notes per page, NOTES_PAGE_SIZE by default
+    ?cursor= -- from the 'next' link of the page before
+    ?stream=true -- every note in one JSON array instead, sent as it is read
+    """
+    notes = notes.prefetch_related("related")
+    if request.query_params.get("stream") in ("1", "true"):
+        return StreamingHttpResponse(
+            stream_json(notes.order_by(*ORDERING)), content_type="application/json"
+        )
+    try:
+        size = page_size(request.query_params.get("page_size"))
+        page, cursor = await apage(notes, request.query_params.get("cursor"), size)
+    except ValueError as error:
+        return Response({"detail": str(error)}, status=400)
+    next_url = None
+    if cursor is not None:
+        next_url = replace_query_param(request.build_absolute_uri(), "cursor", cursor)
+    results = await serialized(NoteSerializer(page, many=True))
+    return Response({"next": next_url, "results": results}, status=200)
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+@conditional(user_notes_validators)
+async def get_notes(request):
+    """Get the current user's notes, a page at a time or streamed"""
+    notes = user_notes(request.user.id, API_FIELDS)
+    return await note_list_response(request, notes)
+
+
+# the streams and content types of the export formats
+EXPORTS = {
+    "csv": (export_csv, "text/csv"),
+    "jsonl.gz": (export_jsonl_gz, "application/gzip"),
+}
 
 
 @api_view(["GET"])
+@authentication_classes([SessionAuthentication, TokenAuthentication])
 @permission_classes([IsAuthenticated])
-def get_notes(request):
-    """Get all notes for current user"""
-    notes = Note.objects.filter(user=request.user.id)
-    serializer = NoteSerializer(notes, many=True)
-    return Response(serializer.data, status=200)
+async def export_notes(request, extension):
+    """Download the current user's notes, oldest first
+    notes.csv -- a backup file the profile page can import
+    notes.jsonl.gz -- a JSON object per line, gzipped
+    The profile page links here, so a browser's login session is accepted too.
+    """
+    stream, content_type = EXPORTS[extension]
+    # read from the (user, created_at, id) index
+    notes = Note.objects.filter(user=request.user.id).order_by("created_at", "id")
+    response = StreamingHttpResponse(stream(notes), content_type=content_type)
+    response["Content-Disposition"] = f'attachment; filename="notes.{extension}"'
+    return response
 
 
 @api_view(["GET", "PUT", "DELETE"])
 @permission_classes([IsAuthenticated])
-def note_detail(request, id_):
+@conditional(note_validators)
+async def note_detail(request, id_):
     """Get or update a note"""
 
     try:
-        note = Note.objects.get(id=id_)
+        note = await Note.objects.aget(id=id_, user=request.user.id)
     except Note.DoesNotExist:
         return Response(status=404)
     if request.method == "DELETE":
-        note.delete()
+        await note.adelete()
         return Response(status=204)
     if request.method == "GET":
         serializer = NoteSerializer(note)
-        return Response(serializer.data)
+        return Response(await serialized(serializer))
     # it's a PUT request
     serialiser = NoteSerializer(note, data=request.data)
-    if serialiser.is_valid():
-        serialiser.save()
-        return Response(serialiser.data, status=200)
+    if await sync_to_async(serialiser.is_valid)():
+        await sync_to_async(serialiser.save)()
+        return Response(await serialized(serialiser), status=200)
     return Response(serialiser.errors, status=400)
 
 
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+async def note_related(request, id_):
+    """Get the notes most similar to a note, best first"""
+    related = await sync_to_async(get_related_notes)(id_, request.user.id)
+    return Response([{"id": int(note.id), "title": note.title} for note in related])
+
+
 @api_view(["POST"])
 @permission_classes([IsAuthenticated])
-def note_create(request):
+async def note_create(request):
     """create note"""
     serialiser = NoteSerializer(data=request.data)
-    if serialiser.is_valid():
-        serialiser.save()
-        return Response(serialiser.data, status=201)
+    if await sync_to_async(serialiser.is_valid)():
+        # saving the note queues its embedding job for this user
+        await sync_to_async(serialiser.save)(user=request.user.id)
+        return Response(await serialized(serialiser), status=201)
     return Response(serialiser.errors, status=400)
 
 
-@api_view(["GET"])
-@permission_classes([AllowAny])
-def get_all(request):
-    """Get all notes for current user"""
-    # TODO: remove this debug code
-    print(request.path)
-    for key, value in request.headers.items():
-        print(f"{key}: {value}")
-
-    notes = Note.objects.all()
-    serializer = NoteSerializer(notes, many=True)
-    return Response(serializer.data)
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+async def notes_bulk(request):
+    """Create, update and delete many notes in one request
+    {"create": [note, ...], "update": [note with id, ...], "delete": [id, ...]}
+    An invalid batch is rejected whole with the errors of each item. A valid
+    one is applied in one transaction and each item gets a result, a 404
+    for notes that don't exist.
+    """
+    serialiser = BulkNoteSerializer(data=request.data)
+    if not await sync_to_async(serialiser.is_valid)():
+        return Response(serialiser.errors, status=400)
+    results = await sync_to_async(apply_changes)(
+        request.user.id, **serialiser.validated_data
+    )
+    return Response(results, status=200)
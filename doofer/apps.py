@@ -0,0 +1,11 @@
+from django.apps import AppConfig
+
+
+class DooferConfig(AppConfig):
+    """App config, connects the signal handlers and registers job handlers"""
+
+    name = "doofer"
+
+    def ready(self):
+        # pylint: disable=import-outside-toplevel,unused-import
+        from doofer import signals, tasks  # noqa: F401
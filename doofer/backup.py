@@ -0,0 +1,254 @@
+""" Backup files: the CSV layout, a streaming exporter and a batched importer
+
+Exports are written as the notes are read from a server-side cursor, so
+they start at once and use the same memory for any number of notes. An
+upload is stored as chunks in the database and imported by the worker.
+The importer decodes the chunks as it reads them and parses rows as they
+complete, so memory use doesn't grow with the file. Comments are converted
+to Markdown in a process pool and each batch of notes is inserted, and its
+progress recorded, in one transaction. A retried import carries on after
+the rows it already committed.
+"""
+
+# pylint: disable=no-member
+
+import codecs
+import csv
+import io
+import json
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime
+from datetime import timezone as dt_timezone
+from itertools import islice
+from typing import Iterable, Iterator, NamedTuple
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import F, QuerySet
+from django.utils import timezone
+from markdownify import markdownify  # type: ignore[import-untyped]
+
+from doofer.jobs import MAX_ATTEMPTS, enqueue
+from doofer.models import ImportChunk, Job, Note, NoteImport
+
+# column IDs for backup CSV upload
+BACKUP_ID = 0
+BACKUP_TITLE = 1
+BACKUP_COMMENT = 2
+BACKUP_SNIPPET = 3
+BACKUP_URL = 4
+BACKUP_CREATED = 5
+BACKUP_COLUMNS = 6
+# eg '2023-06-16  18:14:17.000', with two spaces
+CREATED_FORMAT = "%Y-%m-%d  %H:%M:%S.%f"
+
+# bytes per stored chunk of an upload
+UPLOAD_CHUNK_SIZE = 256 * 1024
+# comments sent to a pool process at a time
+CONVERT_CHUNK_SIZE = 64
+# header of an exported backup file, in BACKUP_* column order
+BACKUP_HEADER = ["id", "title", "comment", "snippet", "url", "created"]
+# note fields in an exported JSON-lines file
+EXPORT_FIELDS = ("id", "title", "comment", "url", "created_at", "updated_at")
+# bytes of an export gathered before they are sent
+EXPORT_FLUSH_SIZE = 64 * 1024
+
+
+class BackupRow(NamedTuple):
+    """the fields of a note read from a backup row, comment still HTML"""
+
+    title: str
+    comment: str
+    url: str
+    created_at: datetime | None
+
+
+def backup_row(note: dict) -> list:
+    """Export a note as a backup row, from its EXPORT_FIELDS values and
+    comment_html. Comments are stored as HTML, as the importer converts them
+    to Markdown.
+    """
+    created = note["created_at"].astimezone(dt_timezone.utc).strftime(CREATED_FORMAT)
+    return [
+        note["id"],
+        note["title"],
+        note["comment_html"],
+        "",
+        note["url"],
+        created,
+    ]
+
+
+async def export_csv(notes: QuerySet):
+    """a backup file of some notes, in chunks of bytes as they are read"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(BACKUP_HEADER)
+    values = notes.values(*EXPORT_FIELDS, "comment_html")
+    async for note in values.aiterator(chunk_size=settings.NOTES_STREAM_CHUNK_SIZE):
+        writer.writerow(backup_row(note))
+        if buffer.tell() >= EXPORT_FLUSH_SIZE:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+async def export_jsonl_gz(notes: QuerySet):
+    """some notes as gzipped JSON lines, in chunks of bytes as they are read"""
+    # wbits 31 writes a gzip header and trailer
+    compressor = zlib.compressobj(wbits=31)
+    values = notes.values(*EXPORT_FIELDS)
+    async for note in values.aiterator(chunk_size=settings.NOTES_STREAM_CHUNK_SIZE):
+        line = json.dumps(note, cls=DjangoJSONEncoder) + "\n"
+        compressed = compressor.compress(line.encode())
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def start_import(uid, upload, chunk_size: int = UPLOAD_CHUNK_SIZE) -> NoteImport:
+    """save an uploaded backup file, a chunk at a time, and queue its import"""
+    with transaction.atomic():
+        note_import = NoteImport.objects.create(user=uid, name=upload.name[:255])
+        # read() rather than chunks(), which yields in-memory uploads whole
+        upload.seek(0)
+        pieces = iter(lambda: upload.read(chunk_size), b"")
+        for seq, data in enumerate(pieces):
+            ImportChunk.objects.create(note_import=note_import, seq=seq, data=data)
+        enqueue("import_notes", note_import=note_import.pk)
+    return note_import
+
+
+def read_chunks(note_import: NoteImport) -> Iterator[bytes]:
+    """the stored bytes of an upload, in order, a few chunks in memory at a time"""
+    chunks = ImportChunk.objects.filter(note_import=note_import).order_by("seq")
+    for data in chunks.values_list("data", flat=True).iterator(chunk_size=4):
+        yield bytes(data)
+
+
+def text_lines(chunks: Iterable[bytes]) -> Iterator[str]:
+    """Decode UTF-8 chunks into lines, each with its line ending
+    A character or a line split between chunks comes out whole. A byte order
+    mark at the start is dropped.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    for data in chunks:
+        pending += decoder.decode(data)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line + "\n"
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+def backup_rows(chunks: Iterable[bytes]) -> Iterator[list[str]]:
+    """the rows of a backup CSV file, without its header"""
+    rows = csv.reader(text_lines(chunks), delimiter=",", quotechar='"')
+    next(rows, None)
+    return rows
+
+
+def parse_row(column: list[str]) -> BackupRow:
+    """the note fields of a row, ValueError or IndexError if it isn't valid"""
+    if len(column) < BACKUP_COLUMNS:
+        raise IndexError("missing columns")
+    comment = column[BACKUP_COMMENT]
+    if column[BACKUP_SNIPPET]:
+        comment += "From page:"
+        comment += "<br/>"
+        comment += column[BACKUP_SNIPPET]
+    created_at = None
+    # ignore "null" or '' values
+    if len(column[BACKUP_CREATED]) > 5:
+        created_at = timezone.make_aware(
+            datetime.strptime(column[BACKUP_CREATED], CREATED_FORMAT)
+        )
+    return BackupRow(column[BACKUP_TITLE], comment, column[BACKUP_URL], created_at)
+
+
+def process_pool():
+    """a pool for the Markdown conversion, or none for IMPORT_PROCESSES < 2"""
+    if settings.IMPORT_PROCESSES < 2:
+        return nullcontext(None)
+    return ProcessPoolExecutor(settings.IMPORT_PROCESSES)
+
+
+def convert_comments(pool, comments: list[str]) -> list[str]:
+    """html comments convert into markdown, in parallel if there is a pool"""
+    if pool is None:
+        return [markdownify(comment) for comment in comments]
+    return list(pool.map(markdownify, comments, chunksize=CONVERT_CHUNK_SIZE))
+
+
+def import_batch(note_import: NoteImport, batch: list[list[str]], pool) -> None:
+    """insert the notes of a batch of rows and record the progress"""
+    parsed = []
+    for column in batch:
+        try:
+            parsed.append(parse_row(column))
+        except (ValueError, IndexError) as error:
+            print(f"Error importing a row of {note_import.name}: {error}")
+    comments = convert_comments(pool, [row.comment for row in parsed])
+    notes = [
+        Note(user=note_import.user, title=row.title, comment=comment, url=row.url)
+        for row, comment in zip(parsed, comments)
+    ]
+    # bulk_create doesn't call save(), which renders the html
+    for note in notes:
+        note.render()
+    with transaction.atomic():
+        Note.objects.bulk_create(notes)
+        # created_at is set on insert, put back the dates from the file
+        dated = []
+        for note, row in zip(notes, parsed):
+            if row.created_at:
+                note.created_at = row.created_at
+                dated.append(note)
+        Note.objects.bulk_update(dated, ["created_at"])
+        NoteImport.objects.filter(pk=note_import.pk).update(
+            rows=F("rows") + len(batch),
+            imported=F("imported") + len(notes),
+            failed=F("failed") + len(batch) - len(notes),
+            updated_at=timezone.now(),
+        )
+
+
+def import_notes(import_id: int) -> int:
+    """Import a stored backup file into its owner's notes
+    Notes are inserted without signals, the caller queues their embeddings.
+    Returns the user the notes belong to
+    """
+    note_import = NoteImport.objects.get(id=import_id)
+    if note_import.is_finished():
+        return note_import.user
+    NoteImport.objects.filter(id=import_id).update(status=Job.RUNNING)
+    # rows committed by an earlier attempt are skipped
+    rows = islice(backup_rows(read_chunks(note_import)), note_import.rows, None)
+    try:
+        with process_pool() as pool:
+            while batch := list(islice(rows, settings.IMPORT_BATCH_SIZE)):
+                import_batch(note_import, batch, pool)
+    except Exception as error:
+        # the job is retried, unless this was its last attempt
+        last_attempt = Job.objects.filter(
+            kind="import_notes",
+            payload={"note_import": import_id},
+            attempts__gte=MAX_ATTEMPTS,
+        ).exists()
+        status = Job.FAILED if last_attempt else Job.PENDING
+        NoteImport.objects.filter(id=import_id).update(
+            status=status, error=repr(error)
+        )
+        raise
+    with transaction.atomic():
+        NoteImport.objects.filter(id=import_id).update(status=Job.DONE, error="")
+        ImportChunk.objects.filter(note_import=note_import).delete()
+    note_import.refresh_from_db()
+    print(f"Imported {note_import.imported} out of {note_import.rows} items")
+    return note_import.user
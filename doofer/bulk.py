@@ -0,0 +1,112 @@
+""" Create, update and delete many notes in one transaction
+
+A batch is written with bulk_create, bulk_update and one delete query,
+with the per-note signal receivers suspended. The follow-up work they
+would queue for each note, embedding and the related notes graph, is
+queued once for the batch instead. Search indexes notice the changes
+through their stamps.
+"""
+
+# pylint: disable=no-member
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from doofer import signals
+from doofer.jobs import enqueue
+from doofer.models import Note, RelatedNote
+from doofer.tasks import enqueue_embedding, enqueue_related
+
+# fields a bulk request may write
+EDITABLE_FIELDS = ("title", "comment", "url")
+
+
+def apply_changes(uid: int, create=(), update=(), delete=()) -> dict[str, list[dict]]:
+    """Apply a validated batch of changes to a user's notes
+    create -- field values of new notes
+    update -- field values of existing notes, each with its id
+    delete -- ids of notes to delete
+    Notes that aren't the user's are reported as not found, everything else
+    is written in one transaction.
+    Returns a result per item, in request order: {"id", "status"}
+    """
+    with transaction.atomic(), signals.suspended():
+        results = {
+            "create": create_notes(uid, create),
+            "update": update_notes(uid, update),
+            "delete": delete_notes(uid, delete),
+        }
+        if results["create"] or any(r["status"] == 200 for r in results["update"]):
+            # one job embeds every note the batch left without embeddings
+            enqueue_embedding(uid)
+        if any(results.values()):
+            enqueue_related(uid)
+            if settings.ANN_MIN_NOTES:
+                enqueue("ann_sync", unique=True, user=uid)
+    return results
+
+
+def create_notes(uid: int, items) -> list[dict]:
+    """insert new notes, with the ids they were given"""
+    notes = [
+        Note(
+            user=uid,
+            **{field: item[field] for field in EDITABLE_FIELDS if field in item},
+        )
+        for item in items
+    ]
+    for note in notes:
+        note.render()
+    Note.objects.bulk_create(notes)
+    return [{"id": note.id, "status": 201} for note in notes]
+
+
+def update_notes(uid: int, items) -> list[dict]:
+    """write changed fields, clearing embeddings whose text changed
+    and rendering comments and urls again"""
+    ids = [item["id"] for item in items]
+    notes = Note.objects.filter(user=uid).in_bulk(ids)
+    now = timezone.now()
+    fields = {"updated_at"}
+    for item in items:
+        note = notes.get(item["id"])
+        if note is None:
+            continue
+        rendered = False
+        for field in EDITABLE_FIELDS:
+            if field in item and item[field] != getattr(note, field):
+                setattr(note, field, item[field])
+                fields.add(field)
+                embedding = Note.EMBEDDED_FIELDS.get(field)
+                if embedding:
+                    setattr(note, embedding, b"")
+                    setattr(note, f"{embedding}_norm", None)
+                    fields |= {embedding, f"{embedding}_norm"}
+                if field in Note.RENDERED_FIELDS:
+                    fields.update(Note.RENDERED_FIELDS[field])
+                    rendered = True
+        if rendered:
+            note.render()
+        note.updated_at = now
+    Note.objects.bulk_update(notes.values(), sorted(fields))
+    return [
+        {"id": note_id, "status": 200 if note_id in notes else 404} for note_id in ids
+    ]
+
+
+def delete_notes(uid: int, ids) -> list[dict]:
+    """delete notes, queueing new related notes for the notes that listed them"""
+    found = set(Note.objects.filter(user=uid, id__in=ids).values_list("id", flat=True))
+    listed_by = (
+        RelatedNote.objects.filter(to_note__in=found)
+        .exclude(from_note__in=found)
+        .values_list("from_note_id", flat=True)
+    )
+    notes = sorted(set(listed_by))
+    if notes:
+        enqueue("refresh_related", user=uid, notes=notes)
+    Note.objects.filter(id__in=found).delete()
+    return [
+        {"id": note_id, "status": 204 if note_id in found else 404} for note_id in ids
+    ]
@@ -0,0 +1,71 @@
+""" A circuit breaker for calls to a service that may be down """
+
+import time
+from threading import Lock
+
+
+class CircuitBreaker:
+    """Fail fast while a service keeps failing
+    After 'failures' errors in a row the breaker opens and allow() refuses
+    calls. Once 'reset_timeout' seconds have passed it half-opens and lets
+    one probe call through: success closes it, failure opens it again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failures: int = 5, reset_timeout: float = 30.0, clock=None):
+        self.max_failures = failures
+        self.reset_timeout = reset_timeout
+        self._clock = clock or time.monotonic
+        self._lock = Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+
+    @property
+    def state(self) -> str:
+        """closed, open or half-open"""
+        with self._lock:
+            return self._state
+
+    def is_open(self) -> bool:
+        """true if calls would be refused, without claiming a probe"""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return False
+            return self._clock() - self._opened_at < self.reset_timeout
+
+    def allow(self) -> bool:
+        """true if a call may go ahead, which must then be recorded"""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            # the open breaker, or a probe never heard back from, times out
+            if self._clock() - self._opened_at >= self.reset_timeout:
+                # this call is the probe, the rest wait for its result
+                self._state = self.HALF_OPEN
+                self._opened_at = self._clock()
+                return True
+            return False
+
+    def record_success(self) -> None:
+        """a call worked, close the breaker"""
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self) -> None:
+        """a call failed, open the breaker if that was one too many"""
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.max_failures:
+                if self._state != self.OPEN:
+                    print(f"Circuit breaker open after {self._failures} failures")
+                self._state = self.OPEN
+                self._opened_at = self._clock()
+
+    def reset(self) -> None:
+        """close the breaker and forget past failures"""
+        self.record_success()
@@ -0,0 +1,128 @@
+""" Conditional GET: ETag and Last-Modified validators for notes
+
+Validators come from one aggregate query, without loading any notes, so a
+client polling for changes gets a 304 Not Modified for the cost of that
+query. A list's ETag covers the number of notes as well as their latest
+change, so deleting a note changes it. Deleting leaves the latest change
+of what is left as it was, so lists have no Last-Modified and clients
+polling them have to send If-None-Match.
+"""
+
+# pylint: disable=no-member
+
+import hashlib
+from datetime import datetime
+from functools import wraps
+from inspect import iscoroutinefunction
+
+from asgiref.sync import sync_to_async
+from django.db.models import Count, Max, QuerySet
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from doofer.models import Note
+
+Validators = tuple[str | None, datetime | None]
+
+
+def make_etag(*parts) -> str:
+    """a weak ETag from the values the response depends on"""
+    digest = hashlib.sha256(repr(parts).encode()).hexdigest()[:32]
+    return f'W/"{digest}"'
+
+
+def latest(*times: datetime | None) -> datetime | None:
+    """the latest of some times, None if there are none"""
+    return max((time for time in times if time is not None), default=None)
+
+
+def request_variant(request) -> tuple:
+    """what else a response depends on: who asks, how, and the query string
+    Pages carry the CSRF token, which changes when the session does on login,
+    so a browser's session is part of it. Token clients have none.
+    """
+    session = getattr(request, "session", None)
+    return (
+        request.user.pk,
+        request.META.get("QUERY_STRING", ""),
+        request.META.get("HTTP_ACCEPT", ""),
+        getattr(session, "session_key", None) or "",
+    )
+
+
+def list_validators(request, notes: QuerySet) -> Validators:
+    """validators of a response listing some notes, an ETag only"""
+    stamp = notes.aggregate(
+        count=Count("id"),
+        updated_at=Max("updated_at"),
+        related_updated_at=Max("related_updated_at"),
+    )
+    modified = latest(stamp["updated_at"], stamp["related_updated_at"])
+    return make_etag(request_variant(request), stamp["count"], modified), None
+
+
+def user_notes_validators(request) -> Validators:
+    """validators of a response listing the current user's notes"""
+    return list_validators(request, Note.objects.filter(user=request.user.pk))
+
+
+def note_validators(request, id_) -> Validators:
+    """validators of a response showing one of the current user's notes,
+    None if they have no such note"""
+    times = (
+        Note.objects.filter(id=id_, user=request.user.pk)
+        .values_list("updated_at", "related_updated_at")
+        .first()
+    )
+    if times is None:
+        return None, None
+    modified = latest(*times)
+    return make_etag(request_variant(request), id_, modified), modified
+
+
+def conditional(validators):
+    """Answer conditional GETs with 304 Not Modified, and add validators
+    validators -- called with the view's arguments, returns (etag,
+        last modified), read on the ORM thread for async views
+    Like django.views.decorators.http.condition, for async views too.
+    """
+
+    def respond(request, etag, modified):
+        timestamp = int(modified.timestamp()) if modified else None
+        return get_conditional_response(request, etag=etag, last_modified=timestamp)
+
+    def add_headers(request, response, etag, modified):
+        # 304s carry the validators too, errors don't
+        if request.method in ("GET", "HEAD") and response.status_code < 400:
+            if modified and not response.has_header("Last-Modified"):
+                response.headers["Last-Modified"] = http_date(modified.timestamp())
+            if etag:
+                response.headers.setdefault("ETag", etag)
+        return response
+
+    def decorator(func):
+        if iscoroutinefunction(func):
+
+            @wraps(func)
+            async def inner(request, *args, **kwargs):
+                etag, modified = await sync_to_async(validators)(
+                    request, *args, **kwargs
+                )
+                response = respond(request, etag, modified)
+                if response is None:
+                    response = await func(request, *args, **kwargs)
+                return add_headers(request, response, etag, modified)
+
+        else:
+
+            @wraps(func)
+            def inner(request, *args, **kwargs):
+                etag, modified = validators(request, *args, **kwargs)
+                response = respond(request, etag, modified)
+                if response is None:
+                    response = func(request, *args, **kwargs)
+                return add_headers(request, response, etag, modified)
+
+        return inner
+
+    return decorator
@@ -1,22 +1,13 @@
-import csv
-from datetime import datetime
-import io
 from django import forms
 from django.shortcuts import render, redirect
 from django.contrib import messages
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import User
-from doofer.models import Note
-from markdownify import markdownify  # type: ignore[import-untyped]
+from doofer.backup import start_import
+from doofer.models import NoteImport
 
-
-# column IDs for backup CSV upload
-BACKUP_ID = 0
-BACKUP_TITLE = 1
-BACKUP_COMMENT = 2
-BACKUP_SNIPPET = 3
-BACKUP_URL = 4
-BACKUP_CREATED = 5
+# imports listed on the profile page
+RECENT_IMPORTS = 5
 
 
 class LoginForm(forms.Form):
@@ -94,66 +85,33 @@ def profile(request):
     message = ""
     if request.user.is_authenticated and request.method == "POST":
         form = UploadFileForm(request.POST, request.FILES)
-        if form.is_valid():
-            success_count, lines_count = handle_uploaded_file(request)
-            message = f"{success_count} out of {lines_count} items imported"
-        else:
+        if not form.is_valid():
             message = "Error processing file"
+        elif not request.FILES["backup_file"].name.endswith(".csv"):
+            message = "THIS IS NOT A CSV FILE"
+        else:
+            # the worker imports the file, progress is shown below the form
+            note_import = start_import(request.user.pk, request.FILES["backup_file"])
+            message = f"Importing {note_import.name}"
     else:
         form = UploadFileForm()
-    return render(request, "auth/profile.html", {"form": form, "message": message})
-
-
-def handle_uploaded_file(request):
-    # https://simathapa111.medium.com/how-to-upload-a-csv-file-in-django-3a0d6295f624
-    f = request.FILES["backup_file"]
-    # let's check if it is a csv file
-    if not f.name.endswith(".csv"):
-        return "THIS IS NOT A CSV FILE"
-    data_set = f.read().decode("UTF-8")
-
-    # setup a stream which is when we loop through each line we are able to handle a data in a stream
-    io_string = io.StringIO(data_set)
-
-    # skip the titles
-    next(io_string)
-
-    lines_count = 0
-    success_count = 0
-    # loop through each line and create a note
-    for column in csv.reader(io_string, delimiter=",", quotechar='"'):
-        lines_count += 1
-        try:
-            note: Note = Note()
-            note.title = column[BACKUP_TITLE]
-
-            # html comments convert into markdown
-            comment = column[BACKUP_COMMENT]
-            if column[BACKUP_SNIPPET]:
-                comment += "From page:"
-                comment += "<br/>"
-                comment += column[BACKUP_SNIPPET]
-            comment = markdownify(comment)
-            note.comment = comment
-
-            note.url = column[BACKUP_URL]
-            # convert string of format '16/06/2023  18:14:17' to datetime
-            if len(column[BACKUP_CREATED]) > 5:
-                # ignore "null" or '' values
-                created = datetime.strptime(
-                    column[BACKUP_CREATED], "%Y-%m-%d  %H:%M:%S.%f"
-                )
-                note.created_at = created
-
-            user_id = request.user.pk
-            note.user = user_id
-            note.save()
-            print(f"Note {note.title} imported")
-            success_count += 1
-        except (ValueError, IndexError) as e:
-            if len(column) < 6:
-                print("Error: missing columns")
-            else:
-                print(f"Error importing {column[BACKUP_TITLE]}")
-    print(f"Imported {success_count} out of {lines_count} items")
-    return success_count, lines_count
+    context = {"form": form, "message": message}
+    context.update(imports_context(request))
+    return render(request, "auth/profile.html", context)
+
+
+def imports_context(request) -> dict:
+    """the user's recent imports, and whether any is still running"""
+    imports = []
+    if request.user.is_authenticated:
+        recent = NoteImport.objects.filter(user=request.user.pk)
+        imports = list(recent.order_by("-created_at")[:RECENT_IMPORTS])
+    return {
+        "imports": imports,
+        "importing": any(not note_import.is_finished() for note_import in imports),
+    }
+
+
+def import_progress(request):
+    """the progress of recent imports, polled while one is running"""
+    return render(request, "auth/import_progress.html", imports_context(request))
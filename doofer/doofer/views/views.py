@@ -2,13 +2,19 @@
 
 # pylint: disable=no-member
 
+from asgiref.sync import sync_to_async
 from django.forms import ModelForm
+from django.http import HttpResponseBadRequest
 from django.shortcuts import redirect, render
 
+from doofer.conditional import conditional, user_notes_validators
 from doofer.models import Note
-from doofer.search import do_text_search
+from doofer.pagination import page, page_size, user_notes
+from doofer.related import get_related_notes
+from doofer.search import ado_text_search, aload_result_notes
 
 
+@conditional(user_notes_validators)
 def index(request):
     """Home page view"""
     context = {
@@ -16,9 +22,15 @@ def index(request):
     }
     if request.method == "POST":
         return render(request, "partial.html", context)
-    # set notes to all notes belonging to the current user
-    notes = Note.objects.filter(user=request.user.pk)
+    # a page of the current user's notes, newest first
+    try:
+        size = page_size(request.GET.get("page_size"))
+        notes, cursor = page(user_notes(request.user.pk), request.GET.get("cursor"), size)
+    except ValueError as error:
+        return HttpResponseBadRequest(str(error))
     context["notes"] = notes
+    context["next_cursor"] = cursor
+    context["older_page"] = bool(request.GET.get("cursor"))
     return render(request, "notes/note_list.html", context)
 
 
@@ -32,6 +44,12 @@ def note_details(request, id_):
     return render(request, "notes/note_details.html", context)
 
 
+def note_related(request, id_):
+    """Related notes partial view"""
+    context = {"related": get_related_notes(id_, request.user.pk)}
+    return render(request, "notes/related_notes.html", context)
+
+
 class NoteForm(ModelForm):
     """Form for editing a note"""
 
@@ -62,21 +80,24 @@ def note_edit(request, id_):
     return render(request, "notes/note_edit.html", context)
 
 
-def search(request):
-    """endpoint for the search"""
+async def search(request):
+    """endpoint for the search, waiting on the embedding API without a thread"""
     if request.method != "POST":
         raise ValueError("Invalid request method")
     print("search endpoint")
     query = request.POST.get("search")
     if not query:
         return redirect("index")
+    user = await request.auser()
     # case insensitive search
-    notes = do_text_search(query, uid=request.user.pk)
+    results = await ado_text_search(query, uid=user.pk)
+    notes = await aload_result_notes(results, user.pk)
     context = {
         "title": "Search results",
         "notes": notes,
         "search_term": query,
+        "degraded": results.degraded,
     }
-    payload = render(request, "notes/note_list.html", context)
+    payload = await sync_to_async(render)(request, "notes/note_list.html", context)
     print("rendered search results")
     return payload
@@ -0,0 +1,153 @@
+""" Embedding backends, chosen with the EMBEDDING_BACKEND setting """
+
+import asyncio
+import hashlib
+import re
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from doofer.hf_model import (
+    HF_MODEL,
+    get_hf_embeddings,
+    get_hf_embeddings_async,
+    get_hf_embeddings_batch,
+)
+
+# short names accepted by EMBEDDING_BACKEND, a dotted path also works
+BACKENDS = {
+    "huggingface": "doofer.embedding_backends.HuggingFaceAPIBackend",
+    "local": "doofer.embedding_backends.LocalBackend",
+    "hashing": "doofer.embedding_backends.HashingBackend",
+}
+
+# runs embed() for the default aembed(), a caller that stops waiting
+# leaves the call to finish here on its own
+_aembed_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="aembed")
+
+
+class EmbeddingBackend(ABC):
+    """Base class for a way of turning text into a vector"""
+
+    model_name: str = HF_MODEL
+    dims: int = 384
+
+    @abstractmethod
+    def embed(self, text: str, deadline: float | None = None) -> list[float]:
+        """get the embeddings for a text
+        deadline -- time.monotonic() by which a slow backend should give up
+        """
+
+    def embed_batch(self, texts: list[str]) -> list[list[float]]:
+        """get the embeddings for several texts, in order"""
+        return [self.embed(text) for text in texts]
+
+    async def aembed(self, text: str, deadline: float | None = None) -> list[float]:
+        """embed() for coroutines, run on a worker thread by default
+        so CPU-bound backends don't block the event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_aembed_executor, self.embed, text, deadline)
+
+
+class HuggingFaceAPIBackend(EmbeddingBackend):
+    """The hosted Hugging Face inference API"""
+
+    def embed(self, text: str, deadline: float | None = None) -> list[float]:
+        vector = get_hf_embeddings(text, deadline)
+        if not vector:
+            raise ValueError("Hugging Face API call failed")
+        return vector
+
+    async def aembed(self, text: str, deadline: float | None = None) -> list[float]:
+        # awaits the pooled async client, no thread is held while waiting
+        vector = await get_hf_embeddings_async(text, deadline)
+        if not vector:
+            raise ValueError("Hugging Face API call failed")
+        return vector
+
+    def embed_batch(self, texts: list[str]) -> list[list[float]]:
+        vectors = get_hf_embeddings_batch(texts)
+        if len(vectors) != len(texts):
+            raise ValueError("Hugging Face API returned the wrong number of vectors")
+        return vectors
+
+
+class LocalBackend(EmbeddingBackend):
+    """The same MiniLM model run in-process on the CPU
+    Needs the optional sentence-transformers package. The model is loaded
+    on first use and shared by every request in the process.
+    """
+
+    def __init__(self):
+        self._model = None
+
+    def load_model(self):
+        """load the model once"""
+        if self._model is None:
+            try:
+                # pylint: disable=import-outside-toplevel
+                from sentence_transformers import SentenceTransformer  # type: ignore
+            except ImportError as error:
+                raise ImproperlyConfigured(
+                    "The local embedding backend needs sentence-transformers"
+                ) from error
+            self._model = SentenceTransformer(
+                f"sentence-transformers/{self.model_name}", device="cpu"
+            )
+        return self._model
+
+    def embed(self, text: str, deadline: float | None = None) -> list[float]:
+        return self.load_model().encode(text).tolist()
+
+    def embed_batch(self, texts: list[str]) -> list[list[float]]:
+        if not texts:
+            return []
+        return self.load_model().encode(texts).tolist()
+
+
+class HashingBackend(EmbeddingBackend):
+    """Deterministic feature hashing of words and word pairs
+    Needs no model or network, so tests and benchmarks can run anywhere.
+    Texts sharing words get similar vectors, but there is no semantics.
+    """
+
+    model_name = "hashing-384"
+
+    def embed(self, text: str, deadline: float | None = None) -> list[float]:
+        words = re.findall(r"\w+", text.lower())
+        features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+        vector = np.zeros(self.dims)
+        for feature in features:
+            digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+            value = int.from_bytes(digest, "little")
+            sign = 1.0 if value & 1 else -1.0
+            vector[(value >> 1) % self.dims] += sign
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector.tolist()
+
+
+@lru_cache(maxsize=1)
+def get_backend() -> EmbeddingBackend:
+    """the configured embedding backend, created once per process"""
+    name = getattr(settings, "EMBEDDING_BACKEND", "huggingface")
+    try:
+        backend_class = import_string(BACKENDS.get(name, name))
+    except ImportError as error:
+        raise ImproperlyConfigured(f"Unknown EMBEDDING_BACKEND {name}") from error
+    return backend_class()
+
+
+@receiver(setting_changed)
+def reset_backend(setting, **kwargs):
+    """pick the backend up again when tests override the setting"""
+    if setting == "EMBEDDING_BACKEND":
+        get_backend.cache_clear()
@@ -0,0 +1,122 @@
+""" Content-addressed cache of computed embeddings """
+
+# pylint: disable=no-member
+
+import hashlib
+import re
+from collections import OrderedDict
+from threading import Lock
+
+from doofer.models import EmbeddingCacheEntry, pack_embedding, unpack_embedding
+
+# the most embeddings held in process memory
+MAX_MEMORY_ENTRIES = 4096
+# print the hit counts every this many lookups
+REPORT_EVERY = 1000
+
+
+def text_hash(text: str) -> str:
+    """hash of the text with its whitespace normalized"""
+    normalized = re.sub(r"\s+", " ", text).strip()
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+class EmbeddingCache:
+    """Embeddings keyed by (model name, text hash)
+    An in-memory LRU sits in front of the EmbeddingCacheEntry table, which
+    every worker process shares. Counts hits in each tier and misses.
+    """
+
+    def __init__(self, max_entries: int = MAX_MEMORY_ENTRIES):
+        self.max_entries = max_entries
+        self._memory: OrderedDict[tuple[str, str], list[float]] = OrderedDict()
+        self._lock = Lock()
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    def get_many(self, model_name: str, texts: list[str]) -> list[list[float] | None]:
+        """cached vectors for the texts, None where not cached"""
+        hashes = [text_hash(text) for text in texts]
+        found: dict[str, list[float]] = {}
+        with self._lock:
+            for digest in hashes:
+                vector = self._memory.get((model_name, digest))
+                if vector is not None:
+                    self._memory.move_to_end((model_name, digest))
+                    found[digest] = vector
+        memory_hits = len(found)
+
+        missing = set(hashes) - set(found)
+        if missing:
+            entries = EmbeddingCacheEntry.objects.filter(
+                model_name=model_name, text_hash__in=missing
+            ).values_list("text_hash", "embedding")
+            for digest, data in entries:
+                found[digest] = unpack_embedding(data).tolist()
+                self._remember(model_name, digest, found[digest])
+
+        with self._lock:
+            self.memory_hits += memory_hits
+            self.db_hits += len(found) - memory_hits
+            self.misses += len(missing - set(found))
+            lookups = self.memory_hits + self.db_hits + self.misses
+        if lookups // REPORT_EVERY != (lookups - len(hashes)) // REPORT_EVERY:
+            print("Embedding cache", self.stats())
+        return [found.get(digest) for digest in hashes]
+
+    def get(self, model_name: str, text: str) -> list[float] | None:
+        """the cached vector for a text, or None"""
+        return self.get_many(model_name, [text])[0]
+
+    def put_many(
+        self, model_name: str, texts: list[str], vectors: list[list[float]]
+    ) -> None:
+        """store vectors for the texts, skipping failed (empty) ones"""
+        entries = {}
+        for text, vector in zip(texts, vectors):
+            if vector:
+                digest = text_hash(text)
+                self._remember(model_name, digest, vector)
+                entries[digest] = EmbeddingCacheEntry(
+                    model_name=model_name,
+                    text_hash=digest,
+                    embedding=pack_embedding(vector),
+                )
+        if entries:
+            EmbeddingCacheEntry.objects.bulk_create(
+                entries.values(), ignore_conflicts=True
+            )
+
+    def put(self, model_name: str, text: str, vector: list[float]) -> None:
+        """store the vector for a text"""
+        self.put_many(model_name, [text], [vector])
+
+    def stats(self) -> dict[str, int | float]:
+        """hit and miss counts, and the memory tier size"""
+        lookups = self.memory_hits + self.db_hits + self.misses
+        hits = self.memory_hits + self.db_hits
+        return {
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "memory_entries": len(self._memory),
+        }
+
+    def clear(self) -> None:
+        """empty the memory tier and reset the counts"""
+        with self._lock:
+            self._memory.clear()
+            self.memory_hits = self.db_hits = self.misses = 0
+
+    def _remember(self, model_name: str, digest: str, vector: list[float]) -> None:
+        """add to the memory tier, evicting the least recently used"""
+        with self._lock:
+            self._memory[(model_name, digest)] = vector
+            self._memory.move_to_end((model_name, digest))
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+
+embedding_cache = EmbeddingCache()
@@ -1,37 +1,290 @@
 """ Routines for processing embeddings """
 
+import asyncio
 import math
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
 
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from doofer import index_cache
+from doofer.circuit_breaker import CircuitBreaker
+from doofer.embedding_backends import get_backend
+from doofer.embedding_cache import embedding_cache, text_hash
 from doofer.hf_model import get_hf_embeddings
+from doofer.jobs import enqueue
 from doofer.models import Note
+from doofer.single_flight import SingleFlight
 
 EMBEDDINGS_SIZE = 384
+# the most texts, and the most characters, sent to the backend at once
+MAX_BATCH_SIZE = 32
+MAX_BATCH_CHARS = 20000
 
 
-def get_text_embedding(text: str) -> list[float]:
-    """Get the embeddings for a given text"""
+# runs backend calls for start_text_embedding
+_embedder = ThreadPoolExecutor(max_workers=4, thread_name_prefix="embed")
+
+# stops calling a backend that keeps failing, see CircuitBreaker
+embedding_breaker = CircuitBreaker(
+    settings.EMBEDDING_BREAKER_FAILURES, settings.EMBEDDING_BREAKER_RESET
+)
+
+
+# concurrent requests to embed the same text share one backend call
+embedding_flights = SingleFlight()
+
+
+class EmbeddingUnavailable(Exception):
+    """The embeddings could not be had: the backend failed, ran out of
+    time, or is not being called while the circuit breaker is open"""
+
+
+def call_backend(call: Callable, *args):
+    """make a backend call the breaker has allowed and record how it went"""
     try:
-        vector: list[float] = get_hf_embeddings(text)
+        result = call(*args)
+    except Exception:
+        embedding_breaker.record_failure()
+        raise
+    embedding_breaker.record_success()
+    return result
+
+
+def flight_key(backend, text: str) -> tuple[str, str]:
+    """calls for the same text with the same model share one flight"""
+    return backend.model_name, text_hash(text)
+
+
+def start_text_embedding(
+    text: str, deadline: float | None = None
+) -> Callable[[], list[float]]:
+    """Start getting the embeddings for a text, so other work can go on
+    deadline -- time.monotonic() by which to give up, if any
+    Returns a function that waits for them, raising EmbeddingUnavailable on
+    failure. Only the backend call runs in another thread, the cache is read
+    and written from this one, with its database connection. A call already
+    in flight for the same text is shared rather than made again.
+    """
+    backend = get_backend()
+    cached = embedding_cache.get(backend.model_name, text)
+    if cached is not None:
+        return lambda: cached
+
+    def start() -> Future:
+        if not embedding_breaker.allow():
+            raise EmbeddingUnavailable("Embedding backend circuit breaker is open")
+        return _embedder.submit(call_backend, backend.embed, text, deadline)
+
+    try:
+        future, started = embedding_flights.submit(flight_key(backend, text), start)
+    except EmbeddingUnavailable as error:
+        refusal = error
+
+        def refused() -> list[float]:
+            raise refusal
+
+        return refused
+
+    def result() -> list[float]:
+        timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+        try:
+            vector: list[float] = future.result(timeout)
+        except TimeoutError as error:
+            raise EmbeddingUnavailable("Embedding took too long") from error
+        except Exception as error:
+            raise EmbeddingUnavailable(f"Embedding error {error!r}") from error
+        if started:
+            embedding_cache.put(backend.model_name, text, vector)
         return vector
+
+    return result
+
+
+def settle_flight(flight: Future, task: asyncio.Future) -> None:
+    """pass the outcome of an embedding task to the callers sharing it"""
+    if flight.done():
+        # the caller that started it gave up first
+        return
+    error = None if task.cancelled() else task.exception()
+    if task.cancelled() or error is not None:
+        embedding_breaker.record_failure()
+        flight.set_exception(error or EmbeddingUnavailable("Embedding cancelled"))
+    else:
+        embedding_breaker.record_success()
+        flight.set_result(task.result())
+
+
+async def aget_text_embedding(text: str, deadline: float | None = None) -> list[float]:
+    """Get the embeddings for a text from a coroutine
+    deadline -- time.monotonic() by which to give up, if any
+    The backend call is awaited rather than holding a thread, and the cache
+    is used through sync_to_async. A call in flight for the same text, from
+    a thread or a coroutine, is shared. Raises EmbeddingUnavailable on failure.
+    """
+    backend = get_backend()
+    cached = await sync_to_async(embedding_cache.get)(backend.model_name, text)
+    if cached is not None:
+        return cached
+    tasks: list[asyncio.Future] = []
+
+    def start() -> Future:
+        if not embedding_breaker.allow():
+            raise EmbeddingUnavailable("Embedding backend circuit breaker is open")
+        flight: Future = Future()
+        tasks.append(asyncio.ensure_future(backend.aembed(text, deadline)))
+        tasks[0].add_done_callback(lambda task: settle_flight(flight, task))
+        return flight
+
+    future, started = embedding_flights.submit(flight_key(backend, text), start)
+    waiter = asyncio.wrap_future(future)
+    # a caller that gave up never awaits the outcome, so read it here
+    waiter.add_done_callback(lambda done: done.cancelled() or done.exception())
+    timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+    try:
+        # shielded, so one caller timing out leaves the call to the others
+        vector = await asyncio.wait_for(asyncio.shield(waiter), timeout)
     except Exception as error:
-        print("HF API  error", {error})
+        raise EmbeddingUnavailable(f"Embedding error {error!r}") from error
+    finally:
+        if started and not future.done():
+            # the task only runs while its event loop does, so it ends with
+            # the caller that started it and whoever shares it fails too
+            embedding_breaker.record_failure()
+            future.set_exception(EmbeddingUnavailable("Embedding took too long"))
+            tasks[0].cancel()
+    if started:
+        await sync_to_async(embedding_cache.put)(backend.model_name, text, vector)
+    return vector
+
+
+def get_text_embedding(text: str) -> list[float]:
+    """Get the embeddings for a given text, from the cache if possible
+    Returns [] if they can't be had
+    """
+    try:
+        return start_text_embedding(text)()
+    except EmbeddingUnavailable as error:
+        print(error)
         return []
 
 
+def batches(texts: list[str], max_size=MAX_BATCH_SIZE, max_chars=MAX_BATCH_CHARS):
+    """split texts into consecutive batches limited by count and length
+    A single text longer than max_chars gets a batch of its own.
+    """
+    batch: list[str] = []
+    chars = 0
+    for text in texts:
+        if batch and (len(batch) >= max_size or chars + len(text) > max_chars):
+            yield batch
+            batch, chars = [], 0
+        batch.append(text)
+        chars += len(text)
+    if batch:
+        yield batch
+
+
+def get_text_embeddings(texts: list[str]) -> list[list[float]]:
+    """Get the embeddings for many texts with a few batched backend calls
+    Cached texts are not sent, and repeated texts are only sent once.
+    Returns one vector per text, empty for texts in a batch that failed
+    """
+    backend = get_backend()
+    cached = embedding_cache.get_many(backend.model_name, texts)
+    missing = list(
+        dict.fromkeys(text for text, vector in zip(texts, cached) if vector is None)
+    )
+    computed: dict[str, list[float]] = {}
+    for batch in batches(missing):
+        vectors: list[list[float]] = [[] for _ in batch]
+        if not embedding_breaker.allow():
+            print("Embedding backend circuit breaker is open")
+        else:
+            try:
+                vectors = call_backend(backend.embed_batch, batch)
+            except Exception as error:
+                print("Embedding error", {error})
+        embedding_cache.put_many(backend.model_name, batch, vectors)
+        computed.update(zip(batch, vectors))
+    return [
+        vector if vector is not None else computed[text]
+        for text, vector in zip(texts, cached)
+    ]
+
+
+def update_notes_embeddings(notes: list[Note]) -> list[Note]:
+    """calculate every missing embedding of the notes in batches
+    Changed notes are written with one bulk_update, new notes are saved.
+    Notes whose text was edited while the backend worked are not written,
+    the edit queued their embedding again.
+    """
+    # (note, setter) for each missing embedding, in the same order as texts
+    targets = []
+    texts: list[str] = []
+    for note in notes:
+        if note.title and not note.title_embedding:
+            targets.append((note, note.set_title_embeddings))
+            texts.append(note.title)
+        if note.comment and not note.content_embedding:
+            targets.append((note, note.set_content_embeddings))
+            texts.append(note.comment)
+    if not texts:
+        return notes
+
+    dirty: dict[int, Note] = {}
+    now = timezone.now()
+    for (note, setter), vector in zip(targets, get_text_embeddings(texts)):
+        setter(vector)
+        note.embedded_at = now
+        dirty[id(note)] = note
+
+    saved = [note for note in dirty.values() if note.pk is not None]
+    for note in dirty.values():
+        if note.pk is None:
+            note.save()
+    if saved:
+        fields = [
+            "title_embedding",
+            "title_embedding_norm",
+            "content_embedding",
+            "content_embedding_norm",
+            "embedded_at",
+        ]
+        with transaction.atomic():
+            saved = unchanged_notes(saved)
+            Note.objects.bulk_update(saved, fields, batch_size=500)
+    if saved:
+        # bulk_update sends no signals: update each owner's cached index
+        # once and queue one approximate index update per owner
+        index_cache.notes_saved(saved)
+        if settings.ANN_MIN_NOTES:
+            for user in sorted({note.user for note in saved}):
+                enqueue("ann_sync", unique=True, user=user)
+    print(f"updated embeddings for {len(dirty)} notes")
+    return notes
+
+
+def unchanged_notes(notes: list[Note]) -> list[Note]:
+    """the notes whose text is still as stored, locking their rows
+    until the transaction ends so an edit can't slip in before the write"""
+    rows = (
+        Note.objects.select_for_update()
+        .filter(id__in=[note.pk for note in notes])
+        .values_list("id", "title", "comment")
+    )
+    stored = {note_id: (title, comment) for note_id, title, comment in rows}
+    return [note for note in notes if stored.get(note.pk) == (note.title, note.comment)]
+
+
 def update_note_embeddings(note: Note) -> Note:
     """get the note embeddings from the db or calculate them if needed"""
-    dirty = False
-    if note.title and not note.title_embedding:
-        note.set_title_embeddings(get_text_embedding(note.title))
-        dirty = True
-    if note.comment and not note.content_embedding:
-        note.set_content_embeddings(get_text_embedding(note.comment))
-        dirty = True
-
-    if dirty:
-        print("updating note", note)
-        note.save()
-
+    update_notes_embeddings([note])
     return note
 
 
@@ -50,6 +303,13 @@ def cosine_similarity(vector1, vector2):
         return dot_product / (magnitude1 * magnitude2)
 
 
+def unit_similarity(vector1, vector2) -> float:
+    """cosine similarity of two stored, unit length, embeddings"""
+    if len(vector1) != len(vector2):
+        return 0.0
+    return float(np.dot(vector1, vector2))
+
+
 def get_note_similarity(note1: Note, note2: Note) -> float:
     """calculate the similarity between 2 notes"""
     max_similarity = 0.0
@@ -58,13 +318,11 @@ def get_note_similarity(note1: Note, note2: Note) -> float:
     update_note_embeddings(note2)
     # if there are embeddings and the search vector has embeddings
     if note1.title_embedding and note2.title_embedding:
-        title_distance: float = cosine_similarity(
-            note1.get_title_embeddings(), note2.get_title_embeddings()
-        )
+        title_distance = unit_similarity(note1.title_vector(), note2.title_vector())
+        max_similarity = max(max_similarity, title_distance)
     if note1.content_embedding and note2.content_embedding:
-
-        content_distance: float = cosine_similarity(
-            note1.get_content_embeddings(), note2.get_content_embeddings()
+        content_distance = unit_similarity(
+            note1.content_vector(), note2.content_vector()
         )
-        max_similarity = max(max_similarity, title_distance, content_distance)
+        max_similarity = max(max_similarity, content_distance)
     return max_similarity
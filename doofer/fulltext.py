@@ -0,0 +1,101 @@
+""" Ranked full-text search of note titles and comments
+
+SQLite uses an FTS5 table kept in step with doofer_note by triggers, ranked
+with bm25(). PostgreSQL uses a generated tsvector column with a GIN index,
+ranked with ts_rank(). Either way the database keeps the index in sync on
+every write, including queryset updates and writes from other processes.
+Titles weigh more than comments, and every search term matches as a prefix.
+Migration 0014 creates the index, repair() puts back SQLite triggers that
+later migrations drop.
+"""
+
+import re
+
+from django.db import connection
+
+# how much more a match in the title counts than one in the comment
+TITLE_WEIGHT = 10.0
+
+WORD = re.compile(r"\w+")
+
+SQLITE_TRIGGERS = {
+    "doofer_note_fts_insert": """
+        CREATE TRIGGER IF NOT EXISTS doofer_note_fts_insert
+        AFTER INSERT ON doofer_note BEGIN
+            INSERT INTO doofer_note_fts (rowid, title, comment)
+            VALUES (new.id, new.title, new.comment);
+        END""",
+    "doofer_note_fts_delete": """
+        CREATE TRIGGER IF NOT EXISTS doofer_note_fts_delete
+        AFTER DELETE ON doofer_note BEGIN
+            INSERT INTO doofer_note_fts (doofer_note_fts, rowid, title, comment)
+            VALUES ('delete', old.id, old.title, old.comment);
+        END""",
+    "doofer_note_fts_update": """
+        CREATE TRIGGER IF NOT EXISTS doofer_note_fts_update
+        AFTER UPDATE OF title, comment ON doofer_note BEGIN
+            INSERT INTO doofer_note_fts (doofer_note_fts, rowid, title, comment)
+            VALUES ('delete', old.id, old.title, old.comment);
+            INSERT INTO doofer_note_fts (rowid, title, comment)
+            VALUES (new.id, new.title, new.comment);
+        END""",
+}
+
+def repair(conn=connection) -> None:
+    """Put back SQLite triggers dropped by a migration
+    SQLite migrations that alter doofer_note copy it to a new table, which
+    loses its triggers, so this runs after every migrate. If any were
+    missing the index is rebuilt, as writes may have been missed.
+    """
+    if conn.vendor != "sqlite":
+        return
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table'"
+            " AND name = 'doofer_note_fts'"
+        )
+        if not cursor.fetchone():
+            return
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger'"
+            " AND name LIKE 'doofer_note_fts_%'"
+        )
+        existing = {name for (name,) in cursor.fetchall()}
+        if existing == set(SQLITE_TRIGGERS):
+            return
+        for sql in SQLITE_TRIGGERS.values():
+            cursor.execute(sql)
+        cursor.execute("INSERT INTO doofer_note_fts (doofer_note_fts) VALUES ('rebuild')")
+
+
+def search_terms(text: str) -> list[str]:
+    """the words of a search, stripped of query syntax"""
+    return WORD.findall(text.lower())
+
+
+def text_search(uid, text: str, limit: int) -> list[tuple[int, str]]:
+    """(id, title) of the user's notes matching every word, best first
+    A word matches any word it starts, eg "embed" matches "embedding".
+    """
+    terms = search_terms(text)
+    if not terms or limit <= 0:
+        return []
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute(
+                "SELECT id, title FROM doofer_note,"
+                " to_tsquery('english', %s) AS query"
+                ' WHERE "user" = %s AND search_vector @@ query'
+                " ORDER BY ts_rank(search_vector, query) DESC, id LIMIT %s",
+                [" & ".join(f"{term}:*" for term in terms), uid, limit],
+            )
+        else:
+            # bm25() is lower for better matches
+            cursor.execute(
+                "SELECT doofer_note.id, doofer_note.title FROM doofer_note_fts"
+                " JOIN doofer_note ON doofer_note.id = doofer_note_fts.rowid"
+                ' WHERE doofer_note_fts MATCH %s AND doofer_note."user" = %s'
+                " ORDER BY bm25(doofer_note_fts, %s, 1.0), doofer_note.id LIMIT %s",
+                [" ".join(f'"{term}"*' for term in terms), uid, TITLE_WEIGHT, limit],
+            )
+        return cursor.fetchall()
@@ -1,15 +1,25 @@
 """ A class to load the Hugging Face model and get embeddings for a given text """
 
-import json
+import asyncio
 import os
-from dotenv import load_dotenv
-import requests
+import random
 import time
+from threading import Lock
+from weakref import WeakKeyDictionary
+
+import httpx
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from dotenv import load_dotenv
 from decouple import config  # type: ignore [import-untyped]
 
 
 HF_MODEL = "all-MiniLM-L6-v2"
 
+# responses worth another try: rate limiting, the model loading, server errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
 
 class HFKey:
     """A singleton class to load the Hugging Face API Key"""
@@ -26,7 +36,7 @@ class HFKey:
         """load the env var"""
         if self._token is None:
             if config("IS_HEROKU", default="No") == "Yes":
-                self.token = config("API_TOKEN", default=None)
+                self._token = config("API_TOKEN", default=None)
             else:
                 load_dotenv("secrets.env")
                 self._token = os.getenv("API_TOKEN")
@@ -35,35 +45,182 @@ class HFKey:
         return self._token
 
 
-def get_hf_embeddings(text: str) -> list[float]:
-    """Get the embeddings for a given text using the Hugging Face model"""
-    model = "all-MiniLM-L6-v2"
-    api_url = f"https://api-inference.huggingface.co/pipeline/feature-extraction/sentence-transformers/{model}"
-    data = {"inputs": text, "wait_for_model": True}
-    hf_token: str = HFKey().load_model()
-    retries = 4
-    while retries > 0:
-        # call the api
-        headers = {
-            "Authorization": f"Bearer {hf_token}",
-            "pragma": "no-cache",
-            "cache-control": "no-cache",
-        }
+_client: httpx.Client | None = None
+_client_lock = Lock()
+# an async client only works on the event loop it was made on
+_async_clients: WeakKeyDictionary = WeakKeyDictionary()
 
-        try:
-            response = requests.post(api_url, headers=headers, data=json.dumps(data))
-            response.raise_for_status()  # Raise an exception for HTTP errors (e.g., 404, 500)
 
-            # Now you can work with the response data
-            if response.status_code == 200:
-                result = response.json()
-            return result
+def client_options() -> dict:
+    """the pool size and timeouts shared by the sync and async clients"""
+    pool_size = settings.EMBEDDING_HTTP_POOL_SIZE
+    return {
+        "limits": httpx.Limits(
+            max_connections=pool_size, max_keepalive_connections=pool_size
+        ),
+        "timeout": httpx.Timeout(
+            settings.EMBEDDING_HTTP_TIMEOUT,
+            connect=settings.EMBEDDING_HTTP_CONNECT_TIMEOUT,
+        ),
+    }
+
+
+def get_client() -> httpx.Client:
+    """the process-wide client, which keeps connections to the API open"""
+    global _client  # pylint: disable=global-statement
+    with _client_lock:
+        if _client is None:
+            _client = httpx.Client(**client_options())
+        return _client
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """the client shared by coroutines on the running event loop"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(**client_options())
+        _async_clients[loop] = client
+    return client
+
+
+def close_clients() -> None:
+    """close the sync client, the next call opens a new one"""
+    global _client  # pylint: disable=global-statement
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = None
+    _async_clients.clear()
+
+
+@receiver(setting_changed)
+def reset_clients(setting, **kwargs):
+    """make new clients when tests override their settings"""
+    if setting.startswith("EMBEDDING_HTTP_") or setting == "HF_API_URL":
+        close_clients()
+
+
+def backoff_delay(attempt: int) -> float:
+    """Seconds to wait after failed attempt number 'attempt', from 1
+    The limit doubles each time up to EMBEDDING_HTTP_BACKOFF_MAX, and the
+    wait is a random fraction of it, so clients failing together don't all
+    retry together.
+    """
+    limit = settings.EMBEDDING_HTTP_BACKOFF * 2 ** (attempt - 1)
+    return random.uniform(0, min(limit, settings.EMBEDDING_HTTP_BACKOFF_MAX))
+
+
+def hf_request(inputs) -> dict:
+    """the keyword arguments of a feature extraction API call"""
+    return {
+        "url": settings.HF_API_URL,
+        "headers": {"Authorization": f"Bearer {HFKey().load_model()}"},
+        "json": {"inputs": inputs, "wait_for_model": True},
+    }
+
 
-        except requests.exceptions.RequestException as e:
-            print(f"Error making API request: {e}")
+def attempt_timeout(deadline: float | None) -> httpx.Timeout | None:
+    """the timeouts of one attempt, cut short by the deadline
+    Returns None if the deadline has passed
+    """
+    read = settings.EMBEDDING_HTTP_TIMEOUT
+    connect = settings.EMBEDDING_HTTP_CONNECT_TIMEOUT
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        read, connect = min(read, remaining), min(connect, remaining)
+    return httpx.Timeout(read, connect=connect)
 
-        retries -= 1
-        # wait 5 seconds before retrying
-        time.sleep(5)
-    print("API rety limit reached. Exiting...")
+
+def retry_delay(attempt: int, deadline: float | None) -> float | None:
+    """seconds to wait before the next attempt, None if it would be too late"""
+    if attempt >= settings.EMBEDDING_HTTP_RETRIES:
+        return None
+    delay = backoff_delay(attempt)
+    if deadline is not None and time.monotonic() + delay >= deadline:
+        return None
+    return delay
+
+
+def should_retry(error: httpx.HTTPError) -> bool:
+    """true for failures that another attempt may get past"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRY_STATUSES
+    return isinstance(error, httpx.TransportError)
+
+
+def get_hf_embeddings(text: str, deadline: float | None = None) -> list[float]:
+    """Get the embeddings for a given text using the Hugging Face model
+    deadline -- time.monotonic() by which to give up, if any
+    """
+    return post_hf_inputs(text, deadline)
+
+
+def get_hf_embeddings_batch(texts: list[str]) -> list[list[float]]:
+    """Get the embeddings for several texts in one Hugging Face API call"""
+    if not texts:
+        return []
+    return post_hf_inputs(texts)
+
+
+async def get_hf_embeddings_async(
+    text: str, deadline: float | None = None
+) -> list[float]:
+    """get_hf_embeddings for coroutines, many calls share a few connections"""
+    return await post_hf_inputs_async(text, deadline)
+
+
+async def get_hf_embeddings_batch_async(texts: list[str]) -> list[list[float]]:
+    """get_hf_embeddings_batch for coroutines"""
+    if not texts:
+        return []
+    return await post_hf_inputs_async(texts)
+
+
+def post_hf_inputs(inputs, deadline: float | None = None):
+    """call the feature extraction API for a text or a list of texts
+    deadline -- time.monotonic() by which to give up, if any
+    Returns [] if every attempt failed or time ran out
+    """
+    request = hf_request(inputs)
+    attempt = 1
+    while (timeout := attempt_timeout(deadline)) is not None:
+        try:
+            response = get_client().post(**request, timeout=timeout)
+            response.raise_for_status()
+            return response.json()
+        except httpx.HTTPError as error:
+            print(f"Error making API request: {error}")
+            if not should_retry(error):
+                return []
+        delay = retry_delay(attempt, deadline)
+        if delay is None:
+            break
+        time.sleep(delay)
+        attempt += 1
+    print("API retry limit reached")
+    return []
+
+
+async def post_hf_inputs_async(inputs, deadline: float | None = None):
+    """post_hf_inputs for coroutines, waiting without blocking the loop"""
+    request = hf_request(inputs)
+    attempt = 1
+    while (timeout := attempt_timeout(deadline)) is not None:
+        try:
+            response = await get_async_client().post(**request, timeout=timeout)
+            response.raise_for_status()
+            return response.json()
+        except httpx.HTTPError as error:
+            print(f"Error making API request: {error}")
+            if not should_retry(error):
+                return []
+        delay = retry_delay(attempt, deadline)
+        if delay is None:
+            break
+        await asyncio.sleep(delay)
+        attempt += 1
+    print("API retry limit reached")
     return []
@@ -0,0 +1,237 @@
+""" Per-user in-memory cache of ready-to-score note indexes """
+
+# pylint: disable=no-member
+
+from collections import OrderedDict
+from datetime import datetime
+from threading import Lock
+from typing import NamedTuple, Sequence
+
+import numpy as np
+
+from django.db.models import Count, Max, Q
+
+from doofer.models import Note
+from doofer.similarity import (
+    NoteIndex,
+    NoteVectors,
+    embedding_dims,
+    load_note_vectors,
+    note_rows,
+)
+
+# the most users, and the most bytes of index, held at once
+MAX_CACHE_SIZE = 20
+MAX_CACHE_BYTES = 64 * 1024 * 1024
+
+
+class IndexCache:
+    """An LRU cache of NoteIndex objects keyed by user id
+    Eviction keeps both the number of users and the total size of their
+    indexes under the limits. The least recently searched user goes first.
+    """
+
+    def __init__(self, max_users: int = MAX_CACHE_SIZE, max_bytes=MAX_CACHE_BYTES):
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self._indexes: OrderedDict[str, NoteIndex] = OrderedDict()
+        # generations are only kept for cached users, everyone else is at
+        # the floor, which moves up whenever an entry is dropped
+        self._generations: dict[str, int] = {}
+        self._clock = 0
+        self._floor = 0
+        self._lock = Lock()
+
+    def get(self, uid: str) -> NoteIndex | None:
+        """get a user's index and mark it as recently used"""
+        with self._lock:
+            index = self._indexes.get(uid)
+            if index is not None:
+                self._indexes.move_to_end(uid)
+            return index
+
+    def generation(self, uid: str) -> int:
+        """a counter that changes whenever the user's notes change"""
+        with self._lock:
+            return self._generations.get(uid, self._floor)
+
+    def put(self, uid: str, index: NoteIndex, generation: int) -> None:
+        """store an index built when the user was at 'generation'
+        An index built from rows that changed while it was loading is
+        dropped, the next search will build it again.
+        """
+        with self._lock:
+            if self._generations.get(uid, self._floor) != generation:
+                return
+            self._indexes[uid] = index
+            self._generations[uid] = generation
+            self._indexes.move_to_end(uid)
+            self._evict()
+
+    def replace(self, uid: str, update) -> None:
+        """apply 'update' to a cached index, which returns the new index
+        or None to drop it from the cache"""
+        with self._lock:
+            self._clock += 1
+            index = self._indexes.get(uid)
+            if index is None:
+                # stops any build of this user's index that is under way
+                self._floor = self._clock
+                return
+            index = update(index)
+            if index is None:
+                self._drop(uid)
+            else:
+                self._indexes[uid] = index
+                self._generations[uid] = self._clock
+                self._evict()
+
+    def discard(self, uid: str) -> None:
+        """forget a user's index"""
+        self.replace(uid, lambda index: None)
+
+    def clear(self) -> None:
+        """forget every index"""
+        with self._lock:
+            self._indexes.clear()
+            self._generations.clear()
+            self._clock += 1
+            self._floor = self._clock
+
+    def __len__(self) -> int:
+        return len(self._indexes)
+
+    @property
+    def nbytes(self) -> int:
+        """total size of the cached indexes"""
+        return sum(index.nbytes for index in self._indexes.values())
+
+    def _evict(self) -> None:
+        """drop least recently used indexes until within both limits"""
+        size = self.nbytes
+        while self._indexes and (
+            len(self._indexes) > self.max_users or size > self.max_bytes
+        ):
+            uid = next(iter(self._indexes))
+            size -= self._indexes[uid].nbytes
+            self._drop(uid)
+
+    def _drop(self, uid: str) -> None:
+        """forget a user's index and generation"""
+        del self._indexes[uid]
+        del self._generations[uid]
+        self._floor = self._clock
+
+
+index_cache = IndexCache()
+
+
+class IndexStamp(NamedTuple):
+    """a cheap fingerprint of a user's notes, read with one query"""
+
+    note_count: int
+    updated_at: datetime | None
+    embedded_at: datetime | None
+
+
+def read_stamp(uid: int | str) -> IndexStamp:
+    """the current fingerprint of a user's notes"""
+    stamp = Note.objects.filter(user=uid).aggregate(
+        note_count=Count("id"),
+        updated_at=Max("updated_at"),
+        embedded_at=Max("embedded_at"),
+    )
+    return IndexStamp(**stamp)
+
+
+def get_user_index(uid: int | str, stamp: IndexStamp | None = None) -> NoteIndex:
+    """Get the search index for a user
+    A cached index is checked against the notes' fingerprint, which catches
+    writes from other processes such as the job worker. If they differ only
+    the changed rows are loaded. Notes are never embedded here.
+    stamp -- the fingerprint, if it has just been read
+    """
+    key = str(uid)
+    stamp = stamp or read_stamp(uid)
+    index = index_cache.get(key)
+    if index is not None and index.stamp == stamp:
+        return index
+
+    generation = index_cache.generation(key)
+    if index is not None:
+        index = refresh_index(uid, index, stamp)
+    if index is None:
+        notes = list(load_note_vectors(Note.objects.filter(user=uid)))
+        index = NoteIndex.from_notes(notes, embedding_dims(notes))
+    index = index.restamped(stamp)
+    index_cache.put(key, index, generation)
+    return index
+
+
+def since(field: str, value: datetime | None) -> Q:
+    """rows with 'field' after 'value', or with any value if it is None"""
+    if value is None:
+        return Q(**{f"{field}__isnull": False})
+    return Q(**{f"{field}__gt": value})
+
+
+def refresh_index(
+    uid: int | str, index: NoteIndex, stamp: IndexStamp
+) -> NoteIndex | None:
+    """bring an index up to date with the rows changed since it was stamped
+    Returns None if the index has to be built again
+    """
+    old: IndexStamp = index.stamp
+    changed = Note.objects.filter(user=uid).filter(
+        since("updated_at", old.updated_at) | since("embedded_at", old.embedded_at)
+    )
+    refreshed = upsert_notes(index, list(load_note_vectors(changed)))
+    if refreshed is None:
+        return None
+    if len(refreshed) != stamp.note_count:
+        # some notes were deleted
+        ids = set(Note.objects.filter(user=uid).values_list("id", flat=True))
+        for note_id in set(refreshed.rows) - ids:
+            refreshed = refreshed.remove(note_id)
+    return refreshed
+
+
+def upsert_notes(
+    index: NoteIndex, notes: Sequence[Note | NoteVectors]
+) -> NoteIndex | None:
+    """a copy of the index with the notes' current vectors,
+    or None if they don't fit and the index has to be built again"""
+    if not notes:
+        return index
+    vectors = [(note.title_vector(), note.content_vector()) for note in notes]
+    sizes = {vector.size for pair in vectors for vector in pair} - {0}
+    if sizes and sizes != {index.dims}:
+        # first vectors, or a new model
+        return None
+    rows = np.stack([note_rows(*pair, index.dims) for pair in vectors])
+    ids = [int(note.pk) for note in notes]
+    return index.upsert_many(ids, [str(note.title) for note in notes], rows)
+
+
+def note_saved(note: Note) -> None:
+    """update the cached index of the note's owner with the saved note
+    The index keeps its old stamp, so the next search still checks for
+    writes made elsewhere in the meantime.
+    """
+    notes_saved([note])
+
+
+def notes_saved(notes: Sequence[Note]) -> None:
+    """update the cached indexes with many saved notes, copying each
+    owner's index once rather than once per note"""
+    by_user: dict[str, list[Note]] = {}
+    for note in notes:
+        by_user.setdefault(str(note.user), []).append(note)
+    for uid, saved in by_user.items():
+        index_cache.replace(uid, lambda index, saved=saved: upsert_notes(index, saved))
+
+
+def note_deleted(note: Note) -> None:
+    """remove a deleted note from its owner's cached index"""
+    note_id: int = note.id  # type: ignore[attr-defined]
+    index_cache.replace(str(note.user), lambda index: index.remove(note_id))
@@ -0,0 +1,114 @@
+""" A database-backed queue of slow background jobs """
+
+# pylint: disable=no-member
+
+import time
+from datetime import timedelta
+from typing import Callable
+
+from django.db import close_old_connections
+from django.db.models import F, Q
+from django.utils import timezone
+
+from doofer.models import Job
+
+# failed jobs are retried after RETRY_DELAY seconds, doubling each time
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 30
+# a running job not finished after this many seconds is taken to have crashed
+LOCK_TIMEOUT = 15 * 60
+POLL_INTERVAL = 2.0
+
+HANDLERS: dict[str, Callable] = {}
+
+
+def job_handler(kind: str):
+    """decorator registering the function that runs jobs of a kind"""
+
+    def register(handler: Callable) -> Callable:
+        HANDLERS[kind] = handler
+        return handler
+
+    return register
+
+
+def enqueue(kind: str, unique: bool = False, **payload) -> Job:
+    """Add a job to the queue
+    kind -- which handler runs the job
+    unique -- reuse a pending job with the same kind and payload if there is one
+    payload -- keyword arguments for the handler, must be JSON serializable
+    """
+    if unique:
+        pending = Job.objects.filter(kind=kind, status=Job.PENDING, payload=payload)
+        existing = pending.first()
+        if existing:
+            return existing
+    return Job.objects.create(kind=kind, payload=payload)
+
+
+def claim_next() -> Job | None:
+    """take the next runnable job, or None if there is nothing to do
+    A job is claimed with a conditional update, so two workers never run
+    the same job even on databases without row locks.
+    """
+    now = timezone.now()
+    stale = now - timedelta(seconds=LOCK_TIMEOUT)
+    runnable = Job.objects.filter(
+        Q(status=Job.PENDING, run_after__lte=now)
+        | Q(status=Job.RUNNING, locked_at__lt=stale)
+    ).order_by("run_after", "id")
+    for job in runnable[:10]:
+        claimed = Job.objects.filter(
+            pk=job.pk, status=job.status, locked_at=job.locked_at
+        ).update(status=Job.RUNNING, locked_at=now, attempts=F("attempts") + 1)
+        if claimed:
+            job.refresh_from_db()
+            return job
+    return None
+
+
+def run_job(job: Job) -> None:
+    """run a claimed job and record how it went"""
+    try:
+        handler = HANDLERS.get(job.kind)
+        if handler is None:
+            raise ValueError(f"No handler for job kind {job.kind}")
+        handler(**job.payload)
+    except Exception as error:  # pylint: disable=broad-except
+        print(f"Job {job} failed: {error!r}")
+        job.error = repr(error)
+        if job.attempts >= MAX_ATTEMPTS:
+            job.status = Job.FAILED
+        else:
+            job.status = Job.PENDING
+            delay = RETRY_DELAY * 2 ** (job.attempts - 1)
+            job.run_after = timezone.now() + timedelta(seconds=delay)
+    else:
+        job.status = Job.DONE
+        job.error = ""
+    job.locked_at = None
+    job.save()
+
+
+def run_pending(limit: int | None = None) -> int:
+    """run runnable jobs until there are none left, or 'limit' have run
+    Returns the number of jobs run
+    """
+    count = 0
+    while limit is None or count < limit:
+        job = claim_next()
+        if job is None:
+            break
+        run_job(job)
+        count += 1
+    return count
+
+
+def work(poll_interval: float = POLL_INTERVAL, burst: bool = False) -> None:
+    """run jobs forever, or until the queue is empty when 'burst' is set"""
+    while True:
+        close_old_connections()
+        if run_pending() == 0:
+            if burst:
+                return
+            time.sleep(poll_interval)
@@ -0,0 +1,108 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from doofer.ann import IVFIndex
+from doofer.embeddings import EMBEDDINGS_SIZE
+from doofer.models import Note
+from doofer.similarity import (
+    NoteIndex,
+    embedding_dims,
+    load_note_vectors,
+    normalize_rows,
+    top_k,
+)
+
+
+def synthetic_notes(count: int, dims: int, rng) -> tuple[np.ndarray, np.ndarray]:
+    """(ids, (count, 2, dims) unit vectors) spread over topic clusters"""
+    topics = normalize_rows(rng.standard_normal((max(count // 50, 1), dims)))
+    centres = topics[rng.integers(len(topics), size=count)]
+    noise = rng.standard_normal((count, 2, dims)) * 0.08
+    matrix = normalize_rows((centres[:, np.newaxis, :] + noise).astype(np.float32))
+    return np.arange(1, count + 1), matrix
+
+
+def percentile_ms(timings: list[float], percentile: float) -> float:
+    """a latency percentile in milliseconds"""
+    return float(np.percentile(timings, percentile) * 1000)
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare approximate (IVF) search with exact search: recall@k and "
+        "p50/p99 latency, to choose ANN_MIN_NOTES and ANN_NPROBE"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--notes",
+            type=int,
+            nargs="+",
+            default=[1000, 10000, 100000],
+            help="library sizes to try, with synthetic vectors",
+        )
+        parser.add_argument("--user", type=int, help="use this user's real notes")
+        parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16])
+        parser.add_argument("--k", type=int, default=10)
+        parser.add_argument("--queries", type=int, default=200)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options["seed"])
+        if options["user"] is not None:
+            user_notes = Note.objects.filter(user=options["user"])
+            notes = list(load_note_vectors(user_notes))
+            dims = embedding_dims(notes)
+            if not dims:
+                raise CommandError("That user has no embedded notes")
+            index = NoteIndex.from_notes(notes, dims)
+            self.run(index.ids, index.matrix, rng, options)
+            return
+        for count in options["notes"]:
+            ids, matrix = synthetic_notes(count, EMBEDDINGS_SIZE, rng)
+            self.run(ids, matrix, rng, options)
+
+    def run(self, ids, matrix, rng, options):
+        """benchmark one library"""
+        k = options["k"]
+        count, _, dims = matrix.shape
+        # queries are perturbed notes, like searching for a known topic
+        picks = matrix[rng.integers(count, size=options["queries"]), 0]
+        noise = rng.standard_normal(picks.shape).astype(np.float32) * 0.05
+        queries = normalize_rows(picks + noise)
+
+        flat = matrix.reshape(-1, dims)
+        exact, exact_times = [], []
+        for query in queries:
+            start = time.perf_counter()
+            scores = (flat @ query).reshape(count, 2).max(axis=1)
+            exact.append(set(ids[top_k(scores, k)].tolist()))
+            exact_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        ann = IVFIndex.build(np.repeat(ids, 2), flat)
+        build_seconds = time.perf_counter() - start
+
+        self.stdout.write(
+            f"\n{count} notes, {len(ann.centroids)} clusters, "
+            f"built in {build_seconds:.2f}s"
+        )
+        self.stdout.write(
+            f"  exact      recall@{k} 1.000  p50 {percentile_ms(exact_times, 50):7.3f}ms"
+            f"  p99 {percentile_ms(exact_times, 99):7.3f}ms"
+        )
+        for nprobe in options["nprobe"]:
+            recalls, times = [], []
+            for query, expected in zip(queries, exact):
+                start = time.perf_counter()
+                found, _ = ann.search(query[np.newaxis], k, nprobe)
+                times.append(time.perf_counter() - start)
+                recalls.append(len(expected & set(found.tolist())) / len(expected))
+            self.stdout.write(
+                f"  nprobe {nprobe:<3} recall@{k} {np.mean(recalls):.3f}"
+                f"  p50 {percentile_ms(times, 50):7.3f}ms"
+                f"  p99 {percentile_ms(times, 99):7.3f}ms"
+            )
+
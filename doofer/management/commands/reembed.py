@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from doofer.jobs import enqueue
+from doofer.models import Note
+
+
+class Command(BaseCommand):
+    help = "Queue jobs recalculating note embeddings, eg after a backend change"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", type=int, help="only this user's notes")
+
+    def handle(self, *args, **options):
+        if options["user"] is not None:
+            users = [options["user"]]
+        else:
+            users = Note.objects.values_list("user", flat=True).distinct()
+        for user in users:
+            enqueue("reembed", unique=True, user=user)
+        self.stdout.write(f"Queued re-embedding for {len(users)} users")
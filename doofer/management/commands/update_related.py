@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from doofer.models import Note
+from doofer.tasks import enqueue_related
+
+
+class Command(BaseCommand):
+    help = "Queue jobs calculating related notes, eg for notes saved before they existed"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", type=int, help="only this user's notes")
+
+    def handle(self, *args, **options):
+        if options["user"] is not None:
+            users = [options["user"]]
+        else:
+            users = Note.objects.values_list("user", flat=True).distinct()
+        for user in users:
+            enqueue_related(user)
+        self.stdout.write(f"Queued related notes for {len(users)} users")
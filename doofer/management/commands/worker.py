@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from doofer.jobs import POLL_INTERVAL, work
+
+
+class Command(BaseCommand):
+    help = "Run background jobs from the database queue"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--burst",
+            action="store_true",
+            help="exit once the queue is empty instead of waiting for more jobs",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=POLL_INTERVAL,
+            help="seconds to wait between checks of an empty queue",
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write("Worker started")
+        work(poll_interval=options["poll_interval"], burst=options["burst"])
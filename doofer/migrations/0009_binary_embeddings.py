@@ -0,0 +1,59 @@
+# Convert the comma separated embedding text columns to float32 bytes
+
+import numpy as np
+from django.db import migrations, models
+
+FIELDS = ("title_embedding", "content_embedding")
+
+
+def text_to_binary(apps, schema_editor):
+    """pack each comma separated vector into the new binary columns"""
+    Note = apps.get_model("doofer", "Note")
+    for note in Note.objects.all().iterator(chunk_size=500):
+        for field in FIELDS:
+            values = [float(e) for e in getattr(note, field).split(",") if e]
+            setattr(note, f"{field}_bin", np.asarray(values, "<f4").tobytes())
+        note.save(update_fields=[f"{field}_bin" for field in FIELDS])
+
+
+def binary_to_text(apps, schema_editor):
+    """unpack the binary columns back into comma separated text"""
+    Note = apps.get_model("doofer", "Note")
+    for note in Note.objects.all().iterator(chunk_size=500):
+        for field in FIELDS:
+            values = np.frombuffer(getattr(note, f"{field}_bin") or b"", "<f4")
+            setattr(note, field, ",".join(str(e) for e in values.tolist()))
+        note.save(update_fields=list(FIELDS))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("doofer", "0008_note_content_embedding_note_title_embedding_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="note",
+            name="title_embedding_bin",
+            field=models.BinaryField(blank=True, default=b""),
+        ),
+        migrations.AddField(
+            model_name="note",
+            name="content_embedding_bin",
+            field=models.BinaryField(blank=True, default=b""),
+        ),
+        migrations.RunPython(text_to_binary, binary_to_text),
+        migrations.RemoveField(model_name="note", name="title_embedding"),
+        migrations.RemoveField(model_name="note", name="content_embedding"),
+        migrations.RenameField(
+            model_name="note",
+            old_name="title_embedding_bin",
+            new_name="title_embedding",
+        ),
+        migrations.RenameField(
+            model_name="note",
+            old_name="content_embedding_bin",
+            new_name="content_embedding",
+        ),
+    ]
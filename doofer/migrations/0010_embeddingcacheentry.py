@@ -0,0 +1,37 @@
+# Generated by Django 5.0.4 on 2026-10-18 15:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("doofer", "0009_binary_embeddings"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EmbeddingCacheEntry",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("model_name", models.CharField(max_length=100)),
+                ("text_hash", models.CharField(max_length=64)),
+                ("embedding", models.BinaryField()),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="embeddingcacheentry",
+            constraint=models.UniqueConstraint(
+                fields=("model_name", "text_hash"), name="unique_embedding_cache_key"
+            ),
+        ),
+    ]
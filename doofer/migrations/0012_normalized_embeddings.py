@@ -0,0 +1,67 @@
+# Store embeddings at unit length, keeping their original norms
+
+import numpy as np
+from django.db import migrations, models
+
+FIELDS = ("title_embedding", "content_embedding")
+
+
+def normalize(apps, schema_editor):
+    """scale each stored vector to unit length and record its norm"""
+    Note = apps.get_model("doofer", "Note")
+    batch = []
+    for note in Note.objects.all().iterator(chunk_size=500):
+        for field in FIELDS:
+            vector = np.frombuffer(getattr(note, field) or b"", "<f4")
+            if vector.size == 0:
+                continue
+            norm = float(np.linalg.norm(vector.astype(np.float64)))
+            if norm > 0:
+                vector = vector / norm
+            else:
+                print(f"Zero {field} for note {note.pk}")
+            setattr(note, field, vector.astype("<f4").tobytes())
+            setattr(note, f"{field}_norm", norm)
+        batch.append(note)
+        if len(batch) == 500:
+            Note.objects.bulk_update(batch, [*FIELDS, *(f"{f}_norm" for f in FIELDS)])
+            batch = []
+    Note.objects.bulk_update(batch, [*FIELDS, *(f"{f}_norm" for f in FIELDS)])
+
+
+def denormalize(apps, schema_editor):
+    """scale each stored vector back to its recorded norm"""
+    Note = apps.get_model("doofer", "Note")
+    batch = []
+    for note in Note.objects.all().iterator(chunk_size=500):
+        for field in FIELDS:
+            norm = getattr(note, f"{field}_norm")
+            if norm:
+                vector = np.frombuffer(getattr(note, field), "<f4") * norm
+                setattr(note, field, vector.astype("<f4").tobytes())
+        batch.append(note)
+        if len(batch) == 500:
+            Note.objects.bulk_update(batch, FIELDS)
+            batch = []
+    Note.objects.bulk_update(batch, FIELDS)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("doofer", "0011_job_note_embedded_at"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="note",
+            name="content_embedding_norm",
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="note",
+            name="title_embedding_norm",
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.RunPython(normalize, denormalize),
+    ]
@@ -0,0 +1,83 @@
+# Generated by Django 5.0.4 on 2026-10-18 15:32
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def clear_related_updated_at(apps, schema_editor):
+    apps.get_model("doofer", "Note").objects.update(related_updated_at=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("doofer", "0012_normalized_embeddings"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="note",
+            name="related_updated_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        # the old values were save times, not calculation times
+        migrations.RunPython(clear_related_updated_at, migrations.RunPython.noop),
+        migrations.CreateModel(
+            name="RelatedNote",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("score", models.FloatField()),
+                ("rank", models.PositiveSmallIntegerField()),
+                (
+                    "from_note",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="related_links",
+                        to="doofer.note",
+                    ),
+                ),
+                (
+                    "to_note",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="related_by_links",
+                        to="doofer.note",
+                    ),
+                ),
+            ],
+        ),
+        # a field can't gain a through model, and the old table was never filled
+        migrations.RemoveField(
+            model_name="note",
+            name="related",
+        ),
+        migrations.AddField(
+            model_name="note",
+            name="related",
+            field=models.ManyToManyField(
+                related_name="related_by",
+                through="doofer.RelatedNote",
+                to="doofer.note",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="relatednote",
+            index=models.Index(
+                fields=["from_note", "rank"], name="doofer_rela_from_no_e36197_idx"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="relatednote",
+            constraint=models.UniqueConstraint(
+                fields=("from_note", "to_note"), name="unique_related_note"
+            ),
+        ),
+    ]
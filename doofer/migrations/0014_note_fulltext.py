@@ -0,0 +1,78 @@
+# The full-text index of note titles and comments, see doofer.fulltext. The
+# SQL is kept here as it was when this migration was written, so editing the
+# app can't change what it does. doofer.fulltext.repair puts back SQLite
+# triggers lost by later migrations.
+
+from django.db import migrations
+
+SQLITE_INSTALL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS doofer_note_fts USING fts5(
+    title, comment, content='doofer_note', content_rowid='id',
+    tokenize='porter unicode61')""",
+    """CREATE TRIGGER IF NOT EXISTS doofer_note_fts_insert
+    AFTER INSERT ON doofer_note BEGIN
+        INSERT INTO doofer_note_fts (rowid, title, comment)
+        VALUES (new.id, new.title, new.comment);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS doofer_note_fts_delete
+    AFTER DELETE ON doofer_note BEGIN
+        INSERT INTO doofer_note_fts (doofer_note_fts, rowid, title, comment)
+        VALUES ('delete', old.id, old.title, old.comment);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS doofer_note_fts_update
+    AFTER UPDATE OF title, comment ON doofer_note BEGIN
+        INSERT INTO doofer_note_fts (doofer_note_fts, rowid, title, comment)
+        VALUES ('delete', old.id, old.title, old.comment);
+        INSERT INTO doofer_note_fts (rowid, title, comment)
+        VALUES (new.id, new.title, new.comment);
+    END""",
+    "INSERT INTO doofer_note_fts (doofer_note_fts) VALUES ('rebuild')",
+]
+
+SQLITE_UNINSTALL = [
+    "DROP TRIGGER IF EXISTS doofer_note_fts_insert",
+    "DROP TRIGGER IF EXISTS doofer_note_fts_delete",
+    "DROP TRIGGER IF EXISTS doofer_note_fts_update",
+    "DROP TABLE IF EXISTS doofer_note_fts",
+]
+
+POSTGRES_INSTALL = [
+    """ALTER TABLE doofer_note ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(title, '')), 'A')
+        || setweight(to_tsvector('english', coalesce(comment, '')), 'B')
+    ) STORED""",
+    """CREATE INDEX IF NOT EXISTS doofer_note_search_vector
+    ON doofer_note USING GIN (search_vector)""",
+]
+
+POSTGRES_UNINSTALL = [
+    "DROP INDEX IF EXISTS doofer_note_search_vector",
+    "ALTER TABLE doofer_note DROP COLUMN IF EXISTS search_vector",
+]
+
+
+def run(statements):
+    """a RunPython function running the statements for this database"""
+
+    def forwards(apps, schema_editor):
+        vendor = schema_editor.connection.vendor
+        for sql in statements.get(vendor, []):
+            schema_editor.execute(sql, params=None)
+
+    return forwards
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("doofer", "0013_related_notes"),
+    ]
+
+    # the index is kept in step by the database
+    operations = [
+        migrations.RunPython(
+            run({"sqlite": SQLITE_INSTALL, "postgresql": POSTGRES_INSTALL}),
+            run({"sqlite": SQLITE_UNINSTALL, "postgresql": POSTGRES_UNINSTALL}),
+        ),
+    ]
@@ -0,0 +1,85 @@
+# Vector columns for similarity search in SQL, see doofer.pgvector. The SQL
+# is kept here as it was when this migration was written, so editing the app
+# or its settings can't change what it does.
+
+from django.db import migrations
+
+# the size of all-MiniLM-L6-v2 embeddings
+DIMS = 384
+
+COLUMNS = {"title_vector": "title_embedding", "content_vector": "content_embedding"}
+
+# little-endian float32 bytes to a vector, NULL for another size of embedding.
+# Subnormal floats, far below any useful similarity, decode as 0.
+UNPACK_FUNCTION = """
+    CREATE OR REPLACE FUNCTION doofer_unpack_embedding(data bytea, dims integer)
+    RETURNS vector LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE AS $$
+        SELECT CASE WHEN length(data) <> 4 * dims THEN NULL ELSE (
+            SELECT array_agg(
+                CASE WHEN ((bits >> 23) & 255) = 0 THEN 0
+                ELSE (1 - 2 * (bits >> 31))
+                    * (1 + (bits & 8388607) / 8388608.0)
+                    * power(2.0, ((bits >> 23) & 255) - 127)
+                END ORDER BY i
+            )::real[]::vector
+            FROM (
+                SELECT i,
+                    (get_byte(data, 4 * i)::bigint)
+                    | (get_byte(data, 4 * i + 1)::bigint << 8)
+                    | (get_byte(data, 4 * i + 2)::bigint << 16)
+                    | (get_byte(data, 4 * i + 3)::bigint << 24) AS bits
+                FROM generate_series(0, dims - 1) AS i
+            ) AS words
+        ) END
+    $$"""
+
+
+def install(apps, schema_editor):
+    """create the vector columns and their HNSW indexes, on PostgreSQL
+    with the vector extension only"""
+    connection = schema_editor.connection
+    if connection.vendor != "postgresql":
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'vector'")
+        if cursor.fetchone() is None:
+            print("pgvector is not available, similarity search runs in Python")
+            return
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS vector")
+        cursor.execute(UNPACK_FUNCTION)
+        for column, source in COLUMNS.items():
+            cursor.execute(
+                f"ALTER TABLE doofer_note ADD COLUMN IF NOT EXISTS {column}"
+                f" vector({DIMS}) GENERATED ALWAYS AS"
+                f" (doofer_unpack_embedding({source}, {DIMS})) STORED"
+            )
+            cursor.execute(
+                f"CREATE INDEX IF NOT EXISTS doofer_note_{column} ON doofer_note"
+                f" USING hnsw ({column} vector_ip_ops)"
+            )
+
+
+def uninstall(apps, schema_editor):
+    """drop the vector columns and their indexes"""
+    connection = schema_editor.connection
+    if connection.vendor != "postgresql":
+        return
+    with connection.cursor() as cursor:
+        for column in COLUMNS:
+            cursor.execute(f"DROP INDEX IF EXISTS doofer_note_{column}")
+            cursor.execute(f"ALTER TABLE doofer_note DROP COLUMN IF EXISTS {column}")
+        cursor.execute(
+            "DROP FUNCTION IF EXISTS doofer_unpack_embedding(bytea, integer)"
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("doofer", "0014_note_fulltext"),
+    ]
+
+    # PostgreSQL only, the vectors are kept in step by the database
+    operations = [
+        migrations.RunPython(install, uninstall),
+    ]
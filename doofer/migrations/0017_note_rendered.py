@@ -0,0 +1,49 @@
+# Store the html and thumbnail shown for each note, rendered on save
+
+from django.db import migrations, models
+
+from doofer.models import render_html, render_preview, yt_thumbnail_url
+
+RENDERED = ("comment_html", "preview_html", "thumbnail_url")
+
+
+def render_notes(apps, schema_editor):
+    """render the html and thumbnails of the existing notes"""
+    Note = apps.get_model("doofer", "Note")
+    batch = []
+    notes = Note.objects.only("id", "comment", "url")
+    for note in notes.iterator(chunk_size=500):
+        note.comment_html = render_html(note.comment)
+        note.preview_html = render_preview(note.comment)
+        note.thumbnail_url = yt_thumbnail_url(note.url)
+        batch.append(note)
+        if len(batch) == 500:
+            Note.objects.bulk_update(batch, RENDERED)
+            batch = []
+    Note.objects.bulk_update(batch, RENDERED)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("doofer", "0016_note_import"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="note",
+            name="comment_html",
+            field=models.TextField(blank=True, default=""),
+        ),
+        migrations.AddField(
+            model_name="note",
+            name="preview_html",
+            field=models.TextField(blank=True, default=""),
+        ),
+        migrations.AddField(
+            model_name="note",
+            name="thumbnail_url",
+            field=models.URLField(blank=True, default="", max_length=2000),
+        ),
+        migrations.RunPython(render_notes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.0.4 on 2026-10-18 16:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("doofer", "0017_note_rendered"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="note",
+            index=models.Index(
+                fields=["user", "updated_at", "id"], name="note_user_updated"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="note",
+            index=models.Index(
+                fields=["user", "created_at", "id"], name="note_user_created"
+            ),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.0.4 on 2026-10-18 16:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("doofer", "0018_note_user_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AnnIndex",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("user", models.IntegerField(unique=True)),
+                ("data", models.BinaryField()),
+                ("saved_at", models.DateTimeField()),
+            ],
+        ),
+    ]
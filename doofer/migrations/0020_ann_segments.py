@@ -0,0 +1,60 @@
+# Store approximate indexes as centroids plus appended segments, so a sync
+# writes only what changed
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def drop_indexes(apps, schema_editor):
+    """drop the indexes stored whole, queueing a rebuild of each"""
+    AnnIndex = apps.get_model("doofer", "AnnIndex")
+    Job = apps.get_model("doofer", "Job")
+    users = list(AnnIndex.objects.values_list("user", flat=True))
+    AnnIndex.objects.all().delete()
+    Job.objects.bulk_create(
+        Job(kind="ann_sync", payload={"user": user}) for user in users
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("doofer", "0019_ann_index"),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_indexes, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name="annindex",
+            name="built_at",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name="annindex",
+            name="meta",
+            field=models.JSONField(default=dict),
+        ),
+        migrations.CreateModel(
+            name="AnnSegment",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("user", models.IntegerField()),
+                ("base", models.DateTimeField()),
+                ("data", models.BinaryField()),
+            ],
+            options={
+                "indexes": [
+                    models.Index(fields=["user", "id"], name="ann_segment_user_id")
+                ],
+            },
+        ),
+    ]
@@ -1,10 +1,70 @@
 from urllib.parse import parse_qs, urlparse
 
+import numpy as np
 from django.db import models
 from django.forms import ValidationError
+from django.utils import timezone
 from markdown import markdown  # type: ignore[import-untyped]
 from markdownify import markdownify  # type: ignore[import-untyped]
 
+# embeddings are stored as raw little-endian float32 bytes
+EMBEDDING_DTYPE = np.dtype("<f4")
+
+
+def pack_embedding(embeddings) -> bytes:
+    """pack a vector of floats into its binary column format"""
+    return np.asarray(embeddings, dtype=EMBEDDING_DTYPE).tobytes()
+
+
+def normalize_embedding(embeddings) -> tuple[np.ndarray, float | None]:
+    """scale a vector to unit length
+    Returns the unit vector and the original length, None for an empty
+    vector. A zero vector is returned as it is, with length 0.
+    """
+    vector = np.asarray(embeddings, dtype=np.float64)
+    if vector.size == 0:
+        return vector, None
+    norm = float(np.linalg.norm(vector))
+    if norm > 0:
+        vector = vector / norm
+    return vector, norm
+
+
+def unpack_embedding(data) -> np.ndarray:
+    """view a binary embedding column as a float32 array, without copying"""
+    return np.frombuffer(data or b"", dtype=EMBEDDING_DTYPE)
+
+
+def render_html(comment: str) -> str:
+    """convert comment to html"""
+    return markdown(comment)
+
+
+def render_preview(comment: str) -> str:
+    """convert first 3 lines of comment to html"""
+    lines = comment.split("\n")
+    line_count = len(lines)
+    lines = lines[0:4]
+    if lines[0] == "From page:  ":
+        lines = lines[1:]
+    else:
+        lines = lines[:3]
+    if line_count > 4:
+        lines[-1] = lines[-1] + "..."
+
+    return markdown("\n".join(lines))
+
+
+def yt_thumbnail_url(url: str) -> str:
+    """the thumbnail of a youtube video url, '' for any other url"""
+    if "youtube.com" in url:
+        parsed_url = urlparse(url)
+        query_params = parse_qs(parsed_url.query)
+        video_id = query_params.get("v")
+        if video_id:
+            return f"https://img.youtube.com/vi/{video_id[0]}/sddefault.jpg"
+    return ""
+
 
 class Note(models.Model):
     """Django model for a note object"""
@@ -17,29 +77,138 @@ class Note(models.Model):
     url: models.URLField = models.URLField(blank=True, max_length=URL_MAX_LENGTH)
     created_at: models.DateTimeField = models.DateTimeField(auto_now_add=True)
     updated_at: models.DateTimeField = models.DateTimeField(auto_now=True)
-    related_updated_at: models.DateTimeField = models.DateTimeField(auto_now=True)
-    related: models.ManyToManyField = models.ManyToManyField("self", symmetrical=True)
+    # when the related notes were last calculated, see doofer.related
+    related_updated_at: models.DateTimeField = models.DateTimeField(
+        null=True, blank=True
+    )
+    # the most similar notes, best first
+    related: models.ManyToManyField = models.ManyToManyField(
+        "self",
+        symmetrical=False,
+        through="RelatedNote",
+        through_fields=("from_note", "to_note"),
+        related_name="related_by",
+    )
     # the author - this should be a foreignKey to the User model but it caused errors
     user: models.IntegerField = models.IntegerField(default=0)
-    # the embeddings vector, to be replaced with pgvector later
-    title_embedding: models.TextField = models.TextField(blank=True)
-    content_embedding: models.TextField = models.TextField(blank=True)
+    # the embeddings vector as unit length float32 bytes,
+    # to be replaced with pgvector later
+    title_embedding: models.BinaryField = models.BinaryField(blank=True, default=b"")
+    content_embedding: models.BinaryField = models.BinaryField(
+        blank=True, default=b""
+    )
+    # length of the embeddings before normalizing, 0 flags a zero vector
+    title_embedding_norm: models.FloatField = models.FloatField(null=True, blank=True)
+    content_embedding_norm: models.FloatField = models.FloatField(
+        null=True, blank=True
+    )
+    # when the embeddings were last written
+    embedded_at: models.DateTimeField = models.DateTimeField(null=True, blank=True)
+    # rendered from comment and url whenever they are saved, see render()
+    comment_html: models.TextField = models.TextField(blank=True, default="")
+    preview_html: models.TextField = models.TextField(blank=True, default="")
+    thumbnail_url: models.URLField = models.URLField(
+        blank=True, default="", max_length=URL_MAX_LENGTH
+    )
+
+    # text field -> the embedding made from it
+    EMBEDDED_FIELDS = {"title": "title_embedding", "comment": "content_embedding"}
+    # source field -> the fields rendered from it
+    RENDERED_FIELDS = {
+        "comment": ("comment_html", "preview_html"),
+        "url": ("thumbnail_url",),
+    }
+
+    class Meta:
+        # a user's notes newest first, or oldest first, from one index range
+        indexes = [
+            models.Index(fields=["user", "updated_at", "id"], name="note_user_updated"),
+            models.Index(fields=["user", "created_at", "id"], name="note_user_created"),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """remember the text the stored embeddings were made from"""
+        instance = super().from_db(db, field_names, values)
+        instance.remember_embedded_text()
+        return instance
+
+    def remember_embedded_text(self) -> None:
+        """note the current text and embeddings as in step"""
+        self._embedded_text = {
+            field: (self.__dict__.get(field), self.__dict__.get(embedding))
+            for field, embedding in self.EMBEDDED_FIELDS.items()
+        }
+
+    def render(self) -> None:
+        """render the html and thumbnail shown for the comment and url,
+        bulk_create and bulk_update skip save() so call this first"""
+        self.comment_html = render_html(self.comment)
+        self.preview_html = render_preview(self.comment)
+        self.thumbnail_url = yt_thumbnail_url(self.url)
+
+    def save(self, *args, **kwargs):
+        """clear embeddings whose text changed, so they get made again,
+        and render the comment and url"""
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None:
+            rendered = [
+                field
+                for source, fields in self.RENDERED_FIELDS.items()
+                if source in update_fields
+                for field in fields
+            ]
+            if rendered:
+                self.render()
+                kwargs["update_fields"] = {*update_fields, *rendered}
+        else:
+            self.render()
+            loaded = getattr(self, "_embedded_text", {})
+            for field, embedding in self.EMBEDDED_FIELDS.items():
+                text, vector = loaded.get(field, (None, None))
+                changed = text is not None and text != getattr(self, field)
+                if changed and getattr(self, embedding) is vector:
+                    setattr(self, embedding, b"")
+                    setattr(self, f"{embedding}_norm", None)
+        super().save(*args, **kwargs)
+        self.remember_embedded_text()
+
+    def needs_embeddings(self) -> bool:
+        """true if some text has no embeddings yet"""
+        return bool(
+            (self.title and not self.title_embedding)
+            or (self.comment and not self.content_embedding)
+        )
 
     def get_title_embeddings(self) -> list[float]:
         """get the title embeddings as a list of floats"""
-        return [float(e) for e in self.title_embedding.split(",") if e]
+        return self.title_vector().tolist()
 
     def set_title_embeddings(self, embeddings: list[float]) -> None:
-        """set the title embeddings as a list of floats"""
-        self.title_embedding = ",".join([str(e) for e in embeddings])
+        """set the title embeddings as a list of floats, stored normalized"""
+        vector, self.title_embedding_norm = normalize_embedding(embeddings)
+        if self.title_embedding_norm == 0:
+            print(f"Zero title embedding for note {self.pk}")
+        self.title_embedding = pack_embedding(vector)
 
     def set_content_embeddings(self, embeddings: list[float]) -> None:
-        """set the content embeddings as a list of floats"""
-        self.content_embedding = ",".join([str(e) for e in embeddings])
+        """set the content embeddings as a list of floats, stored normalized"""
+        vector, self.content_embedding_norm = normalize_embedding(embeddings)
+        if self.content_embedding_norm == 0:
+            print(f"Zero content embedding for note {self.pk}")
+        self.content_embedding = pack_embedding(vector)
 
     def get_content_embeddings(self) -> list[float]:
         """get the content embeddings as a list of floats"""
-        return [float(e) for e in self.content_embedding.split(",") if e]
+        return self.content_vector().tolist()
+
+    def title_vector(self) -> np.ndarray:
+        """the unit title embeddings as a read-only float32 array"""
+        return unpack_embedding(self.title_embedding)
+
+    def content_vector(self) -> np.ndarray:
+        """the unit content embeddings as a read-only float32 array"""
+        return unpack_embedding(self.content_embedding)
 
     # validate model and convert html to markdown
     def clean(self) -> None:
@@ -56,33 +225,183 @@ class Note(models.Model):
             self.comment = markdownify(self.comment)
 
     def content_as_html(self):
-        """convert comment to html"""
-        return markdown(self.comment)
+        """the comment as html, rendered when it was saved"""
+        return self.comment_html
 
     def preview(self):
-        """convert first 3 lines of comment to html"""
-        lines = self.comment.split("\n")
-        line_count = len(lines)
-        lines = lines[0:4]
-        if lines[0] == "From page:  ":
-            lines = lines[1:]
-        else:
-            lines = lines[:3]
-        if line_count > 4:
-            lines[-1] = lines[-1] + "..."
-
-        return markdown("\n".join(lines))
+        """the first 3 lines of the comment as html, rendered when it was saved"""
+        return self.preview_html
 
     def get_yt_thumbnail_url(self):
-        """get the video id from a the url if it's a youtube url"""
-        if "youtube.com" in self.url:
-            parsed_url = urlparse(self.url)
-            query_params = parse_qs(parsed_url.query)
-            video_id = query_params.get("v")
-            if video_id:
-                return f"https://img.youtube.com/vi/{video_id[0]}/sddefault.jpg"
-        return None
+        """the thumbnail if the url is a youtube video, None otherwise"""
+        return self.thumbnail_url or None
 
     def __str__(self):
         """convert to string"""
         return str(self.title)
+
+
+class RelatedNote(models.Model):
+    """One entry in a note's list of related notes"""
+
+    from_note: models.ForeignKey = models.ForeignKey(
+        Note, on_delete=models.CASCADE, related_name="related_links"
+    )
+    to_note: models.ForeignKey = models.ForeignKey(
+        Note, on_delete=models.CASCADE, related_name="related_by_links"
+    )
+    score: models.FloatField = models.FloatField()
+    # 0 for the most similar note
+    rank: models.PositiveSmallIntegerField = models.PositiveSmallIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["from_note", "to_note"], name="unique_related_note"
+            )
+        ]
+        indexes = [models.Index(fields=["from_note", "rank"])]
+
+    def __str__(self):
+        """convert to string"""
+        return f"{self.from_note_id} -> {self.to_note_id}"
+
+
+class EmbeddingCacheEntry(models.Model):
+    """A computed embedding, keyed by model and a hash of the text"""
+
+    model_name: models.CharField = models.CharField(max_length=100)
+    text_hash: models.CharField = models.CharField(max_length=64)
+    embedding: models.BinaryField = models.BinaryField()
+    created_at: models.DateTimeField = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["model_name", "text_hash"], name="unique_embedding_cache_key"
+            )
+        ]
+
+    def __str__(self):
+        """convert to string"""
+        return f"{self.model_name}:{self.text_hash}"
+
+
+class Job(models.Model):
+    """A unit of slow work for the background worker"""
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUSES = [
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+
+    kind: models.CharField = models.CharField(max_length=50)
+    payload: models.JSONField = models.JSONField(default=dict)
+    status: models.CharField = models.CharField(
+        max_length=10, choices=STATUSES, default=PENDING
+    )
+    attempts: models.PositiveIntegerField = models.PositiveIntegerField(default=0)
+    # not picked up before this time, used to back off retries
+    run_after: models.DateTimeField = models.DateTimeField(default=timezone.now)
+    locked_at: models.DateTimeField = models.DateTimeField(null=True, blank=True)
+    error: models.TextField = models.TextField(blank=True)
+    created_at: models.DateTimeField = models.DateTimeField(auto_now_add=True)
+    updated_at: models.DateTimeField = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "run_after"])]
+
+    def __str__(self):
+        """convert to string"""
+        return f"{self.kind} #{self.pk} ({self.status})"
+
+
+class NoteImport(models.Model):
+    """A backup file being imported into a user's notes, see doofer.backup"""
+
+    user: models.IntegerField = models.IntegerField()
+    name: models.CharField = models.CharField(max_length=255)
+    status: models.CharField = models.CharField(
+        max_length=10, choices=Job.STATUSES, default=Job.PENDING
+    )
+    # rows read so far, of which 'imported' became notes and 'failed' didn't
+    rows: models.PositiveIntegerField = models.PositiveIntegerField(default=0)
+    imported: models.PositiveIntegerField = models.PositiveIntegerField(default=0)
+    failed: models.PositiveIntegerField = models.PositiveIntegerField(default=0)
+    error: models.TextField = models.TextField(blank=True)
+    created_at: models.DateTimeField = models.DateTimeField(auto_now_add=True)
+    updated_at: models.DateTimeField = models.DateTimeField(auto_now=True)
+
+    def is_finished(self) -> bool:
+        """true once the import has stopped, for good or not"""
+        return self.status in (Job.DONE, Job.FAILED)
+
+    def __str__(self):
+        """convert to string"""
+        return f"{self.name} ({self.status})"
+
+
+class ImportChunk(models.Model):
+    """A piece of an uploaded backup file, kept until it is imported
+    Uploads are stored in the database so the worker can read them from
+    another machine.
+    """
+
+    note_import: models.ForeignKey = models.ForeignKey(
+        NoteImport, on_delete=models.CASCADE, related_name="chunks"
+    )
+    seq: models.PositiveIntegerField = models.PositiveIntegerField()
+    data: models.BinaryField = models.BinaryField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["note_import", "seq"], name="unique_import_chunk"
+            )
+        ]
+
+
+class AnnIndex(models.Model):
+    """A user's approximate nearest neighbour index, see doofer.ann
+    Kept in the database so web processes on other machines can load what
+    the job worker built. This row holds the clusters, the indexed vectors
+    are in AnnSegment rows appended to it.
+    """
+
+    user: models.IntegerField = models.IntegerField(unique=True)
+    # the IVFIndex centroids as an .npz file
+    data: models.BinaryField = models.BinaryField()
+    # when the centroids were written, the segments of older ones are gone
+    built_at: models.DateTimeField = models.DateTimeField()
+    saved_at: models.DateTimeField = models.DateTimeField()
+    # sync state, see sync_user_ann
+    meta: models.JSONField = models.JSONField(default=dict)
+
+    def __str__(self):
+        """convert to string"""
+        return f"ANN index of user {self.user}"
+
+
+class AnnSegment(models.Model):
+    """Rows added to, and notes removed from, an AnnIndex by one sync
+    Loading an index applies its segments in id order.
+    """
+
+    user: models.IntegerField = models.IntegerField()
+    # the built_at of the AnnIndex the segment belongs to
+    base: models.DateTimeField = models.DateTimeField()
+    # the segment's arrays as an .npz file
+    data: models.BinaryField = models.BinaryField()
+
+    class Meta:
+        indexes = [models.Index(fields=["user", "id"], name="ann_segment_user_id")]
+
+    def __str__(self):
+        """convert to string"""
+        return f"ANN segment of user {self.user}"
@@ -0,0 +1,85 @@
+""" Keyset pagination of notes, newest first
+
+A page ends at the (updated_at, id) of its last note, and the next page is
+the notes strictly before that, so each page is one indexed range query
+however deep it is, unlike OFFSET which reads and discards every row before
+the page. A user's pages are read from the (user, updated_at, id) index.
+"""
+
+# pylint: disable=no-member
+
+import base64
+import binascii
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q, QuerySet
+
+from doofer.models import Note
+
+ORDERING = ("-updated_at", "-id")
+# note fields shown on a page of the note list
+LIST_FIELDS = ("id", "title", "preview_html", "thumbnail_url")
+
+
+def encode_cursor(updated_at: datetime, note_id: int) -> str:
+    """the opaque cursor of the page after a note"""
+    key = f"{updated_at.isoformat()}|{note_id}"
+    return base64.urlsafe_b64encode(key.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    """(updated_at, id) from a cursor, ValueError if it is not one"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        updated_at, note_id = base64.urlsafe_b64decode(padded).decode().split("|")
+        return datetime.fromisoformat(updated_at), int(note_id)
+    except (binascii.Error, UnicodeDecodeError) as error:
+        raise ValueError(f"Invalid cursor {cursor!r}") from error
+
+
+def page_size(requested: str | None) -> int:
+    """the page size asked for, NOTES_PAGE_SIZE by default, at most NOTES_MAX_PAGE_SIZE
+    ValueError if it is not a number
+    """
+    if not requested:
+        return settings.NOTES_PAGE_SIZE
+    return max(1, min(int(requested), settings.NOTES_MAX_PAGE_SIZE))
+
+
+def user_notes(uid, fields: tuple[str, ...] = LIST_FIELDS) -> QuerySet:
+    """a user's notes for listing, loading only some fields and the ordering"""
+    return Note.objects.filter(user=uid).only(*fields, "updated_at")
+
+
+def after_cursor(queryset: QuerySet, cursor: str | None) -> QuerySet:
+    """the notes of a queryset from a cursor on, newest first"""
+    queryset = queryset.order_by(*ORDERING)
+    if not cursor:
+        return queryset
+    updated_at, note_id = decode_cursor(cursor)
+    # the first condition bounds the index range, the second breaks ties
+    return queryset.filter(updated_at__lte=updated_at).filter(
+        Q(updated_at__lt=updated_at) | Q(id__lt=note_id)
+    )
+
+
+def split_page(notes: list, size: int):
+    """the first 'size' of size + 1 notes, and the cursor after them if there are more"""
+    if len(notes) <= size:
+        return notes, None
+    last = notes[size - 1]
+    return notes[:size], encode_cursor(last.updated_at, last.id)
+
+
+def page(queryset: QuerySet, cursor: str | None, size: int):
+    """Load one page of notes
+    Returns the notes and the cursor of the next page, None on the last page
+    """
+    return split_page(list(after_cursor(queryset, cursor)[: size + 1]), size)
+
+
+async def apage(queryset: QuerySet, cursor: str | None, size: int):
+    """Load one page of notes, from async code, like page()"""
+    notes = [note async for note in after_cursor(queryset, cursor)[: size + 1]]
+    return split_page(notes, size)
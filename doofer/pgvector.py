@@ -0,0 +1,122 @@
+""" Similarity search in SQL with pgvector on PostgreSQL
+
+Migration 0015 decodes the float32 embedding columns into generated
+vector(DIMS) columns, so the database keeps them in step with every write,
+like the full-text index. An HNSW index on each column answers top-k
+queries by inner product, which for unit vectors is the cosine similarity.
+On other databases, or without the vector extension, nothing is installed
+and doofer.search keeps ranking notes in-process.
+"""
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from doofer.similarity import stack_embeddings
+
+COLUMNS = {"title_vector": "title_embedding", "content_vector": "content_embedding"}
+# the size of the vector columns, see migration 0015
+DIMS = 384
+
+_installed: dict[str, bool] = {}
+_versions: dict[str, tuple[int, ...]] = {}
+# the first version able to keep scanning an index until enough rows pass
+# the WHERE clause
+ITERATIVE_SCAN_VERSION = (0, 8)
+
+
+def enabled(conn=connection) -> bool:
+    """true if notes are ranked in SQL, checked once per process"""
+    if settings.VECTOR_SEARCH == "python" or conn.vendor != "postgresql":
+        return False
+    if conn.alias not in _installed:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT 1 FROM information_schema.columns"
+                " WHERE table_name = 'doofer_note' AND column_name = 'title_vector'"
+            )
+            _installed[conn.alias] = cursor.fetchone() is not None
+    return _installed[conn.alias]
+
+
+def extension_version(conn=connection) -> tuple[int, ...]:
+    """the installed version of the vector extension, checked once per process"""
+    if conn.alias not in _versions:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+            row = cursor.fetchone()
+        version = row[0] if row else "0"
+        _versions[conn.alias] = tuple(
+            int(part) for part in version.split(".") if part.isdigit()
+        )
+    return _versions[conn.alias]
+
+
+def note_count(uid) -> int:
+    """how many notes the user has"""
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT count(*) FROM doofer_note WHERE "user" = %s', [uid])
+        return cursor.fetchone()[0]
+
+
+def vector_literal(vector) -> str:
+    """a vector in pgvector's text format"""
+    return "[" + ",".join(repr(float(value)) for value in vector) + "]"
+
+
+def similar_notes(uid, vecs, count: int, threshold: float) -> list[tuple[int, str]]:
+    """(id, title) of the user's notes most similar to the vectors, best first
+    A note scores its best match of title or content against any vector, as
+    in-process scoring does. The indexes cover every user's notes and the
+    user filter applies after them, so a user with few notes in a large
+    table would get few results from them: up to PGVECTOR_EXACT_MAX_NOTES
+    notes are scored exactly instead, and larger libraries scan each index
+    iteratively where pgvector supports it.
+    """
+    count = int(count)
+    queries = [
+        vector_literal(row)
+        for row in stack_embeddings(vecs, DIMS)
+        if row.any()
+    ]
+    if not queries or count <= 0:
+        return []
+    exact = note_count(uid) <= settings.PGVECTOR_EXACT_MAX_NOTES
+    scans, params = [], []
+    for query in queries:
+        for column in COLUMNS:
+            # <#> is the negative inner product, smallest first
+            scan = (
+                f"SELECT id, title, -({column} <#> %s::vector) AS score"
+                f' FROM doofer_note WHERE "user" = %s AND {column} IS NOT NULL'
+            )
+            params += [query, uid]
+            if not exact:
+                scan += f" ORDER BY {column} <#> %s::vector LIMIT %s"
+                params += [query, count]
+            scans.append(f"({scan})")
+    with transaction.atomic(), connection.cursor() as cursor:
+        if not exact:
+            configure_index_scan(cursor, count)
+        cursor.execute(
+            "SELECT id, title FROM (" + " UNION ALL ".join(scans) + ") AS scans"
+            " GROUP BY id, title HAVING max(score) > %s"
+            " ORDER BY max(score) DESC, id LIMIT %s",
+            params + [threshold, count],
+        )
+        return cursor.fetchall()
+
+
+def configure_index_scan(cursor, count: int) -> None:
+    """Set up the index scans of this transaction
+    Each scan looks at PGVECTOR_EF_SEARCH candidates, or 'count' if that is
+    larger. Iterative scans keep going until 'count' of them are the user's.
+    """
+    cursor.execute(
+        "SELECT set_config('hnsw.ef_search', %s, true)",
+        [str(max(int(settings.PGVECTOR_EF_SEARCH), count))],
+    )
+    if extension_version(cursor.db) >= ITERATIVE_SCAN_VERSION:
+        # results are ordered again after the scans, so relaxed order is fine
+        cursor.execute(
+            "SELECT set_config('hnsw.iterative_scan', 'relaxed_order', true)"
+        )
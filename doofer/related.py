@@ -0,0 +1,182 @@
+""" The precomputed graph of related notes
+
+Each note keeps its RELATED_COUNT most similar notes in Note.related, so
+showing them is a single query. When a note changes only its own list and
+the lists it enters or leaves are calculated again.
+"""
+
+# pylint: disable=no-member
+
+from typing import Iterable
+
+import numpy as np
+from django.db import transaction
+from django.db.models import Count, F, Min, Q
+from django.utils import timezone
+
+from doofer.index_cache import get_user_index
+from doofer.models import Note, RelatedNote
+from doofer.search import THRESHOLD, NoteSummaryRecord
+from doofer.similarity import NoteIndex, rank_scores
+
+RELATED_COUNT = 10
+# rows scored against the whole index at once when rebuilding
+ROWS_PER_CHUNK = 128
+
+
+def similarity_rows(index: NoteIndex, rows: np.ndarray) -> np.ndarray:
+    """(rows, notes) best title/content similarity of the rows to every note"""
+    dims = index.dims
+    queries = index.matrix[rows].reshape(-1, dims)
+    scores = queries @ index.matrix.reshape(-1, dims).T
+    scores = scores.reshape(len(rows), 2, len(index), 2).max(axis=(1, 3))
+    # a note is not related to itself
+    scores[np.arange(len(rows)), rows] = -np.inf
+    return scores
+
+
+def neighbours(index: NoteIndex, scores: np.ndarray) -> list[tuple[int, float]]:
+    """(note id, score) of the notes most similar to one row, best first"""
+    best = rank_scores(scores, RELATED_COUNT, THRESHOLD)
+    return [(int(index.ids[row]), float(scores[row])) for row in best]
+
+
+def store_related(
+    lists: dict[int, list[tuple[int, float]]], worst: dict[int, float] | None = None
+) -> None:
+    """replace the related notes of each note id with its list
+    worst -- from worst_scores, kept up to date with the new lists
+    """
+    links = [
+        RelatedNote(from_note_id=note_id, to_note_id=other, score=score, rank=rank)
+        for note_id, related in lists.items()
+        for rank, (other, score) in enumerate(related)
+    ]
+    with transaction.atomic():
+        RelatedNote.objects.filter(from_note__in=list(lists)).delete()
+        RelatedNote.objects.bulk_create(links)
+        # a queryset update, so saving sends no signals
+        Note.objects.filter(id__in=list(lists)).update(
+            related_updated_at=timezone.now()
+        )
+    if worst is not None:
+        for note_id, related in lists.items():
+            if len(related) >= RELATED_COUNT:
+                # lists are best first
+                worst[note_id] = related[-1][1]
+            else:
+                worst.pop(note_id, None)
+
+
+def worst_scores(uid) -> dict[int, float]:
+    """the lowest score in each of a user's full lists, the score a note
+    has to beat to enter it"""
+    lists = (
+        RelatedNote.objects.filter(from_note__user=uid)
+        .values("from_note")
+        .annotate(entries=Count("id"), worst=Min("score"))
+    )
+    return {
+        entry["from_note"]: entry["worst"]
+        for entry in lists
+        if entry["entries"] >= RELATED_COUNT
+    }
+
+
+def recalculate(
+    index: NoteIndex, note_ids: Iterable[int], worst: dict[int, float] | None = None
+) -> None:
+    """calculate the related notes of some of the notes in an index
+    worst -- from worst_scores, kept up to date with the new lists
+    """
+    rows = np.array(
+        sorted(index.rows[note_id] for note_id in note_ids if note_id in index.rows),
+        dtype=np.intp,
+    )
+    for start in range(0, len(rows), ROWS_PER_CHUNK):
+        chunk = rows[start : start + ROWS_PER_CHUNK]
+        scores = similarity_rows(index, chunk)
+        store_related(
+            {
+                int(index.ids[row]): neighbours(index, row_scores)
+                for row, row_scores in zip(chunk, scores)
+            },
+            worst,
+        )
+
+
+def rebuild_related(uid) -> None:
+    """calculate the related notes of every note of a user"""
+    index = get_user_index(uid)
+    if len(index):
+        recalculate(index, index.rows)
+
+
+def update_related(
+    uid,
+    note_id: int,
+    index: NoteIndex | None = None,
+    worst: dict[int, float] | None = None,
+) -> None:
+    """Bring the graph up to date after one note changed
+    The note gets a new list. So does every note that listed it, as it may
+    have dropped out, and every note whose list it now beats.
+    index, worst -- the user's index and worst_scores, read here if not
+        given, so a run over many notes can share them
+    """
+    if index is None:
+        index = get_user_index(uid)
+    if worst is None:
+        worst = worst_scores(uid)
+    affected = set(
+        RelatedNote.objects.filter(to_note=note_id).values_list(
+            "from_note_id", flat=True
+        )
+    )
+    row = index.rows.get(note_id)
+    if row is not None:
+        scores = similarity_rows(index, np.array([row]))[0]
+        store_related({note_id: neighbours(index, scores)}, worst)
+        for other in np.flatnonzero(scores > THRESHOLD):
+            other_id = int(index.ids[other])
+            if scores[other] > worst.get(other_id, THRESHOLD):
+                affected.add(other_id)
+    affected.discard(note_id)
+    recalculate(index, affected, worst)
+
+
+def stale_notes(uid) -> list[int]:
+    """ids of a user's notes changed since their related notes were calculated"""
+    stale = Note.objects.filter(user=uid).filter(
+        Q(related_updated_at__isnull=True)
+        | Q(related_updated_at__lt=F("updated_at"))
+        | Q(related_updated_at__lt=F("embedded_at"))
+    )
+    return list(stale.values_list("id", flat=True))
+
+
+def update_stale_related(uid) -> None:
+    """Update the graph around every note changed since it was last updated
+    When most notes have changed, eg the first time, rebuilding it all is
+    cheaper than following each change.
+    """
+    stale = stale_notes(uid)
+    if not stale:
+        return
+    index = get_user_index(uid)
+    if len(stale) * 2 > len(index):
+        rebuild_related(uid)
+        return
+    worst = worst_scores(uid)
+    for note_id in stale:
+        update_related(uid, note_id, index, worst)
+
+
+def get_related_notes(note_id: int, uid) -> list[NoteSummaryRecord]:
+    """the stored related notes of one of the user's notes, best first"""
+    links = (
+        RelatedNote.objects.filter(from_note=note_id, from_note__user=uid)
+        .order_by("rank")
+        .values_list("to_note_id", "to_note__title")
+    )
+    return [NoteSummaryRecord(str(other), title) for other, title in links]
@@ -2,17 +2,26 @@
 
 # pylint: disable=no-member
 
-from collections import defaultdict
+import asyncio
+import time
 from dataclasses import dataclass
-from doofer.models import Note
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from doofer import pgvector
+from doofer.ann import IVFIndex, ann_enabled, load_user_ann
+from doofer.models import Note, unpack_embedding
+from doofer.pagination import LIST_FIELDS
 from doofer.embeddings import (
-    cosine_similarity,
-    update_note_embeddings,
+    EmbeddingUnavailable,
+    aget_text_embedding,
     get_text_embedding,
+    start_text_embedding,
 )
+from doofer.fulltext import text_search
+from doofer.index_cache import get_user_index, read_stamp
+from doofer.similarity import NoteIndex, embedding_dims, stack_embeddings
 
 THRESHOLD = 0.25
-MAX_CACHE_SIZE = 20
 
 
 @dataclass
@@ -23,12 +32,58 @@ class NoteSummaryRecord:
     title: str
 
 
+@dataclass
+class ApproximateIndex:
+    """a user's approximate index, searched without the exact one"""
+
+    ann: IVFIndex
+    note_count: int
+
+    def __len__(self) -> int:
+        return self.note_count
+
+
+SearchIndex = NoteIndex | ApproximateIndex | None
+
+
+class SearchResults(list):
+    """Search results, best first
+    degraded -- true if similarity search was skipped and only full-text
+        matches are included
+    """
+
+    def __init__(self, results=(), degraded: bool = False):
+        super().__init__(results)
+        self.degraded = degraded
+
+
 def get_my_notes(uid: str) -> list[Note]:
     """Get all notes for current user"""
     notes = list(Note.objects.filter(user=uid))
     return notes
 
 
+def load_result_notes(results: list[NoteSummaryRecord], uid: str) -> list[Note]:
+    """Load the notes of search results for display, in result order
+    Scoring never loads the notes, so the fields the list shows are only
+    fetched here, for the few notes shown.
+    """
+    ids = [int(result.id) for result in results]
+    notes = Note.objects.filter(user=uid).only(*LIST_FIELDS)
+    found = notes.in_bulk(ids)
+    return [found[note_id] for note_id in ids if note_id in found]
+
+
+async def aload_result_notes(
+    results: list[NoteSummaryRecord], uid: str
+) -> list[Note]:
+    """load_result_notes for async views"""
+    ids = [int(result.id) for result in results]
+    notes = Note.objects.filter(user=uid).only(*LIST_FIELDS)
+    found = await notes.ain_bulk(ids)
+    return [found[note_id] for note_id in ids if note_id in found]
+
+
 def get_similar_to_text(text: str, notes: list[Note], count=10):
     """Get notes similar to a text query
     test -- the text to search for
@@ -66,39 +121,26 @@ def vecs_similar_ranked(
     threshold --  the minimum similarity score to return
     Returns ids of most similar notes sorted by similarity
     """
-    similarity_scores: dict[str, float] = defaultdict(float)
-
-    # for a note with embs 'noteVec', calculate the similarity
-    for note in notes:
-        update_note_embeddings(note)
-        for vec in vecs:
-            # for a given note and given embedding, calculate the similarity
-            score = max(
-                cosine_similarity(vec, note.get_title_embeddings()),
-                cosine_similarity(vec, note.get_content_embeddings()),
-            )
-            if abs(score) < 0.0000001:
-                print(f"Similarity score : {score} for {note.id} v. {original_id}")
-
-            # keep the highest score
-            if score > threshold and score > similarity_scores[note.id]:
-                similarity_scores[note.id] = score
-    # Sort score scores in descending order
-    # -> list of [id, score]
-    sorted_scores = sorted(similarity_scores.items(), key=lambda x: x[1], reverse=True)
-
-    # Retrieve the top 'count' notes
-    # -> list of ids
-    ranked_notes = [s[0] for s in sorted_scores[:count]]
-
-    # prepare the return value
-    related: list[NoteSummaryRecord] = []
-    for note_id in ranked_notes:
-        # get the title of the note with id 'id'
-        n = get_note_by_id(notes, str(note_id))
-        if n:
-            related.append(NoteSummaryRecord(str(note_id), n.title))
-    return related
+    if not vecs:
+        return []
+    # unembedded notes still score 0 against the search vectors
+    dims = embedding_dims(notes) or max(len(vec) for vec in vecs) or 1
+    return index_similar_ranked(
+        vecs, NoteIndex.from_notes(notes, dims), count, threshold
+    )
+
+
+def index_similar_ranked(
+    vecs, index: NoteIndex, count=10, threshold=THRESHOLD
+) -> list[NoteSummaryRecord]:
+    """Get the most similar notes in an index to the search vectors
+    One matrix product scores every note against every search vector.
+    Returns ids of most similar notes sorted by similarity
+    """
+    return [
+        NoteSummaryRecord(str(index.ids[row]), index.titles[row])
+        for row in index.ranked(vecs, count, threshold)
+    ]
 
 
 def notes_similar_ranked(
@@ -115,43 +157,190 @@ def notes_similar_ranked(
     )
 
 
-def do_text_search(
-    search_text: str, uid: str, max_results: float = 10
+def get_search_index(uid: str) -> SearchIndex:
+    """The index to search the user's notes with
+    Large libraries use the approximate index once the worker has built it,
+    without loading the exact one. None where pgvector ranks notes in SQL.
+    """
+    if pgvector.enabled():
+        return None
+    stamp = read_stamp(uid)
+    if ann_enabled(stamp.note_count):
+        ann = load_user_ann(uid)
+        if ann is not None:
+            return ApproximateIndex(ann, stamp.note_count)
+    return get_user_index(uid, stamp)
+
+
+def note_count(uid: str, index: SearchIndex) -> int:
+    """how many notes the user has"""
+    if index is None:
+        return Note.objects.filter(user=uid).count()
+    return len(index)
+
+
+def note_query_vectors(note_id: str, uid: str, index: SearchIndex):
+    """a note's unit title and content vectors, None if the user has no such note"""
+    if not str(note_id).isdigit():
+        return None
+    if isinstance(index, NoteIndex):
+        row = index.rows.get(int(note_id))
+        return None if row is None else list(index.matrix[row])
+    embeddings = (
+        Note.objects.filter(id=note_id, user=uid)
+        .values_list("title_embedding", "content_embedding")
+        .first()
+    )
+    return None if embeddings is None else [unpack_embedding(e) for e in embeddings]
+
+
+def vector_search(
+    uid: str, vecs, index: SearchIndex, count=10, threshold=THRESHOLD
+) -> list[NoteSummaryRecord]:
+    """Get the notes most similar to the search vectors
+    index -- from get_search_index, None to rank the notes in SQL
+    The approximate index only holds vectors, so the titles of the notes
+    it finds are read from the database.
+    """
+    if index is None:
+        return [
+            NoteSummaryRecord(str(note_id), title)
+            for note_id, title in pgvector.similar_notes(uid, vecs, count, threshold)
+        ]
+    if isinstance(index, NoteIndex):
+        return index_similar_ranked(vecs, index, count, threshold)
+    if not vecs:
+        return []
+    queries = stack_embeddings(vecs, index.ann.dims)
+    ids, scores = index.ann.search(queries, int(count), settings.ANN_NPROBE)
+    found = [note_id for note_id, score in zip(ids.tolist(), scores) if score > threshold]
+    # notes deleted since the last sync are left out
+    titles = dict(
+        Note.objects.filter(user=uid, id__in=found).values_list("id", "title")
+    )
+    return [
+        NoteSummaryRecord(str(note_id), titles[note_id])
+        for note_id in found
+        if note_id in titles
+    ]
+
+
+def fuse_rankings(
+    rankings: list[tuple[float, list[NoteSummaryRecord]]], count: int, k: int
 ) -> list[NoteSummaryRecord]:
+    """Merge rankings with weighted reciprocal rank fusion
+    rankings -- (weight, notes best first) pairs
+    k -- damping, higher values flatten the gap between the top ranks
+    A ranking with no weight is left out. Each note scores the sum of
+    weight / (k + rank) over the rankings it is in.
+    Returns the top 'count' notes, each once, earlier rankings winning ties
+    """
+    scores: dict[str, float] = {}
+    records: dict[str, NoteSummaryRecord] = {}
+    for weight, ranking in rankings:
+        if weight <= 0:
+            continue
+        for rank, record in enumerate(ranking, 1):
+            scores[record.id] = scores.get(record.id, 0.0) + weight / (k + rank)
+            records.setdefault(record.id, record)
+    # sorted() is stable, so equal scores keep the order they were first seen
+    best = sorted(scores, key=scores.__getitem__, reverse=True)
+    return [records[note_id] for note_id in best[:count]]
+
+
+def do_text_search(
+    search_text: str, uid: str, max_results: float = 10, deadline=None
+) -> SearchResults:
     """
     * search for text in the notes
     searchText --  the text to search for
     maxResults --  the maximum number of results to return
     uid --  the user id
+    deadline -- time.monotonic() by which to answer, SEARCH_DEADLINE from now
+        by default. Without the query's embeddings by then, or while the
+        embedding backend is failing, only full-text matches are returned,
+        flagged as degraded
     Returns  the most similar notes sorted by similarity {id: title}
     """
-    notes = get_my_notes(uid)
-    results: list[NoteSummaryRecord] = []
-
-    if len(notes) == 0 or not search_text:
+    if not search_text:
+        return SearchResults()
+    if deadline is None:
+        deadline = time.monotonic() + settings.SEARCH_DEADLINE
+    count = int(max_results)
+    # the query is embedded while the database is searched
+    text_vector = start_text_embedding(search_text, deadline)
+    index = get_search_index(uid)
+    if note_count(uid, index) == 0:
         print("textSearch - no notes", uid)
-        return results
-
-    # crude text search
-    search_text_lower = search_text.lower()
-    for note in notes:
-        if (
-            search_text_lower in note.title.lower()
-            or search_text_lower in note.comment.lower()
-        ):
-            results.append(NoteSummaryRecord(id=str(note.id), title=note.title))
-
-    # if we still don't have enough results, search for similar notes
-    if len(results) < max_results:
-        search_results = get_similar_to_text(
-            search_text, notes, max_results - len(results)
-        )
-        for result in search_results:
-            # only add if the key not already in the list
-            if not any(note.id == result.id for note in results):
-                results.append(result)
-
-    return results
+        return SearchResults()
+
+    lexical = lexical_search(uid, search_text, count)
+    try:
+        vector = text_vector()
+    except EmbeddingUnavailable as error:
+        print("textSearch - full-text only:", error)
+        return SearchResults(lexical, degraded=True)
+    similar = vector_search(uid, [vector], index, count)
+    return fuse_text_results(lexical, similar, count)
+
+
+async def ado_text_search(
+    search_text: str, uid: str, max_results: float = 10, deadline=None
+) -> SearchResults:
+    """do_text_search for async views
+    The query embedding is awaited while the database is searched, without
+    holding a thread, and scoring runs on a worker thread so the event loop
+    keeps serving other requests.
+    """
+    if not search_text:
+        return SearchResults()
+    if deadline is None:
+        deadline = time.monotonic() + settings.SEARCH_DEADLINE
+    count = int(max_results)
+    embedding = asyncio.ensure_future(aget_text_embedding(search_text, deadline))
+    index = await sync_to_async(get_search_index)(uid)
+    if await sync_to_async(note_count)(uid, index) == 0:
+        print("textSearch - no notes", uid)
+        embedding.cancel()
+        return SearchResults()
+
+    lexical = await sync_to_async(lexical_search)(uid, search_text, count)
+    try:
+        vector = await embedding
+    except EmbeddingUnavailable as error:
+        print("textSearch - full-text only:", error)
+        return SearchResults(lexical, degraded=True)
+    # numpy releases the GIL, so exact scoring on its own thread runs in
+    # parallel, while searches that query the database stay on the thread
+    # with the connection
+    in_memory = isinstance(index, NoteIndex)
+    similar = await sync_to_async(vector_search, thread_sensitive=not in_memory)(
+        uid, [vector], index, count
+    )
+    return fuse_text_results(lexical, similar, count)
+
+
+def lexical_search(uid: str, search_text: str, count: int) -> list[NoteSummaryRecord]:
+    """the user's full-text matches for a search, best first"""
+    return [
+        NoteSummaryRecord(id=str(note_id), title=title)
+        for note_id, title in text_search(uid, search_text, count)
+    ]
+
+
+def fuse_text_results(
+    lexical: list[NoteSummaryRecord], similar: list[NoteSummaryRecord], count: int
+) -> SearchResults:
+    """merge the full-text and similarity rankings of a search"""
+    fused = fuse_rankings(
+        [
+            (settings.SEARCH_LEXICAL_WEIGHT, lexical),
+            (settings.SEARCH_VECTOR_WEIGHT, similar),
+        ],
+        count,
+        settings.SEARCH_RRF_K,
+    )
+    return SearchResults(fused)
 
 
 def do_note_search(
@@ -166,30 +355,24 @@ def do_note_search(
     """
 
     # get the note
-    notes = get_my_notes(uid)
+    index = get_search_index(uid)
     # find the note with note.id == noteId
-    note = get_note_by_id(notes, note_id)
-    if not note:
+    vecs = note_query_vectors(note_id, uid, index)
+    if vecs is None:
         print("noteSearch - note not found", {note_id, uid})
         return []
 
-    # only search if there are text fields
-    if note.title or note.comment:
+    # only search if there are text fields, which will have embeddings
+    if any(vec.any() for vec in vecs):
 
         print("noteSearch - getting related")
-        # we didn't find a valid cache, so search for related notes
 
         # if the user has no other notes, return empty
-        if len(notes) <= 1:
+        if note_count(uid, index) <= 1:
             return []
 
-        # get embeddings for this note
-        note = update_note_embeddings(note)
-
         # get the most similar notes
-        search_results = notes_similar_ranked(
-            note, notes, note_id, max_results, threshold
-        )
+        search_results = vector_search(uid, vecs, index, max_results, threshold)
         return search_results
     # as the note has no text fields, return empty
     return []
@@ -157,6 +157,73 @@ MEDIA_ROOT = BASE_DIR / "doofer" / "media"
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 
+# Embeddings: "huggingface" (hosted API), "local" (in-process CPU model,
+# needs sentence-transformers), "hashing" (deterministic, for tests and
+# benchmarks) or the dotted path of an EmbeddingBackend subclass
+EMBEDDING_BACKEND = config("EMBEDDING_BACKEND", default="huggingface")
+
+# The Hugging Face API client: one pool of keep-alive connections per process,
+# timeouts in seconds, and failed calls retried with jittered exponential
+# backoff starting from EMBEDDING_HTTP_BACKOFF seconds
+HF_API_URL = config(
+    "HF_API_URL",
+    default="https://api-inference.huggingface.co/pipeline/feature-extraction/"
+    "sentence-transformers/all-MiniLM-L6-v2",
+)
+EMBEDDING_HTTP_POOL_SIZE = config("EMBEDDING_HTTP_POOL_SIZE", default=10, cast=int)
+EMBEDDING_HTTP_TIMEOUT = config("EMBEDDING_HTTP_TIMEOUT", default=30.0, cast=float)
+EMBEDDING_HTTP_CONNECT_TIMEOUT = config(
+    "EMBEDDING_HTTP_CONNECT_TIMEOUT", default=5.0, cast=float
+)
+EMBEDDING_HTTP_RETRIES = config("EMBEDDING_HTTP_RETRIES", default=4, cast=int)
+EMBEDDING_HTTP_BACKOFF = config("EMBEDDING_HTTP_BACKOFF", default=0.5, cast=float)
+EMBEDDING_HTTP_BACKOFF_MAX = config(
+    "EMBEDDING_HTTP_BACKOFF_MAX", default=10.0, cast=float
+)
+# after EMBEDDING_BREAKER_FAILURES failed calls in a row the backend is not
+# called for EMBEDDING_BREAKER_RESET seconds, then one call probes it
+EMBEDDING_BREAKER_FAILURES = config("EMBEDDING_BREAKER_FAILURES", default=5, cast=int)
+EMBEDDING_BREAKER_RESET = config("EMBEDDING_BREAKER_RESET", default=30.0, cast=float)
+
+# Approximate nearest neighbour search for users with at least ANN_MIN_NOTES
+# notes, 0 turns it off. Measure the switch-over with manage.py benchmark_ann.
+# ANN_NPROBE is how many clusters each search scores.
+ANN_MIN_NOTES = config("ANN_MIN_NOTES", default=0, cast=int)
+ANN_NPROBE = config("ANN_NPROBE", default=8, cast=int)
+
+# On PostgreSQL with the vector extension similarity search runs in SQL,
+# see doofer.pgvector. VECTOR_SEARCH=python keeps it in-process. The columns
+# hold 384 floats, for all-MiniLM-L6-v2, with HNSW indexes searching
+# PGVECTOR_EF_SEARCH candidates.
+VECTOR_SEARCH = config("VECTOR_SEARCH", default="auto")
+PGVECTOR_EF_SEARCH = config("PGVECTOR_EF_SEARCH", default=100, cast=int)
+# users with at most this many notes are scored exactly, without the index
+PGVECTOR_EXACT_MAX_NOTES = config("PGVECTOR_EXACT_MAX_NOTES", default=10000, cast=int)
+
+# Text search fuses full-text and similarity rankings with reciprocal rank
+# fusion: a note scores weight / (SEARCH_RRF_K + rank) in each ranking.
+SEARCH_LEXICAL_WEIGHT = config("SEARCH_LEXICAL_WEIGHT", default=1.0, cast=float)
+SEARCH_VECTOR_WEIGHT = config("SEARCH_VECTOR_WEIGHT", default=1.0, cast=float)
+SEARCH_RRF_K = config("SEARCH_RRF_K", default=60, cast=int)
+# seconds a text search waits for the query's embeddings before answering
+# from the full-text index alone
+SEARCH_DEADLINE = config("SEARCH_DEADLINE", default=2.0, cast=float)
+
+# notes per page of the list API, and the most a client may ask for
+NOTES_PAGE_SIZE = config("NOTES_PAGE_SIZE", default=100, cast=int)
+NOTES_MAX_PAGE_SIZE = config("NOTES_MAX_PAGE_SIZE", default=1000, cast=int)
+# the most changes in one bulk request
+NOTES_BULK_MAX_ITEMS = config("NOTES_BULK_MAX_ITEMS", default=1000, cast=int)
+# rows fetched at a time when streaming every note
+NOTES_STREAM_CHUNK_SIZE = config("NOTES_STREAM_CHUNK_SIZE", default=500, cast=int)
+# rows of a backup file imported per transaction, and the processes that
+# convert their comments to Markdown, 0 or 1 to convert in the worker
+IMPORT_BATCH_SIZE = config("IMPORT_BATCH_SIZE", default=500, cast=int)
+IMPORT_PROCESSES = config(
+    "IMPORT_PROCESSES", default=min(4, os.cpu_count() or 1), cast=int
+)
+
+
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
         "rest_framework.authentication.TokenAuthentication",
@@ -0,0 +1,107 @@
+""" Model signal handlers """
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from copy import copy
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_delete
+from django.dispatch import receiver
+
+from doofer import fulltext, index_cache
+from doofer.jobs import enqueue
+from doofer.models import Note, RelatedNote
+from doofer.tasks import enqueue_embedding, enqueue_related
+
+# true while a bulk write schedules its own follow-up work, see doofer.bulk
+_suspended = ContextVar("note_receivers_suspended", default=False)
+
+
+@contextmanager
+def suspended():
+    """skip the per-note receivers below, for bulk writes that update the
+    search index and queue jobs once for the whole batch"""
+    token = _suspended.set(True)
+    try:
+        yield
+    finally:
+        _suspended.reset(token)
+
+
+@receiver(post_save, sender=Note)
+def note_saved(sender, instance: Note, **kwargs):
+    """keep the owner's search index in step with the saved note,
+    once the save is committed"""
+    if _suspended.get():
+        return
+    saved = copy(instance)
+    transaction.on_commit(lambda: index_cache.note_saved(saved))
+
+
+@receiver(post_save, sender=Note)
+def schedule_embedding(sender, instance: Note, update_fields=None, **kwargs):
+    """queue a job to embed new or changed text
+    Saves that only write embeddings are skipped, so a failed embedding
+    is retried by its job rather than queued again.
+    """
+    if _suspended.get():
+        return
+    if update_fields and "title_embedding" in update_fields:
+        return
+    if instance.needs_embeddings():
+        enqueue_embedding(instance.user)
+
+
+@receiver(post_delete, sender=Note)
+def note_deleted(sender, instance: Note, **kwargs):
+    """drop the deleted note from the owner's search index, once the
+    delete is committed"""
+    if _suspended.get():
+        return
+    # a copy, as the delete clears the instance's id afterwards
+    deleted = copy(instance)
+    transaction.on_commit(lambda: index_cache.note_deleted(deleted))
+
+
+@receiver(post_save, sender=Note)
+@receiver(post_delete, sender=Note)
+def schedule_ann_sync(sender, instance: Note, **kwargs):
+    """queue an update of the owner's approximate index, if they use one"""
+    if _suspended.get():
+        return
+    if settings.ANN_MIN_NOTES:
+        enqueue("ann_sync", unique=True, user=instance.user)
+
+
+@receiver(post_save, sender=Note)
+def schedule_related(sender, instance: Note, update_fields=None, **kwargs):
+    """queue an update of the related notes graph around the saved note
+    The embedding job queues its own update once it has written a batch.
+    """
+    if _suspended.get():
+        return
+    if update_fields and "title_embedding" in update_fields:
+        return
+    enqueue_related(instance.user)
+
+
+@receiver(pre_delete, sender=Note)
+def schedule_related_refresh(sender, instance: Note, **kwargs):
+    """queue new related notes for the notes that listed a deleted note,
+    read before the delete cascades to the list entries"""
+    if _suspended.get():
+        return
+    listed_by = RelatedNote.objects.filter(to_note=instance).values_list(
+        "from_note_id", flat=True
+    )
+    notes = sorted(set(listed_by))
+    if notes:
+        enqueue("refresh_related", user=instance.user, notes=notes)
+
+
+@receiver(post_migrate)
+def repair_fulltext(sender, using="default", **kwargs):
+    """restore full-text triggers that a migration of doofer_note dropped"""
+    if sender.name == "doofer":
+        fulltext.repair(connections[using])
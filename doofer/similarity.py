@@ -0,0 +1,232 @@
+""" Vectorized similarity scoring for note embeddings """
+
+from typing import Iterator, Protocol, Sequence
+
+import numpy as np
+
+from doofer.models import Note, unpack_embedding
+
+
+class NoteVectors:
+    """The id, title and embeddings of a note: all that scoring needs
+    A light stand-in for Note when building indexes, without the comment,
+    url and timestamps, or the cost of a model instance.
+    """
+
+    FIELDS = ("id", "title", "title_embedding", "content_embedding")
+    __slots__ = FIELDS
+
+    def __init__(self, id_: int, title: str, title_embedding, content_embedding):
+        self.id = id_
+        self.title = title
+        self.title_embedding = title_embedding
+        self.content_embedding = content_embedding
+
+    @property
+    def pk(self) -> int:
+        """the note id, as on a Note"""
+        return self.id
+
+    def title_vector(self) -> np.ndarray:
+        """the unit title embeddings as a read-only float32 array"""
+        return unpack_embedding(self.title_embedding)
+
+    def content_vector(self) -> np.ndarray:
+        """the unit content embeddings as a read-only float32 array"""
+        return unpack_embedding(self.content_embedding)
+
+
+class EmbeddedNote(Protocol):
+    """anything with a note's unit title and content vectors"""
+
+    def title_vector(self) -> np.ndarray: ...
+
+    def content_vector(self) -> np.ndarray: ...
+
+
+def load_note_vectors(notes, chunk_size: int = 2000) -> Iterator[NoteVectors]:
+    """the NoteVectors of a queryset of notes, fetching only their columns"""
+    rows = notes.values_list(*NoteVectors.FIELDS).iterator(chunk_size=chunk_size)
+    for row in rows:
+        yield NoteVectors(*row)
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """scale each row to unit length, leaving all-zero rows as zeros"""
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    return matrix
+
+
+def stack_embeddings(
+    vectors: Sequence[Sequence[float] | np.ndarray], dims: int, normalize: bool = True
+) -> np.ndarray:
+    """stack vectors into a (len(vectors), dims) array of unit rows
+    Vectors that are empty or of a different size become zero rows,
+    so they score 0 against everything, like cosine_similarity does.
+    normalize -- False if the vectors are already unit length
+    """
+    matrix = np.zeros((len(vectors), dims), dtype=np.float32)
+    for row, vector in enumerate(vectors):
+        if len(vector) == dims:
+            matrix[row] = vector
+    return normalize_rows(matrix) if normalize else matrix
+
+
+def embedding_dims(notes: Sequence[EmbeddedNote]) -> int:
+    """the vector size used by a set of notes, 0 if none are embedded"""
+    for note in notes:
+        for vector in (note.title_vector(), note.content_vector()):
+            if vector.size:
+                return vector.size
+    return 0
+
+
+def note_rows(title_vector, content_vector, dims: int) -> np.ndarray:
+    """the (2, dims) title and content rows of one note"""
+    return stack_embeddings([title_vector, content_vector], dims, normalize=False)
+
+
+def stack_note_embeddings(notes: Sequence[EmbeddedNote], dims: int) -> np.ndarray:
+    """stack the title and content embeddings of the notes into one array
+    The result has shape (notes, 2, dims): [i, 0] is the title of notes[i]
+    and [i, 1] its content. Notes store unit vectors, so no scaling is done.
+    """
+    vectors = []
+    for note in notes:
+        vectors += [note.title_vector(), note.content_vector()]
+    matrix = stack_embeddings(vectors, dims, normalize=False)
+    return matrix.reshape(len(notes), 2, dims)
+
+
+def score_matrix(vecs: Sequence[Sequence[float]], matrix: np.ndarray) -> np.ndarray:
+    """best cosine similarity of each note against any of the query vectors
+    vecs -- the query vectors, normalized here once
+    matrix -- unit title and content rows as built by stack_note_embeddings
+    With every row at unit length the cosine is a plain dot product.
+    Returns one score per note
+    """
+    note_count, _, dims = matrix.shape
+    if note_count == 0 or dims == 0 or not vecs:
+        return np.zeros(note_count)
+    queries = stack_embeddings(vecs, dims)
+    # (queries, notes * 2) -> best of title / content -> best of all queries
+    scores = queries @ matrix.reshape(-1, dims).T
+    return scores.reshape(len(vecs), note_count, 2).max(axis=(0, 2))
+
+
+def top_k(scores: np.ndarray, count: int) -> np.ndarray:
+    """indices of the 'count' highest scores, best first
+    Ties keep their original order, matching a stable descending sort,
+    but only the top of the array is ever sorted.
+    """
+    count = int(count)
+    if count <= 0 or scores.size == 0:
+        return np.zeros(0, dtype=np.intp)
+    if count < scores.size:
+        kth = np.partition(scores, scores.size - count)[scores.size - count]
+        candidates = np.flatnonzero(scores >= kth)
+    else:
+        candidates = np.arange(scores.size)
+    order = np.lexsort((candidates, -scores[candidates]))
+    return candidates[order][:count]
+
+
+def rank_scores(scores: np.ndarray, count: int, threshold: float) -> np.ndarray:
+    """indices of the top 'count' scores above the threshold, best first"""
+    passed = np.flatnonzero(scores > threshold)
+    # scores below zero rank as zero, as the unscored default did before
+    best = top_k(np.maximum(scores[passed], 0.0), count)
+    return passed[best]
+
+
+class NoteIndex:
+    """A ready-to-score snapshot of a set of notes
+    ids -- note ids, one per row
+    titles -- note titles, one per row
+    matrix -- (notes, 2, dims) unit title and content vectors
+    Instances are never changed in place: the update methods return a new
+    index, so a search holding the old one always sees consistent rows.
+    """
+
+    def __init__(
+        self, ids: np.ndarray, titles: list[str], matrix: np.ndarray, stamp=None
+    ):
+        self.ids = ids
+        self.titles = titles
+        self.matrix = matrix
+        self.rows = {int(note_id): row for row, note_id in enumerate(ids)}
+        # version of the rows the index was built from, kept by its owner
+        self.stamp = stamp
+
+    @classmethod
+    def from_notes(
+        cls, notes: Sequence[Note] | Sequence[NoteVectors], dims: int
+    ) -> "NoteIndex":
+        """build the index for a list of notes"""
+        ids = np.array([int(note.pk) for note in notes], dtype=np.int64)
+        titles = [str(note.title) for note in notes]
+        return cls(ids, titles, stack_note_embeddings(notes, dims))
+
+    @property
+    def dims(self) -> int:
+        """the vector size of the index"""
+        return self.matrix.shape[2]
+
+    @property
+    def nbytes(self) -> int:
+        """approximate memory used by the index"""
+        titles_size = sum(len(title) for title in self.titles)
+        return self.matrix.nbytes + self.ids.nbytes + titles_size
+
+    def __len__(self) -> int:
+        return len(self.titles)
+
+    def ranked(
+        self, vecs: Sequence[Sequence[float]], count: int, threshold: float
+    ) -> np.ndarray:
+        """rows of the notes most similar to the vectors, best first"""
+        if not vecs:
+            return np.zeros(0, dtype=np.intp)
+        return rank_scores(score_matrix(vecs, self.matrix), count, threshold)
+
+    def upsert(self, note_id: int, title: str, rows: np.ndarray) -> "NoteIndex":
+        """a copy of the index with a note's rows replaced or appended"""
+        return self.upsert_many([note_id], [title], rows[np.newaxis])
+
+    def upsert_many(
+        self, note_ids: Sequence[int], titles: Sequence[str], rows: np.ndarray
+    ) -> "NoteIndex":
+        """a copy of the index with many notes' rows replaced or appended,
+        copying the matrix once
+        rows -- (notes, 2, dims), in the order of note_ids
+        """
+        # the last rows given for a note win
+        latest = {int(note_id): i for i, note_id in enumerate(note_ids)}
+        replaced = {n: i for n, i in latest.items() if n in self.rows}
+        added = [(n, i) for n, i in latest.items() if n not in self.rows]
+        matrix = self.matrix.copy()
+        titles_ = list(self.titles)
+        for note_id, i in replaced.items():
+            matrix[self.rows[note_id]] = rows[i]
+            titles_[self.rows[note_id]] = titles[i]
+        ids = self.ids
+        if added:
+            new = [i for _, i in added]
+            ids = np.append(ids, np.array([n for n, _ in added], dtype=np.int64))
+            matrix = np.concatenate([matrix, rows[new]])
+            titles_ += [titles[i] for i in new]
+        return NoteIndex(ids, titles_, matrix, self.stamp)
+
+    def remove(self, note_id: int) -> "NoteIndex":
+        """a copy of the index without a note"""
+        row = self.rows.get(note_id)
+        if row is None:
+            return self
+        titles = self.titles[:row] + self.titles[row + 1 :]
+        matrix = np.delete(self.matrix, row, axis=0)
+        return NoteIndex(np.delete(self.ids, row), titles, matrix, self.stamp)
+
+    def restamped(self, stamp) -> "NoteIndex":
+        """a copy of the index, sharing its arrays, with a new stamp"""
+        return NoteIndex(self.ids, self.titles, self.matrix, stamp)
@@ -0,0 +1,62 @@
+""" Share one in-flight call among concurrent callers asking for the same thing """
+
+from concurrent.futures import Future
+from threading import Lock
+from typing import Callable, Hashable
+
+
+class SingleFlight:
+    """In-flight calls keyed by what they compute
+    The first caller for a key starts the call, anyone asking for the same
+    key before it finishes gets the same Future. Futures are thread-safe and
+    coroutines can await them with asyncio.wrap_future, so threads and
+    event loops can share a call. Counts calls made and callers coalesced.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._flights: dict[Hashable, Future] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def submit(self, key: Hashable, start: Callable[[], Future]) -> tuple[Future, bool]:
+        """Join the call in flight for a key, or start one with start()
+        Returns the call's Future and true if this caller started it.
+        Exceptions from start() are raised and nothing is left in flight.
+        """
+        with self._lock:
+            future = self._flights.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = start()
+            self._flights[key] = future
+            self.calls += 1
+        future.add_done_callback(lambda done: self._land(key, done))
+        return future, True
+
+    def _land(self, key: Hashable, future: Future) -> None:
+        """forget a finished call, later callers start a new one"""
+        with self._lock:
+            if self._flights.get(key) is future:
+                del self._flights[key]
+
+    def in_flight(self) -> int:
+        """how many calls are running"""
+        with self._lock:
+            return len(self._flights)
+
+    def stats(self) -> dict[str, int | float]:
+        """calls made, callers that shared one, and calls running"""
+        callers = self.calls + self.coalesced
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "coalesced_rate": self.coalesced / callers if callers else 0.0,
+            "in_flight": self.in_flight(),
+        }
+
+    def clear(self) -> None:
+        """reset the counts, calls in flight still finish"""
+        with self._lock:
+            self.calls = self.coalesced = 0
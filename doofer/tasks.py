@@ -0,0 +1,93 @@
+""" Background job handlers """
+
+# pylint: disable=no-member
+
+from django.conf import settings
+from django.db.models import Q
+
+from doofer.ann import sync_user_ann
+from doofer.backup import import_notes
+from doofer.embeddings import update_notes_embeddings
+from doofer.index_cache import get_user_index
+from doofer.jobs import enqueue, job_handler
+from doofer.models import Note
+from doofer.related import recalculate, update_stale_related
+
+# notes embedded per batch by the embedding jobs
+CHUNK_SIZE = 500
+
+MISSING_EMBEDDINGS = (~Q(title="") & Q(title_embedding=b"")) | (
+    ~Q(comment="") & Q(content_embedding=b"")
+)
+
+
+def enqueue_embedding(user: int):
+    """schedule embedding of a user's notes, unless already scheduled"""
+    return enqueue("embed_missing", unique=True, user=user)
+
+
+def enqueue_related(user: int):
+    """schedule an update of a user's related notes, unless already scheduled"""
+    return enqueue("update_related", unique=True, user=user)
+
+
+@job_handler("embed_missing")
+def embed_missing(user: int) -> None:
+    """calculate every missing embedding of a user's notes"""
+    notes = Note.objects.filter(user=user).filter(MISSING_EMBEDDINGS)
+    chunk: list[Note] = []
+    for note in notes.iterator(chunk_size=CHUNK_SIZE):
+        chunk.append(note)
+        if len(chunk) == CHUNK_SIZE:
+            update_notes_embeddings(chunk)
+            chunk = []
+    update_notes_embeddings(chunk)
+    # new embeddings move notes in the related notes graph
+    enqueue_related(user)
+    # failed embeddings are left empty, fail the job so it is retried
+    remaining = Note.objects.filter(user=user).filter(MISSING_EMBEDDINGS).count()
+    if remaining:
+        raise RuntimeError(f"{remaining} notes of user {user} still need embeddings")
+
+
+@job_handler("reembed")
+def reembed(user: int) -> None:
+    """throw away and recalculate all of a user's embeddings,
+    eg after changing the embedding backend"""
+    Note.objects.filter(user=user).update(
+        title_embedding=b"",
+        title_embedding_norm=None,
+        content_embedding=b"",
+        content_embedding_norm=None,
+        embedded_at=None,
+    )
+    embed_missing(user)
+
+
+@job_handler("ann_sync")
+def ann_sync(user: int) -> None:
+    """update the approximate nearest neighbour index of a user"""
+    sync_user_ann(user)
+
+
+@job_handler("update_related")
+def update_related(user: int) -> None:
+    """update the related notes graph around a user's changed notes"""
+    update_stale_related(user)
+
+
+@job_handler("refresh_related")
+def refresh_related(user: int, notes: list[int]) -> None:
+    """calculate the related notes of some notes again,
+    eg those that listed a deleted note"""
+    recalculate(get_user_index(user), notes)
+
+
+@job_handler("import_notes")
+def import_backup(note_import: int) -> None:
+    """import an uploaded backup file, then embed and relate the new notes"""
+    user = import_notes(note_import)
+    enqueue_embedding(user)
+    enqueue_related(user)
+    if settings.ANN_MIN_NOTES:
+        enqueue("ann_sync", unique=True, user=user)
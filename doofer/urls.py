@@ -29,8 +29,10 @@ urlpatterns = [
     path("logout/", auth_views.logout_user, name="logout"),
     path("register/", auth_views.register_user, name="logout"),
     path("profile/", auth_views.profile, name="profile"),
+    path("profile/imports", auth_views.import_progress, name="import_progress"),
     path("note/<int:id_>/edit", core_views.note_edit, name="note_edit"),
     path("note/<int:id_>/", core_views.note_details, name="note_details"),
+    path("note/<int:id_>/related", core_views.note_related, name="note_related"),
     path("search/", core_views.search, name="search"),
     path("admin/", admin.site.urls),
     path("api/", include("doofer.api.urls")),
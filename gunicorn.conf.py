@@ -0,0 +1,21 @@
+""" Gunicorn settings for serving the ASGI application with Uvicorn workers """
+
+import os
+
+# each worker runs an event loop, so one process serves many requests that
+# are waiting on the database or the embedding API
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+
+# Heroku's router gives up after 30 seconds, searches answer within
+# SEARCH_DEADLINE so this only catches stuck workers
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+graceful_timeout = 20
+keepalive = 5
+
+# restart workers now and then to cap memory growth from the index caches
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 1000))
+max_requests_jitter = 100
+
+accesslog = "-"
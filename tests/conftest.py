@@ -1,6 +1,20 @@
+import pytest
 from pytest_factoryboy import register
 
+from doofer.embedding_cache import embedding_cache
+from doofer.embeddings import embedding_breaker, embedding_flights
+from doofer.index_cache import index_cache
+
 import factories
 
 register(factories.UserFactory)
 register(factories.NoteFactory)
+
+
+@pytest.fixture(autouse=True)
+def clear_process_caches():
+    """caches are per process, don't let them leak between tests"""
+    index_cache.clear()
+    embedding_cache.clear()
+    embedding_breaker.reset()
+    embedding_flights.clear()
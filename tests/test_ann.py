@@ -0,0 +1,171 @@
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+from django.test import override_settings
+from django.utils import timezone
+
+from doofer import ann, search
+from doofer.ann import IVFIndex, load_user_ann, sync_user_ann
+from doofer.models import AnnIndex, AnnSegment
+from doofer.search import do_note_search
+from doofer.similarity import normalize_rows
+
+from fixtures import user_1, note_1, note_2, note_3
+
+
+def clustered(count, dims=16, clusters=64, seed=0):
+    rng = np.random.default_rng(seed)
+    topics = normalize_rows(rng.standard_normal((clusters, dims)))
+    centres = topics[rng.integers(clusters, size=count)]
+    noise = rng.standard_normal((count, dims)) * 0.05
+    return normalize_rows((centres + noise).astype(np.float32))
+
+
+def exact_top(vectors, query, count):
+    return set(np.argsort(-(vectors @ query))[:count].tolist())
+
+
+def test_search_recall():
+    vectors = clustered(2000)
+    index = IVFIndex.build(np.arange(2000), vectors)
+    recalls = []
+    for query in vectors[:50]:
+        ids, scores = index.search(query[np.newaxis], 10, nprobe=8)
+        assert list(scores) == sorted(scores, reverse=True)
+        recalls.append(len(exact_top(vectors, query, 10) & set(ids.tolist())) / 10)
+    assert np.mean(recalls) > 0.9
+
+
+def test_search_returns_each_note_once():
+    vectors = clustered(20)
+    # two rows per note, like a title and a content
+    index = IVFIndex.build(np.repeat(np.arange(10), 2), vectors)
+    ids, _ = index.search(vectors[:1], 10, nprobe=20)
+    assert sorted(ids.tolist()) == list(range(10))
+
+
+def test_add_remove_and_compact():
+    vectors = clustered(100)
+    index = IVFIndex.build(np.arange(100), vectors)
+    index.remove([0, 1])
+    # an update replaces the old row with a tombstone
+    index.add(np.array([2]), vectors[50:51])
+    assert index.live_rows == 98
+    ids, _ = index.search(vectors[:1], 100, nprobe=100)
+    assert not {0, 1} & set(ids.tolist())
+    ids, _ = index.search(vectors[50:51], 2, nprobe=100)
+    assert set(ids.tolist()) == {2, 50}
+
+    index.remove(range(3, 30))
+    assert index.needs_compaction()
+    compacted = index.compact()
+    assert len(compacted.ids) == compacted.live_rows == 71
+    assert not compacted.needs_compaction()
+
+
+def test_add_other_dims_rebuilds():
+    index = IVFIndex.build(np.arange(50), clustered(50))
+    index.meta["synced_at"] = "2024-01-01T00:00:00+00:00"
+    vectors = clustered(10, dims=8, clusters=4)
+    index.add(np.arange(10), vectors)
+    assert index.dims == 8
+    assert index.live_rows == 10
+    assert index.meta["synced_at"] == "2024-01-01T00:00:00+00:00"
+    ids, _ = index.search(vectors[:1], 10, nprobe=10)
+    assert sorted(ids.tolist()) == list(range(10))
+
+
+def test_centroids_and_segments_round_trip():
+    vectors = clustered(50)
+    index = IVFIndex.build(np.arange(50), vectors)
+    loaded = IVFIndex.from_centroid_bytes(index.centroid_bytes())
+    loaded.apply_segment(index.segment_bytes(()))
+    expected = index.search(vectors[:1], 5, 2)[0]
+    assert np.array_equal(loaded.search(vectors[:1], 5, 2)[0], expected)
+
+    # a segment carries the rows added and the notes removed since 'start'
+    start = len(index.ids)
+    index.remove([3, 4])
+    index.add(np.array([5]), vectors[:1])
+    loaded.apply_segment(index.segment_bytes([3, 4, 5], start))
+    assert loaded.id_rows == index.id_rows
+    expected = index.search(vectors[:1], 5, 2)[0]
+    assert np.array_equal(loaded.search(vectors[:1], 5, 2)[0], expected)
+
+
+def test_loaded_indexes_are_bounded(monkeypatch):
+    monkeypatch.setattr(ann, "_loaded", OrderedDict())
+    monkeypatch.setattr(ann, "MAX_LOADED_USERS", 2)
+    index = IVFIndex.build(np.arange(50), clustered(50))
+    monkeypatch.setattr(ann, "MAX_LOADED_BYTES", 2 * index.nbytes)
+    for uid in range(3):
+        ann.remember_ann(uid, ann.LoadedAnn(timezone.now(), 0, index))
+    assert list(ann._loaded) == ["1", "2"]  # pylint: disable=protected-access
+
+    big = IVFIndex.build(np.arange(100), clustered(100))
+    ann.remember_ann(3, ann.LoadedAnn(timezone.now(), 0, big))
+    assert list(ann._loaded) == ["3"]  # pylint: disable=protected-access
+
+
+def embed(note, title, content):
+    note.set_title_embeddings(title)
+    note.set_content_embeddings(content)
+    note.save()
+
+
+@pytest.mark.django_db
+def test_sync_user_ann(user_1, note_1, note_2, note_3, monkeypatch):
+    # a library this small would be compacted by any change
+    monkeypatch.setattr(ann, "COMPACT_DEAD_FRACTION", 0.5)
+    with override_settings(ANN_MIN_NOTES=3):
+        embed(note_1, [1.0, 0.0], [0.0, 1.0])
+        embed(note_2, [1.0, 1.0], [1.0, 0.0])
+        embed(note_3, [0.0, 1.0], [0.0, 1.0])
+        index = sync_user_ann(user_1.id)
+        assert set(index.id_rows) == {note_1.id, note_2.id, note_3.id}
+        # web processes load what the worker stored
+        assert set(load_user_ann(user_1.id).id_rows) == set(index.id_rows)
+
+        centroids = bytes(AnnIndex.objects.get(user=user_1.id).data)
+        embed(note_3, [-1.0, 0.0], [-1.0, 0.0])
+        index = sync_user_ann(user_1.id)
+        ids, _ = index.search(np.array([[-1.0, 0.0]], dtype=np.float32), 1, 8)
+        assert ids.tolist() == [note_3.id]
+        # the change is appended, the centroids are not written again
+        assert AnnSegment.objects.filter(user=user_1.id).count() == 2
+        assert bytes(AnnIndex.objects.get(user=user_1.id).data) == centroids
+        # another process reads the stored parts into the same index
+        ann.remember_ann(user_1.id, None)
+        loaded = load_user_ann(user_1.id)
+        assert loaded.id_rows == index.id_rows
+        ids, _ = loaded.search(np.array([[-1.0, 0.0]], dtype=np.float32), 1, 8)
+        assert ids.tolist() == [note_3.id]
+
+        # with too many segments the index is written whole again
+        monkeypatch.setattr(ann, "MAX_SEGMENTS", 2)
+        embed(note_2, [0.0, -1.0], [0.0, -1.0])
+        index = sync_user_ann(user_1.id)
+        assert AnnSegment.objects.filter(user=user_1.id).count() == 1
+        assert index.live_rows == len(index.ids) == 6
+        assert load_user_ann(user_1.id).id_rows == index.id_rows
+
+        # below the threshold the index is dropped
+        note_3.delete()
+        assert sync_user_ann(user_1.id) is None
+        assert load_user_ann(user_1.id) is None
+
+
+@pytest.mark.django_db
+def test_note_search_uses_ann(user_1, note_1, note_2, note_3, monkeypatch):
+    with override_settings(ANN_MIN_NOTES=3):
+        embed(note_1, [1.0, 0.0], [1.0, 0.0])
+        embed(note_2, [0.9, 0.1], [0.9, 0.1])
+        embed(note_3, [0.0, 1.0], [0.0, 1.0])
+        sync_user_ann(user_1.id)
+        # the exact index is never built
+        monkeypatch.setattr(search, "get_user_index", None)
+        # the exact index sees this at once, the approximate one after a sync
+        embed(note_3, [1.0, 0.0], [1.0, 0.0])
+        results = do_note_search(note_1.id, 10, user_1.id)
+        assert [int(result.id) for result in results] == [note_1.id, note_2.id]
@@ -1,8 +1,13 @@
+import json
+from datetime import timedelta
+
 import pytest
+from asgiref.sync import async_to_sync
 from rest_framework import status
 from rest_framework.test import APIRequestFactory, force_authenticate
-from doofer.api.views import get_notes, note_create, note_detail
-from doofer.models import Note
+from doofer.api.views import get_notes, note_create, note_detail, notes_bulk
+from doofer.jobs import run_pending
+from doofer.models import Job, Note
 
 from fixtures import user_1, note_1, note_2
 
@@ -12,10 +17,10 @@ def test_get_notes(user_1, note_1, note_2):
     request = factory.get(f"/api/notes/")
     force_authenticate(request, user=user_1)
 
-    response = get_notes(request)  # Pass pk argument for detail view
+    response = async_to_sync(get_notes)(request)  # Pass pk argument for detail view
 
     assert response.status_code == status.HTTP_200_OK
-    ids = [n.get("id") for n in response.data]
+    ids = [n.get("id") for n in response.data["results"]]
     assert note_1.id in ids
     assert note_2.id in ids
 
@@ -24,7 +29,7 @@ def test_get_note_detail(note_1, user_1):
     request = APIRequestFactory().get(f"/api/notes/{note_1.id}/")
     force_authenticate(request, user=user_1)
 
-    response = note_detail(request, id_=note_1.id)  # Pass pk argument for detail view
+    response = async_to_sync(note_detail)(request, id_=note_1.id)  # Pass pk argument for detail view
     assert response.status_code == status.HTTP_200_OK
     assert response.data["title"] == note_1.title
 
@@ -34,7 +39,7 @@ def test_create_note(user_1):
     data = {"title": "Test Note 3", "comment": "This is a new test note."}
     request = APIRequestFactory().post("/api/notes/", data=data)
     force_authenticate(request, user=user_1)
-    response = note_create(request)  # Pass pk argument for detail view
+    response = async_to_sync(note_create)(request)  # Pass pk argument for detail view
     assert response.status_code == status.HTTP_201_CREATED
     assert response.data["title"] == "Test Note 3"
 
@@ -43,11 +48,11 @@ def test_update_note(user_1, note_1):
     data = {"title": "Updated Note", "comment": "This is an updated test note."}
     request = APIRequestFactory().put(f"/api/notes/{note_1.id}/", data=data)
 
-    response = note_detail(request, id_=note_1.id)  # Pass pk argument for detail view
+    response = async_to_sync(note_detail)(request, id_=note_1.id)  # Pass pk argument for detail view
     assert response.status_code >= 400
 
     force_authenticate(request, user=user_1)
-    response = note_detail(request, id_=note_1.id)  # Pass pk argument for detail view
+    response = async_to_sync(note_detail)(request, id_=note_1.id)  # Pass pk argument for detail view
     assert response.status_code == status.HTTP_200_OK
     assert response.data["title"] == data["title"]
 
@@ -59,15 +64,194 @@ def test_delete_note(user_1):
     request = APIRequestFactory().delete(f"/api/notes/{note.id}/")
 
     # call the api unauthorized user
-    response = note_detail(request, id_=note.id)  # Pass pk argument for detail view
+    response = async_to_sync(note_detail)(request, id_=note.id)  # Pass pk argument for detail view
     assert response.status_code >= 400
 
     # now call the api with authorized user
     force_authenticate(request, user=user_1)
-    response = note_detail(request, id_=note.id)  # Pass pk argument for detail view
+    response = async_to_sync(note_detail)(request, id_=note.id)  # Pass pk argument for detail view
 
     assert response.status_code == status.HTTP_204_NO_CONTENT
 
     with pytest.raises(Note.DoesNotExist) as exc_info:
         Note.objects.get(id=note.id)
     assert str(exc_info.value) == "Note matching query does not exist."
+
+
+def get_page(view, user, url):
+    request = APIRequestFactory().get(url)
+    force_authenticate(request, user=user)
+    return async_to_sync(view)(request)
+
+
+@pytest.mark.django_db
+def test_get_notes_pages(user_1):
+    notes = [Note.objects.create(user=user_1.id, title=f"note {i}") for i in range(5)]
+    Note.objects.create(user=user_1.id + 1, title="someone else's")
+    # touching a note moves it to the front
+    notes[0].save()
+
+    seen, url = [], "/api/?page_size=2"
+    while url:
+        response = get_page(get_notes, user_1, url)
+        assert response.status_code == status.HTTP_200_OK
+        assert len(response.data["results"]) <= 2
+        seen += [note["id"] for note in response.data["results"]]
+        url = response.data["next"]
+    assert seen == [notes[0].id] + [note.id for note in reversed(notes[1:])]
+
+    response = get_page(get_notes, user_1, "/api/?cursor=nonsense")
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.django_db
+def test_get_notes_streams(user_1):
+    for i in range(3):
+        Note.objects.create(user=user_1.id, title=f"note {i}")
+    # another user's notes are left out
+    Note.objects.create(user=user_1.id + 1, title="not mine")
+    response = get_page(get_notes, None, "/api/?stream=true")
+    assert response.status_code in (401, 403)
+    response = get_page(get_notes, user_1, "/api/?stream=true")
+    assert response.streaming
+
+    async def read():
+        return b"".join([part async for part in response.streaming_content])
+
+    notes = json.loads(async_to_sync(read)())
+    assert [note["title"] for note in notes] == ["note 2", "note 1", "note 0"]
+    assert notes[0]["related"] == []
+
+
+@pytest.mark.django_db
+def test_conditional_get(user_1, note_1):
+    def get(view, url, **headers):
+        request = APIRequestFactory().get(url, headers=headers)
+        force_authenticate(request, user=user_1)
+        kwargs = {"id_": note_1.id} if view is note_detail else {}
+        return async_to_sync(view)(request, **kwargs)
+
+    response = get(note_detail, "/api/note/1/")
+    etag = response["ETag"]
+    assert response.status_code == status.HTTP_200_OK and response["Last-Modified"]
+    response = get(note_detail, "/api/note/1/", if_none_match=etag)
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    assert response["ETag"] == etag
+    response = get(
+        note_detail, "/api/note/1/", if_modified_since=response["Last-Modified"]
+    )
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+    response = get(get_notes, "/api/")
+    list_etag = response["ETag"]
+    # deletes don't change the latest change, so lists have no Last-Modified
+    assert not response.has_header("Last-Modified")
+    assert get(get_notes, "/api/", if_none_match=list_etag).status_code == 304
+    # the CSRF cookie is not part of the ETag
+    request = APIRequestFactory().get("/api/", headers={"if-none-match": list_etag})
+    request.COOKIES["csrftoken"] = "rotated"
+    force_authenticate(request, user=user_1)
+    assert async_to_sync(get_notes)(request).status_code == 304
+    response = get(get_notes, "/api/?page_size=1", if_none_match=list_etag)
+    assert response.status_code == 200
+
+    note_1.title = "changed"
+    note_1.save()
+    assert get(note_detail, "/api/note/1/", if_none_match=etag).status_code == 200
+    assert get(get_notes, "/api/", if_none_match=list_etag).status_code == 200
+
+    # deleting a note changes the list even though no note is newer
+    old = Note.objects.create(user=user_1.id, title="old")
+    Note.objects.filter(id=old.id).update(
+        updated_at=note_1.updated_at - timedelta(days=1)
+    )
+    list_etag = get(get_notes, "/api/")["ETag"]
+    old.delete()
+    assert get(get_notes, "/api/", if_none_match=list_etag).status_code == 200
+
+    # another user's note looks the same as a missing one
+    other = Note.objects.create(user=user_1.id + 1, title="not mine")
+    request = APIRequestFactory().get(f"/api/note/{other.id}/")
+    force_authenticate(request, user=user_1)
+    response = async_to_sync(note_detail)(request, id_=other.id)
+    assert response.status_code == 404 and not response.has_header("ETag")
+
+
+def post_bulk(user, data):
+    request = APIRequestFactory().post("/api/note/bulk/", data=data, format="json")
+    force_authenticate(request, user=user)
+    return async_to_sync(notes_bulk)(request)
+
+
+@pytest.mark.django_db
+def test_bulk_changes(user_1, django_assert_max_num_queries):
+    kept, edited, gone = (
+        Note.objects.create(user=user_1.id, title=title)
+        for title in ("kept", "edited", "gone")
+    )
+    others = Note.objects.create(user=user_1.id + 1, title="someone else's")
+    run_pending()
+    Job.objects.all().delete()
+    data = {
+        "create": [{"title": f"new {i}", "comment": "text"} for i in range(50)],
+        "update": [
+            {"id": edited.id, "title": "changed", "comment": "*new*"},
+            {"id": others.id},
+        ],
+        "delete": [gone.id, 999],
+    }
+    # the same handful of queries however many notes are in the batch
+    with django_assert_max_num_queries(16):
+        response = post_bulk(user_1, data)
+    assert response.status_code == status.HTTP_200_OK
+    assert [r["status"] for r in response.data["create"]] == [201] * 50
+    created = Note.objects.filter(id__in=[r["id"] for r in response.data["create"]])
+    assert sorted(note.title for note in created) == sorted(
+        f"new {i}" for i in range(50)
+    )
+    assert all(note.comment_html == "<p>text</p>" for note in created)
+    assert response.data["update"] == [
+        {"id": edited.id, "status": 200},
+        {"id": others.id, "status": 404},
+    ]
+    assert response.data["delete"] == [
+        {"id": gone.id, "status": 204},
+        {"id": 999, "status": 404},
+    ]
+
+    edited.refresh_from_db()
+    assert edited.title == "changed" and not edited.title_embedding
+    assert edited.comment_html == edited.preview_html == "<p><em>new</em></p>"
+    assert not Note.objects.filter(id=gone.id).exists()
+    # one job embeds the whole batch
+    assert Job.objects.filter(kind="embed_missing").count() == 1
+    run_pending()
+    assert not Note.objects.filter(user=user_1.id, title_embedding=b"").exists()
+
+
+@pytest.mark.django_db
+def test_bulk_create_renders_like_create(user_1):
+    data = {
+        "title": "video",
+        "comment": "*line 1*\nline 2\nline 3\nline 4\nline 5",
+        "url": "https://www.youtube.com/watch?v=abc123",
+    }
+    request = APIRequestFactory().post("/api/notes/", data=data)
+    force_authenticate(request, user=user_1)
+    single = Note.objects.get(id=async_to_sync(note_create)(request).data["id"])
+    bulk = Note.objects.get(id=post_bulk(user_1, {"create": [data]}).data["create"][0]["id"])
+
+    assert bulk.comment_html == single.comment_html != ""
+    assert bulk.preview_html == single.preview_html != ""
+    assert bulk.thumbnail_url == single.thumbnail_url != ""
+
+
+@pytest.mark.django_db
+def test_bulk_rejects_invalid_batch(user_1):
+    data = {"create": [{"title": "fine"}, {"url": "not a url"}], "delete": ["x"]}
+    response = post_bulk(user_1, data)
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert response.data["create"][0] == {}
+    assert "url" in response.data["create"][1]
+    assert "delete" in response.data
+    assert not Note.objects.exists()
@@ -0,0 +1,177 @@
+import gzip
+import json
+import re
+from datetime import datetime, timezone
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import override_settings
+from markdownify import markdownify  # type: ignore[import-untyped]
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from doofer.api.views import export_notes
+
+from doofer import backup
+from doofer.backup import start_import, text_lines
+from doofer.jobs import run_pending
+from doofer.models import ImportChunk, Job, Note, NoteImport
+
+from fixtures import user_1
+
+BACKUP = (
+    "﻿id,title,comment,snippet,url,created\n"
+    '1,Café,"<p>first line</p>\n<p>second line</p>",,https://a.com,'
+    "2023-06-16  18:14:17.000\n"
+    "2,Second,<b>bold</b>,a snippet,https://b.com,null\n"
+    "3,missing columns\n"
+    "4,Bad date,comment,,https://c.com,16/06/2023 18:14\n"
+    "5,Last,no newline at the end,,https://d.com,\n"
+).encode()
+
+
+def upload(data=BACKUP):
+    return SimpleUploadedFile("backup.csv", data, content_type="text/csv")
+
+
+def test_text_lines_joins_split_characters_and_lines():
+    data = "é1\nsecond é\nlast".encode()
+    # every split point, including inside the two-byte é
+    for split in range(len(data)):
+        chunks = [data[:split], data[split:]]
+        assert list(text_lines(chunks)) == ["é1\n", "second é\n", "last"]
+
+
+@pytest.mark.django_db
+@override_settings(IMPORT_PROCESSES=0, IMPORT_BATCH_SIZE=2)
+def test_import_in_the_background(user_1):
+    # small chunks split the é and the quoted multiline comment
+    note_import = start_import(user_1.id, upload(), chunk_size=7)
+    assert ImportChunk.objects.filter(note_import=note_import).count() > 10
+    assert not Note.objects.exists()
+
+    run_pending()
+    note_import.refresh_from_db()
+    assert note_import.status == Job.DONE
+    assert (note_import.rows, note_import.imported, note_import.failed) == (5, 3, 2)
+    assert not ImportChunk.objects.exists()
+
+    notes = {note.title: note for note in Note.objects.filter(user=user_1.id)}
+    assert set(notes) == {"Café", "Second", "Last"}
+    assert notes["Café"].comment == markdownify("<p>first line</p>\n<p>second line</p>")
+    assert notes["Café"].created_at == datetime(2023, 6, 16, 18, 14, 17, tzinfo=timezone.utc)
+    assert notes["Second"].comment == "**bold**From page:  \na snippet"
+    assert notes["Last"].url == "https://d.com"
+    assert notes["Second"].comment_html.startswith("<p><strong>bold</strong>")
+    # the import queued the embeddings, which have run since
+    assert Job.objects.filter(kind="embed_missing", status=Job.DONE).exists()
+    assert all(note.title_embedding for note in notes.values())
+
+
+@pytest.mark.django_db
+@override_settings(IMPORT_PROCESSES=0, IMPORT_BATCH_SIZE=2)
+def test_retried_import_skips_committed_rows(user_1, monkeypatch):
+    note_import = start_import(user_1.id, upload())
+    import_batch = backup.import_batch
+    batches = []
+
+    def crash_on_second_batch(*args):
+        batches.append(args)
+        if len(batches) == 2:
+            raise RuntimeError("worker died")
+        import_batch(*args)
+
+    monkeypatch.setattr(backup, "import_batch", crash_on_second_batch)
+    assert run_pending(limit=1) == 1
+    note_import.refresh_from_db()
+    assert note_import.status == Job.PENDING
+    assert note_import.rows == 2 and "worker died" in note_import.error
+
+    monkeypatch.setattr(backup, "import_batch", import_batch)
+    Job.objects.filter(kind="import_notes").update(run_after=note_import.created_at)
+    run_pending()
+    note_import.refresh_from_db()
+    assert note_import.status == Job.DONE
+    assert note_import.imported == 3
+    assert Note.objects.filter(user=user_1.id).count() == 3
+
+
+@pytest.mark.django_db(transaction=True)
+@override_settings(IMPORT_PROCESSES=2)
+def test_import_converts_in_a_process_pool(user_1):
+    note_import = start_import(user_1.id, upload())
+    backup.import_notes(note_import.id)
+    assert NoteImport.objects.get(id=note_import.id).imported == 3
+    assert Note.objects.get(title="Second").comment.startswith("**bold**")
+
+
+def export(user, extension):
+    request = APIRequestFactory().get(f"/api/notes.{extension}")
+    force_authenticate(request, user=user)
+    response = async_to_sync(export_notes)(request, extension=extension)
+    assert response.streaming
+    assert f'filename="notes.{extension}"' in response["Content-Disposition"]
+
+    async def read():
+        return b"".join([part async for part in response.streaming_content])
+
+    return async_to_sync(read)()
+
+
+@pytest.mark.django_db
+@override_settings(IMPORT_PROCESSES=0, NOTES_STREAM_CHUNK_SIZE=2)
+def test_export_csv_imports_back(user_1):
+    Note.objects.create(user=user_1.id, title="First", comment="**bold**\n\nmore")
+    Note.objects.create(user=user_1.id, title="Second, quoted", url="https://a.com")
+    Note.objects.create(user=user_1.id + 1, title="someone else's")
+    created = list(Note.objects.filter(user=user_1.id).order_by("created_at", "id"))
+
+    data = export(user_1, "csv")
+    assert data.decode().startswith("id,title,comment,snippet,url,created\r\n")
+
+    Note.objects.filter(user=user_1.id).delete()
+    start_import(user_1.id, upload(data))
+    run_pending()
+    imported = list(Note.objects.filter(user=user_1.id).order_by("created_at", "id"))
+    # comments come back as the same Markdown, give or take blank lines
+    assert [(n.title, n.comment.split(), n.url) for n in imported] == [
+        (n.title, n.comment.split(), n.url) for n in created
+    ]
+    assert [n.created_at for n in imported] == [n.created_at for n in created]
+
+
+@pytest.mark.django_db
+@override_settings(NOTES_STREAM_CHUNK_SIZE=2)
+def test_export_jsonl_gz(user_1):
+    for i in range(5):
+        Note.objects.create(user=user_1.id, title=f"note {i}")
+    lines = gzip.decompress(export(user_1, "jsonl.gz")).decode().splitlines()
+    notes = [json.loads(line) for line in lines]
+    assert [note["title"] for note in notes] == [f"note {i}" for i in range(5)]
+    assert set(notes[0]) == {"id", "title", "comment", "url", "created_at", "updated_at"}
+
+
+@pytest.mark.django_db
+@override_settings(
+    STORAGES={
+        "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+        # the page's stylesheet isn't built for the tests
+        "staticfiles": {
+            "BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"
+        },
+    }
+)
+def test_profile_page_downloads_a_backup(client, user_1):
+    Note.objects.create(user=user_1.id, title="First")
+    assert client.get("/api/notes.csv").status_code in (401, 403)
+
+    client.force_login(user_1)
+    page = client.get("/profile/").content.decode()
+    link = re.search(r'href="([^"]+)"[^>]*>Download a backup file', page).group(1)
+    response = client.get(link)
+    assert response.status_code == 200
+
+    async def read():
+        return b"".join([part async for part in response.streaming_content])
+
+    assert b"First" in async_to_sync(read)()
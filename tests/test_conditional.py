@@ -0,0 +1,29 @@
+import pytest
+from django.test import RequestFactory
+
+from doofer.conditional import user_notes_validators
+from doofer.doofer.views.views import index
+from doofer.models import Note
+
+from fixtures import user_1, note_1
+
+
+@pytest.mark.django_db
+def test_index_not_modified(user_1, note_1, django_assert_num_queries):
+    request = RequestFactory().get("/")
+    request.user = user_1
+    etag, modified = user_notes_validators(request)
+
+    request = RequestFactory().get("/", headers={"if-none-match": etag})
+    request.user = user_1
+    # one aggregate query and no notes loaded or rendered
+    with django_assert_num_queries(1):
+        response = index(request)
+    assert response.status_code == 304
+    assert response["ETag"] == etag
+
+    Note.objects.create(user=user_1.id, title="another")
+    assert user_notes_validators(request)[0] != etag
+    # other users' pages have their own validators
+    request.user = type(user_1).objects.create(username="user_2")
+    assert user_notes_validators(request)[0] != etag
@@ -0,0 +1,37 @@
+import pytest
+from django.core.exceptions import ImproperlyConfigured
+from django.test import override_settings
+
+from doofer.embedding_backends import (
+    HashingBackend,
+    HuggingFaceAPIBackend,
+    get_backend,
+)
+from doofer.embeddings import EMBEDDINGS_SIZE, cosine_similarity
+
+
+def test_hashing_backend_is_deterministic():
+    backend = HashingBackend()
+    vector = backend.embed("The quick brown fox")
+    assert len(vector) == EMBEDDINGS_SIZE
+    assert vector == backend.embed("the quick brown FOX")
+
+
+def test_hashing_backend_similarity():
+    backend = HashingBackend()
+    query = backend.embed("django search")
+    close = backend.embed("searching notes with django search")
+    far = backend.embed("a recipe for banana bread")
+    assert cosine_similarity(query, close) > cosine_similarity(query, far)
+
+
+def test_get_backend_from_settings():
+    with override_settings(EMBEDDING_BACKEND="huggingface"):
+        assert isinstance(get_backend(), HuggingFaceAPIBackend)
+    with override_settings(
+        EMBEDDING_BACKEND="doofer.embedding_backends.HashingBackend"
+    ):
+        assert isinstance(get_backend(), HashingBackend)
+    with override_settings(EMBEDDING_BACKEND="nonsense"):
+        with pytest.raises(ImproperlyConfigured):
+            get_backend()
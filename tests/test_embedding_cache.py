@@ -0,0 +1,37 @@
+import pytest
+
+from doofer.embedding_cache import EmbeddingCache, text_hash
+from doofer.embeddings import get_text_embedding, get_text_embeddings
+from doofer.models import EmbeddingCacheEntry
+
+
+def test_text_hash_normalizes_whitespace():
+    assert text_hash("  some   text\n") == text_hash("some text")
+    assert text_hash("some text") != text_hash("other text")
+
+
+@pytest.mark.django_db
+def test_cache_tiers():
+    cache = EmbeddingCache(max_entries=1)
+    assert cache.get("model", "a") is None
+    cache.put("model", "a", [1.0, 2.0])
+    cache.put("model", "b", [3.0, 4.0])
+    assert cache.get("model", "b") == [3.0, 4.0]
+    # "a" was evicted from memory but is still in the table
+    assert cache.get("model", "a") == [1.0, 2.0]
+    assert cache.get("other model", "a") is None
+    stats = cache.stats()
+    assert (stats["memory_hits"], stats["db_hits"], stats["misses"]) == (1, 1, 2)
+    assert stats["memory_entries"] == 1
+
+
+@pytest.mark.django_db
+def test_get_text_embedding_uses_cache():
+    vector = get_text_embedding("cached query")
+    assert EmbeddingCacheEntry.objects.count() == 1
+    assert get_text_embedding("cached  query ") == pytest.approx(vector)
+
+    vectors = get_text_embeddings(["cached query", "new", "new"])
+    assert vectors[0] == pytest.approx(vector)
+    assert vectors[1] == vectors[2]
+    assert EmbeddingCacheEntry.objects.count() == 2
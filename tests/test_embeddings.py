@@ -1,8 +1,19 @@
+import asyncio
+import threading
+
 import pytest
+from asgiref.sync import async_to_sync
 
+from doofer import embeddings
+from doofer.embedding_backends import HashingBackend
 from doofer.models import Note
 from doofer.embeddings import (
     EMBEDDINGS_SIZE,
+    aget_text_embedding,
+    batches,
+    embedding_flights,
+    start_text_embedding,
+    update_notes_embeddings,
     cosine_similarity,
     get_hf_embeddings,
     get_text_embedding,
@@ -23,6 +34,7 @@ def test_getHFembeddings():
     assert len(embeddings) == EMBEDDINGS_SIZE
 
 
+@pytest.mark.django_db
 def test_getTextEmbedding():
     text = "This is a test."
     embeddings = get_text_embedding(text)
@@ -45,3 +57,126 @@ def test_getNoteSimilarity():
     )
     similarity = get_note_similarity(note1, note2)
     assert similarity > 0.0
+
+
+def test_batches():
+    texts = ["a" * 10, "b" * 10, "c" * 10, "d" * 50, "e"]
+    assert list(batches(texts, max_size=2, max_chars=100)) == [
+        texts[0:2],
+        texts[2:4],
+        texts[4:],
+    ]
+    assert list(batches(texts, max_size=10, max_chars=30)) == [
+        texts[0:3],
+        texts[3:4],
+        texts[4:],
+    ]
+
+
+class CountingBackend(HashingBackend):
+    def __init__(self):
+        self.calls = []
+
+    def embed_batch(self, texts):
+        self.calls.append(len(texts))
+        return super().embed_batch(texts)
+
+
+@pytest.mark.django_db
+def test_updateNotesEmbeddings(monkeypatch, django_assert_max_num_queries):
+    backend = CountingBackend()
+    monkeypatch.setattr(embeddings, "get_backend", lambda: backend)
+    Note.objects.bulk_create(
+        Note(user=1, title=f"title {i}", comment=f"comment {i}") for i in range(40)
+    )
+    notes = list(Note.objects.all())
+
+    # cache lookup, one cache insert per batch, the text check and the
+    # bulk update, in a savepoint here
+    with django_assert_max_num_queries(8):
+        update_notes_embeddings(notes)
+    assert backend.calls == [32, 32, 16]
+
+    for note in Note.objects.all():
+        assert len(note.get_title_embeddings()) == EMBEDDINGS_SIZE
+        assert len(note.get_content_embeddings()) == EMBEDDINGS_SIZE
+
+    update_notes_embeddings(list(Note.objects.all()))
+    assert backend.calls == [32, 32, 16]
+
+
+@pytest.mark.django_db
+def test_edit_during_embedding_is_not_overwritten(monkeypatch):
+    monkeypatch.setattr(embeddings, "get_backend", lambda: HashingBackend())
+    note = Note.objects.create(user=1, title="old title")
+    stale = Note.objects.get(id=note.id)
+    # the note is edited while the worker is embedding its old text
+    note.title = "completely different"
+    note.save()
+    update_notes_embeddings([stale])
+    note.refresh_from_db()
+    assert note.title_embedding == b""
+
+    update_notes_embeddings([note])
+    note.refresh_from_db()
+    assert note.get_title_embeddings() == pytest.approx(
+        get_text_embedding("completely different"), abs=1e-6
+    )
+
+
+class GatedBackend(HashingBackend):
+    """counts calls, which wait until the gate opens"""
+
+    def __init__(self):
+        self.calls = 0
+        self.gate = threading.Event()
+
+    def embed(self, text, deadline=None):
+        self.calls += 1
+        self.gate.wait(5)
+        return super().embed(text, deadline)
+
+    async def aembed(self, text, deadline=None):
+        self.calls += 1
+        await asyncio.sleep(0.05)
+        return super().embed(text, deadline)
+
+
+@pytest.mark.django_db
+def test_concurrent_embeddings_share_a_call(monkeypatch):
+    backend = GatedBackend()
+    monkeypatch.setattr(embeddings, "get_backend", lambda: backend)
+    waiting = [start_text_embedding("popular query") for _ in range(5)]
+    other = start_text_embedding("another query")
+    backend.gate.set()
+    vectors = [result() for result in waiting]
+    assert all(vector == vectors[0] for vector in vectors)
+    assert len(other()) == EMBEDDINGS_SIZE
+    assert backend.calls == 2
+    assert embedding_flights.stats()["coalesced"] == 4
+
+    # later requests come from the cache
+    assert start_text_embedding("popular query")() == vectors[0]
+    assert backend.calls == 2
+
+
+@pytest.mark.django_db
+def test_concurrent_async_embeddings_share_a_call(monkeypatch):
+    backend = GatedBackend()
+    monkeypatch.setattr(embeddings, "get_backend", lambda: backend)
+
+    async def embed_all():
+        return await asyncio.gather(
+            *(aget_text_embedding("popular query") for _ in range(5))
+        )
+
+    vectors = async_to_sync(embed_all)()
+    assert all(vector == vectors[0] for vector in vectors)
+    assert len(vectors[0]) == EMBEDDINGS_SIZE
+    assert backend.calls == 1
+    assert embedding_flights.stats() == {
+        "calls": 1,
+        "coalesced": 4,
+        "coalesced_rate": 0.8,
+        "in_flight": 0,
+    }
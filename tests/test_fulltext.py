@@ -0,0 +1,66 @@
+import pytest
+from django.db import connection
+
+from doofer import fulltext
+from doofer.fulltext import search_terms, text_search
+from doofer.models import Note
+from doofer.search import do_text_search
+
+from fixtures import user_1
+
+
+def test_search_terms_strip_query_syntax():
+    assert search_terms('Embed* OR "vectors" NEAR(a b)') == [
+        "embed",
+        "or",
+        "vectors",
+        "near",
+        "a",
+        "b",
+    ]
+
+
+@pytest.mark.django_db
+def test_ranked_prefix_search(user_1):
+    in_comment = Note.objects.create(
+        user=user_1.id, title="notes", comment="about embeddings"
+    )
+    in_title = Note.objects.create(user=user_1.id, title="Embedding models")
+    Note.objects.create(user=user_1.id, title="unrelated")
+    Note.objects.create(user=user_1.id + 1, title="someone else's embeddings")
+
+    # title matches rank first, "embed" matches as a prefix
+    assert text_search(user_1.id, "embed", 10) == [
+        (in_title.id, "Embedding models"),
+        (in_comment.id, "notes"),
+    ]
+    assert text_search(user_1.id, "embed about", 10) == [(in_comment.id, "notes")]
+    assert text_search(user_1.id, "embed", 1) == [(in_title.id, "Embedding models")]
+    assert text_search(user_1.id, "!!", 10) == []
+
+
+@pytest.mark.django_db
+def test_index_follows_writes(user_1):
+    note = Note.objects.create(user=user_1.id, title="first title")
+    Note.objects.filter(id=note.id).update(title="second title")
+    assert text_search(user_1.id, "first", 10) == []
+    assert text_search(user_1.id, "second", 10) == [(note.id, "second title")]
+    note.delete()
+    assert text_search(user_1.id, "second", 10) == []
+
+
+@pytest.mark.django_db
+def test_repair_restores_dropped_triggers(user_1):
+    with connection.cursor() as cursor:
+        cursor.execute("DROP TRIGGER doofer_note_fts_insert")
+    note = Note.objects.create(user=user_1.id, title="missed while dropped")
+    fulltext.repair(connection)
+    assert text_search(user_1.id, "missed", 10) == [(note.id, "missed while dropped")]
+
+
+@pytest.mark.django_db
+def test_text_search_puts_text_matches_first(user_1):
+    note = Note.objects.create(user=user_1.id, title="a note about python")
+    Note.objects.create(user=user_1.id, title="something else")
+    results = do_text_search("pyth", user_1.id, 1)
+    assert [int(result.id) for result in results] == [note.id]
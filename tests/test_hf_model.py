@@ -0,0 +1,107 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from doofer import hf_model
+from doofer.hf_model import (
+    HFKey,
+    backoff_delay,
+    get_hf_embeddings,
+    get_hf_embeddings_async,
+    get_hf_embeddings_batch,
+)
+
+
+class StandInAPI(BaseHTTPRequestHandler):
+    """answers like the feature extraction API, after 'failures' 503s"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers["Content-Length"])
+        inputs = json.loads(self.rfile.read(length))["inputs"]
+        with server.lock:
+            server.requests.append(self.headers["Authorization"])
+            server.connections.add(self.client_address)
+            fail = server.failures > 0
+            server.failures -= 1
+        if fail:
+            self.reply(503, {"error": "Model is loading"})
+        elif isinstance(inputs, list):
+            self.reply(200, [[float(len(text))] * 3 for text in inputs])
+        else:
+            self.reply(200, [float(len(inputs))] * 3)
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def stand_in_api(settings, monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInAPI)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.connections = set()
+    server.failures = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setenv("API_TOKEN", "test-token")
+    monkeypatch.setattr(HFKey, "_token", None)
+    settings.HF_API_URL = f"http://127.0.0.1:{server.server_port}/"
+    settings.EMBEDDING_HTTP_BACKOFF = 0.001
+    yield server
+    hf_model.close_clients()
+    server.shutdown()
+    server.server_close()
+
+
+def test_connections_are_reused(stand_in_api):
+    assert get_hf_embeddings("four") == [4.0, 4.0, 4.0]
+    assert get_hf_embeddings_batch(["a", "bb"]) == [[1.0] * 3, [2.0] * 3]
+    assert get_hf_embeddings("x") == [1.0] * 3
+    assert stand_in_api.requests == ["Bearer test-token"] * 3
+    assert len(stand_in_api.connections) == 1
+
+
+def test_retries_then_gives_up(stand_in_api, settings):
+    stand_in_api.failures = 2
+    assert get_hf_embeddings("four") == [4.0] * 3
+    assert len(stand_in_api.requests) == 3
+
+    settings.EMBEDDING_HTTP_RETRIES = 2
+    stand_in_api.failures = 5
+    assert get_hf_embeddings("four") == []
+    assert len(stand_in_api.requests) == 5
+
+
+def test_async_calls_run_together(stand_in_api, settings):
+    settings.EMBEDDING_HTTP_POOL_SIZE = 4
+
+    async def embed_all():
+        texts = ["x" * size for size in range(1, 9)]
+        return await asyncio.gather(*(get_hf_embeddings_async(t) for t in texts))
+
+    vectors = asyncio.run(embed_all())
+    assert vectors == [[float(size)] * 3 for size in range(1, 9)]
+    assert len(stand_in_api.connections) <= 4
+
+
+def test_backoff_delay_grows_with_jitter(settings):
+    settings.EMBEDDING_HTTP_BACKOFF = 1.0
+    settings.EMBEDDING_HTTP_BACKOFF_MAX = 5.0
+    delays = [backoff_delay(4) for _ in range(200)]
+    assert all(0 <= delay <= 5.0 for delay in delays)
+    assert len(set(delays)) > 1
+    assert all(backoff_delay(1) <= 1.0 for _ in range(50))
@@ -0,0 +1,155 @@
+import numpy as np
+import pytest
+from django.db import transaction
+from django.test import override_settings
+from django.utils import timezone
+
+from doofer.embeddings import update_notes_embeddings
+from doofer.index_cache import IndexCache, get_user_index, index_cache
+from doofer.models import Job, Note
+from doofer.search import do_note_search
+from doofer.similarity import NoteIndex
+
+from fixtures import user_1, note_1, note_2
+
+
+def embed(note, title, content):
+    note.set_title_embeddings(title)
+    note.set_content_embeddings(content)
+    note.save()
+
+
+@pytest.mark.django_db
+def test_index_is_cached(user_1, note_1, note_2, django_assert_num_queries):
+    embed(note_1, [1.0, 0.0], [0.0, 1.0])
+    embed(note_2, [1.0, 1.0], [1.0, 0.0])
+    index = get_user_index(user_1.id)
+    assert list(index.ids) == [note_1.id, note_2.id]
+    # only the fingerprint query runs while nothing changes
+    with django_assert_num_queries(1):
+        assert get_user_index(user_1.id) is index
+
+
+@pytest.mark.django_db
+def test_index_sees_writes_from_other_processes(user_1, note_1, note_2):
+    embed(note_1, [1.0, 0.0], [0.0, 1.0])
+    get_user_index(user_1.id)
+
+    # queryset writes send no signals, like a save in another process
+    Note.objects.filter(id=note_2.id).update(
+        title_embedding=note_1.title_embedding, embedded_at=timezone.now()
+    )
+    Note.objects.filter(id=note_1.id).delete()
+    index = get_user_index(user_1.id)
+    assert list(index.ids) == [note_2.id]
+    assert np.allclose(index.matrix[0, 0], [1.0, 0.0])
+
+
+@pytest.mark.django_db
+def test_index_follows_saves_and_deletes(user_1, note_1, note_2):
+    embed(note_1, [1.0, 0.0], [0.0, 1.0])
+    embed(note_2, [1.0, 1.0], [1.0, 0.0])
+    get_user_index(user_1.id)
+
+    note_2.title = "renamed"
+    embed(note_2, [0.0, 1.0], [1.0, 1.0])
+    index = get_user_index(user_1.id)
+    assert index.titles[index.rows[note_2.id]] == "renamed"
+    assert np.allclose(index.matrix[index.rows[note_2.id], 0], [0.0, 1.0])
+    assert np.allclose(index.matrix[index.rows[note_2.id], 1], [0.7071, 0.7071])
+
+    note_3 = Note.objects.create(user=user_1.id, title="new")
+    embed(note_3, [1.0, 0.0], [])
+    assert list(get_user_index(user_1.id).ids) == [note_1.id, note_2.id, note_3.id]
+
+    note_1.delete()
+    assert list(get_user_index(user_1.id).ids) == [note_2.id, note_3.id]
+
+    results = do_note_search(str(note_3.id), 10, user_1.id)
+    assert [r.id for r in results] == [str(note_3.id), str(note_2.id)]
+
+
+@pytest.mark.django_db
+def test_index_ignores_rolled_back_saves(
+    user_1, note_1, django_capture_on_commit_callbacks
+):
+    embed(note_1, [1.0, 0.0], [0.0, 1.0])
+    index = get_user_index(user_1.id)
+
+    with django_capture_on_commit_callbacks(execute=True):
+        with pytest.raises(ValueError), transaction.atomic():
+            embed(note_1, [0.0, 1.0], [1.0, 0.0])
+            raise ValueError
+    assert index_cache.get(str(user_1.id)) is index
+
+    with django_capture_on_commit_callbacks(execute=True):
+        note_1.delete()
+    assert len(index_cache.get(str(user_1.id))) == 0
+
+
+def test_cache_evicts_least_recently_used():
+    def index(size):
+        return NoteIndex(np.arange(size), ["t"] * size, np.zeros((size, 2, 4)))
+
+    cache = IndexCache(max_users=2, max_bytes=500)
+    cache.put("1", index(1), 0)
+    cache.put("2", index(1), 0)
+    cache.get("1")
+    cache.put("3", index(1), 0)
+    assert cache.get("2") is None
+    assert cache.get("1") is not None
+
+    cache.put("4", index(6), 0)
+    assert len(cache) == 1
+    assert cache.nbytes <= 500
+
+
+def test_evicted_users_forget_their_generation():
+    def index():
+        return NoteIndex(np.arange(0), [], np.zeros((0, 2, 4)))
+
+    cache = IndexCache(max_users=1)
+    for uid in map(str, range(5)):
+        cache.discard(uid)
+        cache.put(uid, index(), cache.generation(uid))
+        cache.replace(uid, lambda index: index)
+    assert list(cache._generations) == ["4"]  # pylint: disable=protected-access
+
+    # a build that started before the eviction is still dropped
+    generation = cache.generation("4")
+    cache.replace("4", lambda index: index)
+    cache.put("0", index(), cache.generation("0"))
+    assert cache.get("4") is None
+    cache.put("4", index(), generation)
+    assert cache.get("4") is None
+
+
+def test_stale_build_is_not_cached():
+    cache = IndexCache()
+    generation = cache.generation("1")
+    cache.discard("1")
+    cache.put("1", NoteIndex(np.arange(0), [], np.zeros((0, 2, 4))), generation)
+    assert cache.get("1") is None
+
+
+@pytest.mark.django_db
+@override_settings(ANN_MIN_NOTES=1000)
+def test_embedding_batch_updates_cached_index_once(user_1, note_1, monkeypatch):
+    update_notes_embeddings([note_1])
+    notes = [Note.objects.create(user=user_1.id, title=f"new {i}") for i in range(3)]
+    get_user_index(user_1.id)
+    Job.objects.all().delete()
+    copies = []
+    upsert_many = NoteIndex.upsert_many
+    monkeypatch.setattr(
+        NoteIndex,
+        "upsert_many",
+        lambda self, *args: copies.append(args) or upsert_many(self, *args),
+    )
+
+    update_notes_embeddings(notes)
+    assert len(copies) == 1
+    index = index_cache.get(str(user_1.id))
+    assert list(index.ids) == [note_1.id] + [note.id for note in notes]
+    assert all(index.matrix[index.rows[note.id], 0].any() for note in notes)
+    assert Job.objects.filter(kind="ann_sync").count() == 1
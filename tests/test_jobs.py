@@ -0,0 +1,79 @@
+from datetime import timedelta
+
+import pytest
+from django.utils import timezone
+
+from doofer import jobs
+from doofer.jobs import claim_next, enqueue, run_pending
+from doofer.models import Job, Note
+
+from fixtures import user_1
+
+
+@pytest.mark.django_db
+def test_saving_a_note_queues_embedding(user_1):
+    note = Note.objects.create(user=user_1.id, title="a title", comment="a comment")
+    Note.objects.create(user=user_1.id, title="another")
+    job = Job.objects.get(kind="embed_missing")
+    assert job.payload == {"user": user_1.id}
+
+    # the embedding job, then the related notes update
+    assert run_pending() == 2
+    job.refresh_from_db()
+    assert job.status == Job.DONE
+    note.refresh_from_db()
+    assert note.get_title_embeddings() and note.get_content_embeddings()
+    assert note.embedded_at is not None
+
+    # writing the embeddings does not queue another job
+    assert Job.objects.filter(status=Job.PENDING).count() == 0
+
+
+@pytest.mark.django_db
+def test_editing_text_queues_re_embedding(user_1):
+    note = Note.objects.create(user=user_1.id, title="a title")
+    run_pending()
+    note = Note.objects.get(id=note.id)
+    note.title = "a new title"
+    note.save()
+    assert note.title_embedding == b""
+    pending = Job.objects.filter(status=Job.PENDING, kind="embed_missing")
+    assert pending.count() == 1
+
+
+@pytest.mark.django_db
+def test_failed_job_backs_off_then_fails(monkeypatch):
+    calls = []
+
+    def fail(**kwargs):
+        calls.append(kwargs)
+        raise ValueError("boom")
+
+    monkeypatch.setitem(jobs.HANDLERS, "test_fail", fail)
+    monkeypatch.setattr(jobs, "MAX_ATTEMPTS", 2)
+    job = enqueue("test_fail", value=1)
+    assert run_pending() == 1
+    job.refresh_from_db()
+    assert job.status == Job.PENDING
+    assert job.run_after > timezone.now()
+    assert "boom" in job.error
+
+    Job.objects.filter(id=job.id).update(run_after=timezone.now())
+    assert run_pending() == 1
+    job.refresh_from_db()
+    assert job.status == Job.FAILED
+    assert calls == [{"value": 1}, {"value": 1}]
+
+
+@pytest.mark.django_db
+def test_unique_enqueue_and_stale_claims():
+    first = enqueue("test_kind", unique=True, user=1)
+    assert enqueue("test_kind", unique=True, user=1) == first
+    assert enqueue("test_kind", unique=True, user=2) != first
+
+    job = claim_next()
+    assert job.status == Job.RUNNING and job.attempts == 1
+    # a job locked by a worker that died is claimed again
+    stale = timezone.now() - timedelta(seconds=jobs.LOCK_TIMEOUT + 1)
+    Job.objects.filter(id=job.id).update(locked_at=stale)
+    assert claim_next().id == job.id
@@ -1,3 +1,7 @@
+import math
+
+import pytest
+
 from doofer.models import Note
 
 from fixtures import user_1, note_1, note_2, note_3
@@ -9,7 +13,11 @@ def test_get_title_embeddings(note_1, note_2, note_3):
 
     note_1_embeddings = [0.1, 0.2, 0.3]
     note_1.set_title_embeddings(note_1_embeddings)
-    assert note_1.get_title_embeddings() == note_1_embeddings
+    norm = math.sqrt(0.14)
+    assert note_1.get_title_embeddings() == pytest.approx(
+        [e / norm for e in note_1_embeddings]
+    )
+    assert note_1.title_embedding_norm == pytest.approx(norm)
 
     note_2_embeddings = []
     note_2.set_title_embeddings(note_2_embeddings)
@@ -17,4 +25,38 @@ def test_get_title_embeddings(note_1, note_2, note_3):
 
     note_3_embeddings = [0.9]
     note_3.set_title_embeddings(note_3_embeddings)
-    assert note_3.get_title_embeddings() == note_3_embeddings
+    assert note_3.get_title_embeddings() == pytest.approx([1.0])
+    assert note_3.title_embedding_norm == pytest.approx(0.9)
+
+
+def test_embeddings_stored_as_float32(note_1):
+    note_1.set_title_embeddings([0.0, -2.0, 0.0])
+    assert note_1.title_embedding == b"\x00\x00\x00\x00\x00\x00\x80\xbf\x00\x00\x00\x00"
+    assert note_1.title_vector().dtype.itemsize == 4
+    assert note_1.content_vector().size == 0
+
+
+def test_zero_embeddings_are_flagged(note_1):
+    note_1.set_content_embeddings([0.0, 0.0])
+    assert note_1.content_embedding_norm == 0
+    assert note_1.get_content_embeddings() == [0.0, 0.0]
+
+
+@pytest.mark.django_db
+def test_save_renders_html_and_thumbnail(user_1):
+    note = Note.objects.create(
+        user=user_1.id,
+        comment="From page:  \n**one**\ntwo\nthree\nfour",
+        url="https://www.youtube.com/watch?v=abc123",
+    )
+    note = Note.objects.get(id=note.id)
+    assert note.comment_html.startswith("<p>From page:")
+    assert note.preview_html == "<p><strong>one</strong>\ntwo\nthree...</p>"
+    assert note.thumbnail_url == "https://img.youtube.com/vi/abc123/sddefault.jpg"
+
+    note.comment = "*changed*"
+    note.url = "https://example.com"
+    note.save(update_fields=["comment", "url"])
+    note = Note.objects.get(id=note.id)
+    assert note.comment_html == note.preview_html == "<p><em>changed</em></p>"
+    assert note.get_yt_thumbnail_url() is None
@@ -0,0 +1,59 @@
+import pytest
+from django.db import connection
+from django.utils import timezone
+
+from doofer.models import Note
+from doofer.pagination import after_cursor, page, user_notes
+from doofer.search import NoteSummaryRecord, load_result_notes
+
+from fixtures import user_1
+
+
+@pytest.mark.django_db
+def test_pages_break_ties_on_id(user_1):
+    for i in range(5):
+        Note.objects.create(user=user_1.id, title=f"note {i}")
+    Note.objects.create(user=user_1.id + 1, title="someone else's")
+    # notes saved in the same instant are ordered by id
+    Note.objects.update(updated_at=timezone.now())
+
+    seen, cursor = [], None
+    while True:
+        notes, cursor = page(user_notes(user_1.id), cursor, 2)
+        seen += [note.title for note in notes]
+        if cursor is None:
+            break
+    assert seen == [f"note {i}" for i in reversed(range(5))]
+
+
+@pytest.mark.django_db
+def test_user_notes_use_the_user_index(user_1):
+    Note.objects.create(user=user_1.id, title="a note")
+    notes, cursor = page(user_notes(user_1.id), None, 10)
+    assert [note.title for note in notes] == ["a note"] and cursor is None
+    # the embeddings are left in the database
+    assert "title_embedding" in notes[0].get_deferred_fields()
+
+    if connection.vendor == "sqlite":
+        plan = after_cursor(user_notes(user_1.id), None)[:11].explain()
+        assert "note_user_updated" in plan
+
+
+@pytest.mark.django_db
+def test_note_list_loads_only_the_fields_shown(user_1, django_assert_num_queries):
+    for i in range(3):
+        Note.objects.create(
+            user=user_1.id,
+            title=f"note {i}",
+            comment="**bold** " * 500,
+            url="https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+        )
+    notes, _ = page(user_notes(user_1.id), None, 10)
+    results = [NoteSummaryRecord(id=str(note.id), title=note.title) for note in notes]
+    found = load_result_notes(results, user_1.id)
+    for listed in (notes, found):
+        assert {"comment", "comment_html"} <= listed[0].get_deferred_fields()
+        # the fields note_list.html shows are loaded already
+        with django_assert_num_queries(0):
+            shown = [(n.id, n.title, n.preview_html, n.thumbnail_url) for n in listed]
+        assert shown[0][1] == "note 2" and "img.youtube.com" in shown[0][3]
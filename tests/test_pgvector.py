@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+from django.db import connection
+
+from doofer import pgvector
+from doofer.embeddings import get_text_embedding
+from doofer.models import Note
+from doofer.search import do_note_search, do_text_search, get_search_index
+
+from fixtures import user_1
+
+requires_pgvector = pytest.mark.skipif(
+    connection.vendor != "postgresql",
+    reason="needs PostgreSQL with the vector extension, eg DATABASE_URL=postgres://...",
+)
+
+
+def make_notes(user, titles):
+    notes = []
+    for title in titles:
+        note = Note.objects.create(user=user.id, title=title)
+        note.set_title_embeddings(get_text_embedding(title))
+        note.save()
+        notes.append(note)
+    return notes
+
+
+def test_vector_literal():
+    assert pgvector.vector_literal(np.array([0.5, -1.0], dtype="<f4")) == "[0.5,-1.0]"
+
+
+@pytest.mark.django_db
+def test_python_fallback_without_postgres(user_1):
+    if connection.vendor == "postgresql":
+        pytest.skip("the fallback is for other databases")
+    assert not pgvector.enabled()
+    make_notes(user_1, ["travel in japan", "japanese cooking"])
+    assert len(get_search_index(user_1.id)) == 2
+
+
+@requires_pgvector
+@pytest.mark.django_db
+def test_vector_columns_follow_embeddings(user_1):
+    (note,) = make_notes(user_1, ["travel in japan"])
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT title_vector::text, content_vector FROM doofer_note WHERE id = %s",
+            [note.id],
+        )
+        title_vector, content_vector = cursor.fetchone()
+    decoded = np.array(title_vector.strip("[]").split(","), dtype=np.float32)
+    assert np.allclose(decoded, note.title_vector(), atol=1e-6)
+    assert content_vector is None
+
+
+@requires_pgvector
+@pytest.mark.django_db
+def test_sql_ranking_matches_python(user_1, settings):
+    titles = ["travel in japan", "japanese cooking", "gardening tips", "japan rail"]
+    notes = make_notes(user_1, titles)
+    assert pgvector.enabled()
+    in_sql = do_note_search(str(notes[0].id), 3, user_1.id, threshold=-1)
+    in_sql_text = do_text_search("japan trip", user_1.id, 3)
+
+    settings.VECTOR_SEARCH = "python"
+    assert do_note_search(str(notes[0].id), 3, user_1.id, threshold=-1) == in_sql
+    assert do_text_search("japan trip", user_1.id, 3) == in_sql_text
+
+
+@requires_pgvector
+@pytest.mark.django_db
+def test_sql_decodes_float32_bits():
+    values = np.array(
+        [0.0, -0.0, 1.0, -2.5, 0.1, 3.4e38, -1.2e-38, 1e-45, 0.333333, 1e-7],
+        dtype="<f4",
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT doofer_unpack_embedding(%s, %s)::text,"
+            " doofer_unpack_embedding(%s, %s)",
+            [values.tobytes(), len(values), values.tobytes(), len(values) + 1],
+        )
+        decoded, wrong_size = cursor.fetchone()
+    decoded = np.array(decoded.strip("[]").split(","), dtype=np.float32)
+    # subnormals, like 1e-45, decode as 0
+    expected = np.where(np.abs(values) < np.finfo("<f4").tiny, 0, values)
+    assert np.allclose(decoded, expected, rtol=1e-6, atol=0)
+    assert wrong_size is None
+
+
+@requires_pgvector
+@pytest.mark.django_db
+@pytest.mark.parametrize("exact_max_notes", [10000, 0])
+def test_small_library_gets_all_results(user_1, settings, exact_max_notes):
+    settings.PGVECTOR_EXACT_MAX_NOTES = exact_max_notes
+    settings.PGVECTOR_EF_SEARCH = 10
+    # other users' notes close to the query fill the first index candidates
+    others = [Note(user=user_1.id + 1, title="japan") for _ in range(200)]
+    vector = get_text_embedding("japan")
+    for note in others:
+        note.set_title_embeddings(vector)
+    Note.objects.bulk_create(others)
+    mine = make_notes(user_1, ["travel in japan", "japan rail", "gardening"])
+
+    results = pgvector.similar_notes(user_1.id, [vector], 3, threshold=-1)
+    assert sorted(note_id for note_id, _ in results) == sorted(n.id for n in mine)
@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+from asgiref.sync import async_to_sync
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from doofer import related
+from doofer.api.views import note_related
+from doofer.jobs import run_pending
+from doofer.models import Note, RelatedNote
+from doofer.related import get_related_notes, rebuild_related, update_stale_related
+
+from fixtures import user_1
+
+
+def make_notes(user, count, seed=0):
+    rng = np.random.default_rng(seed)
+    notes = []
+    for number in range(count):
+        note = Note(user=user.id, title=f"note {number}")
+        note.set_title_embeddings(rng.standard_normal(8).tolist())
+        note.save()
+        notes.append(note)
+    return notes
+
+
+def graph(user):
+    links = RelatedNote.objects.filter(from_note__user=user.id)
+    return sorted(links.values_list("from_note_id", "rank", "to_note_id"))
+
+
+@pytest.mark.django_db
+def test_rebuild_related(user_1):
+    vectors = {"a": [1.0, 0.0], "b": [0.9, 0.1], "c": [0.0, 1.0]}
+    notes = {}
+    for title, vector in vectors.items():
+        notes[title] = Note(user=user_1.id, title=title)
+        notes[title].set_title_embeddings(vector)
+        notes[title].save()
+    rebuild_related(user_1.id)
+    # not related to itself, and c is too far from either
+    assert [note.title for note in get_related_notes(notes["a"].id, user_1.id)] == [
+        "b"
+    ]
+    assert get_related_notes(notes["c"].id, user_1.id) == []
+    notes["a"].refresh_from_db()
+    assert notes["a"].related_updated_at is not None
+
+
+@pytest.mark.django_db
+def test_incremental_update_matches_rebuild(user_1, monkeypatch):
+    monkeypatch.setattr(related, "RELATED_COUNT", 3)
+    monkeypatch.setattr(related, "THRESHOLD", -1.0)
+    notes = make_notes(user_1, 30)
+    rebuild_related(user_1.id)
+
+    rng = np.random.default_rng(1)
+    for note in notes[:3]:
+        note.set_title_embeddings(rng.standard_normal(8).tolist())
+        note.save()
+    # the user's lists are read once, not once per changed note
+    reads = []
+    worst_scores = related.worst_scores
+    monkeypatch.setattr(
+        related, "worst_scores", lambda uid: reads.append(uid) or worst_scores(uid)
+    )
+    update_stale_related(user_1.id)
+    assert reads == [user_1.id]
+    incremental = graph(user_1)
+
+    rebuild_related(user_1.id)
+    assert incremental == graph(user_1)
+
+
+@pytest.mark.django_db
+def test_delete_refreshes_lists(user_1):
+    notes = make_notes(user_1, 3)
+    for note in notes:
+        note.set_title_embeddings([1.0, 0.0])
+        note.save()
+    run_pending()
+    assert len(get_related_notes(notes[0].id, user_1.id)) == 2
+
+    notes[1].delete()
+    run_pending()
+    assert [int(note.id) for note in get_related_notes(notes[0].id, user_1.id)] == [
+        notes[2].id
+    ]
+
+
+@pytest.mark.django_db
+def test_related_endpoint(user_1, django_assert_num_queries):
+    notes = make_notes(user_1, 2)
+    for note in notes:
+        note.set_title_embeddings([1.0, 0.0])
+        note.save()
+    rebuild_related(user_1.id)
+
+    request = APIRequestFactory().get(f"/api/note/{notes[0].id}/related/")
+    force_authenticate(request, user=user_1)
+    with django_assert_num_queries(1):
+        response = async_to_sync(note_related)(request, id_=notes[0].id)
+    assert response.data == [{"id": notes[1].id, "title": notes[1].title}]
@@ -1,14 +1,26 @@
+import asyncio
+import time
+
 import pytest
+from asgiref.sync import async_to_sync
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
-from doofer.embeddings import get_text_embedding
+from doofer.embedding_backends import HashingBackend
+from doofer.embeddings import embedding_breaker, get_text_embedding
+from doofer.index_cache import get_user_index
 from doofer.models import Note
 from doofer.search import (
     get_my_notes,
     get_similar_to_text,
     get_note_by_id,
     vecs_similar_ranked,
+    ado_text_search,
     do_text_search,
     do_note_search,
+    fuse_rankings,
+    load_result_notes,
+    NoteSummaryRecord,
 )
 from fixtures import user_1, note_1, note_2, note_3
 
@@ -76,3 +88,113 @@ def test_doNoteSearch(note_1):
     threshold = 0.25
     expected = do_note_search(noteId, maxResults, uid, threshold)
     assert do_note_search(noteId, maxResults, uid, threshold) == expected
+
+
+def test_fuse_rankings():
+    a, b, c = (NoteSummaryRecord(str(i), f"note {i}") for i in range(3))
+    # b is in both rankings, so it beats both first places
+    assert fuse_rankings([(1.0, [a, b]), (1.0, [c, b])], 10, 60) == [b, a, c]
+    # weights favour one ranking
+    assert fuse_rankings([(1.0, [a]), (3.0, [c])], 10, 60) == [c, a]
+    assert fuse_rankings([(1.0, [a, b]), (1.0, [c, b])], 1, 60) == [b]
+
+
+@pytest.mark.django_db
+def test_do_text_search_fuses_text_and_similarity(user_1, settings):
+    settings.SEARCH_VECTOR_WEIGHT = 0.0
+    texts = ["travel in japan", "japanese cooking", "gardening tips"]
+    notes = [Note.objects.create(user=user_1.id, title=text) for text in texts]
+    for note in notes:
+        note.set_title_embeddings(get_text_embedding(note.title))
+        note.save()
+    # only the full-text matches, "japan" matching "japanese" as a prefix
+    results = do_text_search("japan", user_1.id, 10)
+    assert {int(result.id) for result in results} == {notes[0].id, notes[1].id}
+
+    settings.SEARCH_VECTOR_WEIGHT = 1.0
+    results = do_text_search("japan", user_1.id, 10)
+    ids = [int(result.id) for result in results]
+    assert set(ids[:2]) == {notes[0].id, notes[1].id}
+    assert len(ids) == len(set(ids))
+
+
+@pytest.mark.django_db
+def test_search_index_skips_comments(user_1, note_1):
+    with CaptureQueriesContext(connection) as queries:
+        get_user_index(user_1.id)
+    assert not any('"comment"' in query["sql"] for query in queries)
+
+    results = [NoteSummaryRecord(str(note_1.id), note_1.title)]
+    assert load_result_notes(results, user_1.id) == [note_1]
+    assert load_result_notes(results, user_1.id + 1) == []
+
+
+class FailingBackend(HashingBackend):
+    calls = 0
+
+    def embed(self, text, deadline=None):
+        FailingBackend.calls += 1
+        raise ValueError("backend down")
+
+
+class SlowBackend(HashingBackend):
+    def embed(self, text, deadline=None):
+        time.sleep(0.5)
+        return super().embed(text, deadline)
+
+
+@pytest.mark.django_db
+def test_text_search_degrades_to_full_text(user_1, settings):
+    note = Note.objects.create(user=user_1.id, title="python notes")
+    settings.EMBEDDING_BACKEND = "test_search.FailingBackend"
+    settings.SEARCH_VECTOR_WEIGHT = 1.0
+    FailingBackend.calls = 0
+    for _ in range(settings.EMBEDDING_BREAKER_FAILURES + 2):
+        results = do_text_search("python", user_1.id, 10)
+        assert results.degraded
+        assert [int(result.id) for result in results] == [note.id]
+    # the open breaker stops calls to the backend
+    assert FailingBackend.calls == settings.EMBEDDING_BREAKER_FAILURES
+    assert embedding_breaker.is_open()
+
+
+@pytest.mark.django_db
+def test_text_search_deadline(user_1, settings):
+    Note.objects.create(user=user_1.id, title="python notes")
+    settings.EMBEDDING_BACKEND = "test_search.SlowBackend"
+    start = time.monotonic()
+    results = do_text_search("python", user_1.id, 10, time.monotonic() + 0.05)
+    assert time.monotonic() - start < 0.4
+    assert results.degraded
+    assert not do_text_search("python", user_1.id, 10).degraded
+
+
+@pytest.mark.django_db
+def test_async_text_search_matches_sync(user_1):
+    texts = ["travel in japan", "japanese cooking", "gardening tips"]
+    for text in texts:
+        note = Note.objects.create(user=user_1.id, title=text)
+        note.set_title_embeddings(get_text_embedding(text))
+        note.save()
+    results = async_to_sync(ado_text_search)("japan", user_1.id, 10)
+    assert results == do_text_search("japan", user_1.id, 10)
+    assert not results.degraded
+
+
+@pytest.mark.django_db
+def test_async_text_search_deadline(user_1, settings):
+    Note.objects.create(user=user_1.id, title="python notes")
+    settings.EMBEDDING_BACKEND = "test_search.SlowBackend"
+
+    async def search_twice():
+        # the other search is served while this one waits for its embedding
+        return await asyncio.gather(
+            ado_text_search("python", user_1.id, 10, time.monotonic() + 0.05),
+            asyncio.sleep(0.01, "served"),
+        )
+
+    start = time.monotonic()
+    results, other = async_to_sync(search_twice)()
+    assert time.monotonic() - start < 0.4
+    assert results.degraded and other == "served"
+    assert [result.title for result in results] == ["python notes"]
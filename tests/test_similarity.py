@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from doofer.embeddings import cosine_similarity
+from doofer.similarity import rank_scores, score_matrix, stack_embeddings, top_k
+
+
+def test_score_matrix_matches_cosine_similarity():
+    titles = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], []]
+    contents = [[0.0, 0.0, 1.0], [1.0, 1.0, 0.0], [0.0, 0.0, 0.0]]
+    vecs = [[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]]
+    rows = [vec for pair in zip(titles, contents) for vec in pair]
+    scores = score_matrix(vecs, stack_embeddings(rows, 3).reshape(3, 2, 3))
+    for i, (title, content) in enumerate(zip(titles, contents)):
+        expected = max(
+            max(cosine_similarity(vec, title), cosine_similarity(vec, content))
+            for vec in vecs
+        )
+        assert scores[i] == pytest.approx(expected, abs=1e-6)
+
+
+def test_top_k_keeps_order_of_ties():
+    scores = np.array([0.5, 0.9, 0.5, 0.7, 0.5])
+    assert list(top_k(scores, 3)) == [1, 3, 0]
+    assert list(top_k(scores, 10)) == [1, 3, 0, 2, 4]
+    assert list(top_k(scores, 0)) == []
+
+
+def test_rank_scores_applies_threshold():
+    scores = np.array([0.2, 0.9, 0.3, 0.25])
+    assert list(rank_scores(scores, 10, 0.25)) == [1, 2]
@@ -0,0 +1,65 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pytest
+
+from doofer.single_flight import SingleFlight
+
+
+def test_callers_share_a_call_until_it_lands():
+    flights = SingleFlight()
+    first, started = flights.submit("key", Future)
+    assert started
+    second, started = flights.submit("key", Future)
+    assert second is first and not started
+    other, started = flights.submit("other", Future)
+    assert other is not first and started
+
+    first.set_exception(ValueError("failed"))
+    with pytest.raises(ValueError):
+        second.result()
+    # a finished call is forgotten, the next caller starts a new one
+    third, started = flights.submit("key", Future)
+    assert third is not first and started
+    assert flights.stats()["calls"] == 3
+    assert flights.stats()["coalesced"] == 1
+    assert flights.in_flight() == 2
+
+
+def test_failed_start_leaves_nothing_in_flight():
+    flights = SingleFlight()
+
+    def refuse():
+        raise RuntimeError("refused")
+
+    with pytest.raises(RuntimeError):
+        flights.submit("key", refuse)
+    assert flights.in_flight() == 0
+    _, started = flights.submit("key", Future)
+    assert started
+
+
+def test_threads_coalesce():
+    flights = SingleFlight()
+    gate = threading.Event()
+    calls = []
+
+    def start():
+        calls.append(1)
+        future = Future()
+        threading.Thread(target=lambda: gate.wait(5) and future.set_result(42)).start()
+        return future
+
+    def caller(_):
+        future, _ = flights.submit("key", start)
+        return future.result(5)
+
+    with ThreadPoolExecutor(8) as pool:
+        results = pool.map(caller, range(8))
+        while flights.stats()["calls"] + flights.stats()["coalesced"] < 8:
+            time.sleep(0.001)
+        gate.set()
+        assert list(results) == [42] * 8
+    assert len(calls) == 1
+    assert flights.stats()["coalesced"] == 7